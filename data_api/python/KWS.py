@@ -36,6 +36,9 @@ try:
     # Python 2.5 and newer
     import hashlib
 
+    new_md5 = hashlib.md5
+    new_sha1 = hashlib.sha1
+
     def compute_md5_hex(data):
         h = hashlib.md5()
         h.update(data)
@@ -50,6 +53,9 @@ except ImportError:
     import md5
     import sha
 
+    new_md5 = md5.new
+    new_sha1 = sha.new
+
     def compute_md5_hex(data):
         h = md5.new()
         h.update(data)
@@ -89,14 +95,61 @@ else:
         return str(data)
 
 
-__all__ = ['KWSSigner']
+# Size of chunks read from streamed content
+CHUNK_SIZE = 65536
+
+
+def iterate_chunks(content, chunk_size = CHUNK_SIZE):
+    """ Generate chunks of content given as a file-like object (read from
+    its current position until the end) or as an iterable of buffers.
+    """
+    if hasattr(content, 'read'):
+        while True:
+            chunk = content.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for chunk in content:
+            yield chunk
+
+
+def compute_md5_hex_stream(content):
+    """ Compute MD5 hash of content given as a file-like object or as an
+    iterable of buffers (see iterate_chunks) without holding the whole
+    content in memory.
+    """
+    h = new_md5()
+    for chunk in iterate_chunks(content):
+        h.update(to_hashable(chunk))
+    return h.hexdigest()
+
+
+__all__ = ['KWSSigner', 'compute_md5_hex', 'compute_md5_hex_stream', 'iterate_chunks']
 
 
 class KWSSigner:
-    """ Class generating KWS request signatures. """
+    """ Class generating KWS request signatures.
+
+    The signer can be shared by multiple threads.
+    """
+
+    def __init__(self, secret_key, memoize = False):
+        """
+        Initialize signer with the secret key.
 
-    def __init__(self, secret_key):
+        If memoize is True, signatures of requests without content (e.g.
+        GET, DELETE) are remembered for as long as their date stays the
+        same, so that repeated identical requests made within the same
+        second are signed only once.
+        """
         self.secret_key = ascii_to_hashable(secret_key)
+        # hash state after the constant prefix of all the signed strings
+        self._prefix_hash = new_sha1()
+        self._prefix_hash.update(self.secret_key+EOL+EOL)
+        self._memo = None
+        if memoize:
+            self._memo = (None, dict())
 
     def sign_with_content_md5(self, method, content_md5, content_type, date, request_path):
         """
@@ -114,16 +167,12 @@ class KWSSigner:
 
         Returns the signature as str (Python 2) or bytes (Python 3).
         """
-        toSign = ascii_to_hashable(self.secret_key)+EOL+EOL
-        toSign += ascii_to_hashable(method)+EOL
-        toSign += ascii_to_hashable(content_md5)+EOL
-        if content_type is not None:
-            toSign += ascii_to_hashable(content_type)+EOL
-        else:
-            toSign += EOL
-        toSign += ascii_to_hashable(date)+EOL
-        toSign += ascii_to_hashable(request_path)
-        return compute_sha1_base64(toSign)
+        if content_type is None:
+            content_type = ""
+        h = self._prefix_hash.copy()
+        h.update(EOL.join([ascii_to_hashable(method), ascii_to_hashable(content_md5),
+            ascii_to_hashable(content_type), ascii_to_hashable(date), ascii_to_hashable(request_path)]))
+        return base64.b64encode(h.digest())
 
     def sign_with_content(self, method, content, content_type, date, request_path):
         """
@@ -139,13 +188,66 @@ class KWSSigner:
         content_md5 = compute_md5_hex(to_hashable(content))
         return self.sign_with_content_md5(method, content_md5, content_type, date, request_path)
 
+    def sign_with_content_stream(self, method, content, content_type, date, request_path):
+        """
+        Sign request using request content read incrementally.
+
+        The content argument is a file-like object (read from its current
+        position until the end, the caller has to rewind it before sending
+        the content) or an iterable of buffers (e.g. a list of bytes). See
+        sign_with_content_md5 for the description of the remaining
+        arguments.
+
+        Returns the signature as str (Python 2) or bytes (Python 3).
+        """
+        content_md5 = compute_md5_hex_stream(content)
+        return self.sign_with_content_md5(method, content_md5, content_type, date, request_path)
+
     def sign_with_no_content(self, method, content_type, date, request_path):
         """
         Sign request that uses no body (e.g. empty GET).
 
         Returns the signature as str (Python 2) or bytes (Python 3).
         """
-        return self.sign_with_content_md5(method, "", content_type, date, request_path)
+        memo = self._memo
+        if memo is None:
+            return self.sign_with_content_md5(method, "", content_type, date, request_path)
+        (memo_date, signatures) = memo
+        if memo_date != date:
+            # keep only the signatures with the current date
+            signatures = dict()
+            self._memo = (date, signatures)
+        key = (method, content_type, request_path)
+        signature = signatures.get(key)
+        if signature is None:
+            signature = self.sign_with_content_md5(method, "", content_type, date, request_path)
+            signatures[key] = signature
+        return signature
+
+    def sign_many(self, requests):
+        """
+        Sign multiple requests at once.
+
+        The requests argument is a sequence of tuples (method, content_md5,
+        content_type, date, request_path), see sign_with_content_md5 for
+        their meaning (content_md5 is "" for requests without content).
+
+        Returns list of the signatures in the order of the requests.
+        """
+        # local names save attribute lookups in the loop
+        copy_prefix_hash = self._prefix_hash.copy
+        join = EOL.join
+        to_hashable = ascii_to_hashable
+        b64encode = base64.b64encode
+        signatures = list()
+        for (method, content_md5, content_type, date, request_path) in requests:
+            if content_type is None:
+                content_type = ""
+            h = copy_prefix_hash()
+            h.update(join([to_hashable(method), to_hashable(content_md5),
+                to_hashable(content_type), to_hashable(date), to_hashable(request_path)]))
+            signatures.append(b64encode(h.digest()))
+        return signatures
 
 
 # vim: ai:si:et:sw=4:ts=4:
@@ -0,0 +1,542 @@
+"""
+Asynchronous (asyncio) client for kooaba Data Upload API.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from KWS import CHUNK_SIZE, KWSSigner, compute_md5_hex_stream
+from request_xml import image_xml, item_xml, medium_xml, resource_file_xml, resource_uri_xml, status_xml
+from retry import IDEMPOTENT_METHODS
+from urllib.parse import urlparse
+import asyncio
+import email.utils
+import mimetypes
+import time
+import xml.etree.ElementTree as ET
+
+VERSION = '1.1.0'
+
+
+# Configuration defaults
+QUERY_ENDPOINT = 'http://my.kooaba.com'
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+__all__ = ['AsyncDataUploadClient', 'AsyncConnectionPool']
+
+
+class _Connection:
+    """ Open stream pair to a server. """
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.released_at = None
+
+    def close(self):
+        self.writer.close()
+
+    def is_dropped(self):
+        """ Return True if the server closed the idle connection. """
+        return self.reader.at_eof() or self.writer.is_closing()
+
+
+class AsyncConnectionPool:
+    """ Pool of persistent HTTP/1.1 connections for asyncio clients.
+
+    At most max_connections connections per (scheme, host, port) key are
+    open at the same time, further requests wait for a free connection.
+    Idle connections are reused unless they were idle for more than
+    max_idle_time seconds. Connecting, sending a request and receiving its
+    response each have to finish within timeout seconds (None means no
+    limit). The pool must be used from a single event loop.
+    """
+
+    def __init__(self, max_connections = 32, max_idle_time = 30.0, timeout = 60.0):
+        self.max_connections = max_connections
+        self.max_idle_time = max_idle_time
+        self.timeout = timeout
+        self._idle = dict()
+        self._slots = dict()
+        self._stats = {'hits': 0, 'new_connections': 0, 'evictions': 0, 'reconnects': 0}
+
+    async def acquire(self, scheme, host, port = None):
+        """ Take a connection to given server out of the pool.
+        Waits while max_connections connections to the server are in use.
+        Returns tuple (connection, reused).
+        Raises exception:
+            - RuntimeError: Unsupported transport scheme.
+            - OSError: Failure connecting to the server.
+            - asyncio.TimeoutError: Connecting took longer than the timeout.
+        """
+        if scheme not in DEFAULT_PORTS:
+            raise RuntimeError("URL scheme '%s' not supported" % scheme)
+        if port is None:
+            port = DEFAULT_PORTS[scheme]
+        key = (scheme, host, port)
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots[key] = asyncio.Semaphore(self.max_connections)
+        await slots.acquire()
+        try:
+            now = time.monotonic()
+            idle = self._idle.get(key, [])
+            while idle:
+                connection = idle.pop()
+                if (now - connection.released_at > self.max_idle_time) or connection.is_dropped():
+                    self._stats['evictions'] += 1
+                    connection.close()
+                else:
+                    self._stats['hits'] += 1
+                    return (connection, True)
+            self._stats['new_connections'] += 1
+            return (await self._connect(key), False)
+        except BaseException:
+            slots.release()
+            raise
+
+    async def reconnect(self, connection):
+        """ Replace a connection found stale by a new one to the same server. """
+        connection.close()
+        self._stats['reconnects'] += 1
+        self._stats['new_connections'] += 1
+        return await self._connect(connection.key)
+
+    def discard(self, connection):
+        """ Close connection instead of returning it to the pool. """
+        connection.close()
+        self._slots[connection.key].release()
+
+    def release(self, connection):
+        """ Return connection with completely read response to the pool. """
+        connection.released_at = time.monotonic()
+        self._idle.setdefault(connection.key, []).append(connection)
+        self._slots[connection.key].release()
+
+    def close(self):
+        """ Close all idle connections. """
+        for idle in self._idle.values():
+            for connection in idle:
+                connection.close()
+        self._idle = dict()
+
+    def stats(self):
+        """ Return pool statistics as dictionary (see HTTPConnectionPool.stats()). """
+        stats = dict(self._stats)
+        stats['idle'] = sum([len(idle) for idle in self._idle.values()])
+        return stats
+
+    async def _connect(self, key):
+        (scheme, host, port) = key
+        (reader, writer) = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=(scheme == 'https')), self.timeout)
+        return _Connection(key, reader, writer)
+
+
+class _Response:
+    """ Status line and headers of a HTTP response. """
+
+    def __init__(self, status, reason, headers):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    def getheader(self, name, default = None):
+        return self.headers.get(name.lower(), default)
+
+
+class AsyncDataUploadClient:
+    """ Asynchronous client for kooaba Data Upload API.
+
+    The methods correspond to the methods of BasicDataUploadClient but are
+    coroutines. The requests are sent over connections from a shared
+    AsyncConnectionPool, so many requests can be in flight concurrently
+    without a thread per request. The descriptions returned by the get_*
+    methods are XML documents as bytes.
+    """
+
+    def __init__(self, access_key, secret_key, endpoint = None, connection_pool = None):
+        """ Initialize client for given query endpoint.
+        None as endpoint means default endpoint. None as connection_pool
+        means a new pool used only by this client.
+        """
+        self.access_key = access_key
+        self.kws = KWSSigner(secret_key, memoize=True)
+        api_path = '/api'
+        if endpoint is not None:
+            self.api_url = endpoint+api_path
+        else:
+            self.api_url = QUERY_ENDPOINT+api_path
+        if connection_pool is None:
+            connection_pool = AsyncConnectionPool()
+        self.connection_pool = connection_pool
+        self.debugging = False
+
+    async def activate_image(self, image_id):
+        """ Activate the image.
+        Returns current status of the image.
+        """
+        return await self._set_image_status(image_id, 'ACTIVE')
+
+    async def add_resource_file(self, item_id, title, section, filename):
+        """ Add a file resource to an item.
+        Raises exception on error.
+        """
+        upload_id = await self.upload_from_file(filename)
+        await self._post_data("/items/%s/item_resources.xml" % item_id, resource_file_xml(title, section, upload_id), 'application/xml')
+
+    async def add_resource_uri(self, item_id, title, section, uri):
+        """ Add a URI resource to an item.
+        Raises exception on error.
+        """
+        await self._post_data("/items/%s/item_resources.xml" % item_id, resource_uri_xml(title, section, uri), 'application/xml')
+
+    async def change_item_medium_type(self, item_id, medium_type, title, metadata):
+        """ Change the medium type of the item and upload new metadata.
+        See BasicDataUploadClient.change_item_medium_type().
+        """
+        await self._put_data("/items/%s/medium.xml" % item_id, medium_xml(medium_type, title, metadata), 'application/xml')
+
+    def close(self):
+        """ Close idle connections to the API server. """
+        self.connection_pool.close()
+
+    async def create_image_from_upload(self, item_id, upload_id):
+        """ Associate uploaded image with an item.
+        Returns image ID.
+        """
+        (_response, body) = await self._post_data("/items/%s/images.xml" % item_id, image_xml(upload_id), 'application/xml')
+        return self._id_from_xml_string(body)
+
+    async def create_item(self, group_id, title, extras = dict()):
+        """ Create a new item with title in the group with group_id.
+        See BasicDataUploadClient.create_item().
+        Returns ID of the created item.
+        """
+        (_response, body) = await self._post_data("/groups/%s/items.xml" % group_id, item_xml(extras, title), 'application/xml')
+        return self._id_from_xml_string(body)
+
+    async def deactivate_image(self, image_id):
+        """ Deactivate the image.
+        Returns current status of the image.
+        """
+        return await self._set_image_status(image_id, 'INACTIVE')
+
+    async def delete_image(self, image_id):
+        """ Delete the image.
+        Raises exception on error.
+        """
+        await self._send_request('DELETE', "/images/%s.xml" % image_id)
+
+    async def delete_item(self, item_id):
+        """ Delete the item.
+        Raises exception on error.
+        """
+        await self._send_request('DELETE', "/items/%s.xml" % item_id)
+
+    def get_connection_stats(self):
+        """ Return statistics of the connection pool. """
+        return self.connection_pool.stats()
+
+    async def get_group(self, group_id):
+        """ Return description of the group. """
+        (_response, body) = await self._send_request('GET', "/groups/%s.xml" % group_id)
+        return body
+
+    async def get_group_items(self, group_id):
+        """ Return items from the group. """
+        (_response, body) = await self._send_request('GET', "/groups/%s/items.xml" % group_id)
+        return body
+
+    async def get_image(self, image_id):
+        """ Return description of the image. """
+        (_response, body) = await self._send_request('GET', "/images/%s.xml" % image_id)
+        return body
+
+    async def get_image_status(self, image_id):
+        """ Return current image status. """
+        (_response, body) = await self._send_request('GET', "/images/%s.xml" % image_id)
+        return self._element_from_xml(ET.fromstring(body), "status")
+
+    async def get_item(self, item_id):
+        """ Return description of the item. """
+        (_response, body) = await self._send_request('GET', "/items/%s.xml" % item_id)
+        return body
+
+    async def get_item_resources(self, item_id):
+        """ Return resources of the item. """
+        (_response, body) = await self._send_request('GET', "/items/%s/item_resources.xml" % item_id)
+        return body
+
+    def set_debug(self, flag):
+        """ Enable/disable debugging printouts according to the flag. """
+        self.debugging = flag
+
+    async def update_item(self, item_id, extras = dict()):
+        """ Update the item according to metadata in extras.
+        See BasicDataUploadClient.update_item().
+        """
+        await self._put_data("/items/%s.xml" % item_id, item_xml(extras), 'application/xml')
+
+    async def upload_data(self, data, content_type):
+        """ Upload data (bytes) from memory.
+        Returns upload ID.
+        """
+        (_response, body) = await self._post_data('/uploads.xml', data, content_type)
+        return self._id_from_xml_string(body)
+
+    async def upload_from_file(self, filename, content_type = None):
+        """ Upload a file.
+        The file is streamed, it is hashed and sent in chunks read in the
+        default executor of the event loop and never held in memory as a
+        whole.
+        Returns upload ID.
+        """
+        if content_type is None:
+            (content_type, _encoding) = mimetypes.guess_type(filename)
+        data = await asyncio.get_running_loop().run_in_executor(None, _hash_file, filename)
+        (_response, body) = await self._post_data('/uploads.xml', data, content_type)
+        return self._id_from_xml_string(body)
+
+    def _element_from_xml(self, xml, name):
+        """ Extract element name from supplied XML element.
+        Returns the element text content as string.
+        Raises KeyError if there is no such element.
+        """
+        elem = xml.find(name)
+        if elem is None:
+            raise KeyError("No '"+name+"' element in the supplied XML: "+ET.tostring(xml, encoding='unicode'))
+        return elem.text
+
+    def _id_from_xml_string(self, xml_string):
+        """ Extract id element from supplied XML string.
+        Returns the ID as string.
+        Raises KeyError if there is no ID element.
+        """
+        return self._element_from_xml(ET.fromstring(xml_string), "id")
+
+    async def _post_data(self, api_path, data, content_type):
+        """ Post data to an API node specified by api_path. """
+        return await self._send_request('POST', api_path, data, content_type)
+
+    async def _put_data(self, api_path, data, content_type):
+        """ Put data to an API node specified by api_path. """
+        return await self._send_request('PUT', api_path, data, content_type)
+
+    async def _send_request(self, method, api_path, data=None, content_type=None):
+        """ Send (POST/PUT/GET/DELETE according to the method) data to an API
+        node specified by api_path.
+
+        Returns tuple (response, body). The response describes the status
+        line and headers, the body is bytes.
+
+        A request failing on a reused connection closed by the server is
+        sent once more over a new connection if it was not sent yet or if it
+        is idempotent.
+
+        Raises exception on error:
+            - IOError: Failure performing HTTP call (including a timeout, see
+               AsyncConnectionPool)
+            - RuntimeError: Unsupported transport scheme.
+            - RuntimeError: API call returned an error.
+        """
+        if self.debugging:
+            if data is None:
+                print("%s ...%s" % (method, api_path))
+            elif isinstance(data, _FileBody):
+                print("%s ...%s: %sB" % (method, api_path, data.size))
+            elif len(data) < 4096:
+                print("%s ...%s:\n%s" % (method, api_path, data))
+            else:
+                print("%s ...%s: %sB" % (method, api_path, len(data)))
+        if '://' not in self.api_url:
+            # endpoint as a host or host:port
+            parsed_url = urlparse('http://'+self.api_url+api_path)
+        else:
+            parsed_url = urlparse(self.api_url+api_path)
+        if isinstance(data, str):
+            data = data.encode('UTF-8')
+        date = email.utils.formatdate(None, localtime=False, usegmt=True)
+        if isinstance(data, _FileBody):
+            signature = self.kws.sign_with_content_md5(method, data.content_md5, content_type, date, parsed_url.path)
+        elif data is not None:
+            signature = self.kws.sign_with_content(method, data, content_type, date, parsed_url.path)
+        else:
+            signature = self.kws.sign_with_no_content(method, content_type, date, parsed_url.path)
+        head = ["%s %s HTTP/1.1" % (method, parsed_url.path),
+                "Host: %s" % parsed_url.netloc,
+                "Authorization: KWS %s:%s" % (self.access_key, signature.decode('ascii')),
+                "Date: %s" % date]
+        if content_type is not None:
+            head.append("Content-Type: %s" % content_type)
+        if isinstance(data, _FileBody):
+            head.append("Content-Length: %d" % data.size)
+        elif data is not None:
+            head.append("Content-Length: %d" % len(data))
+        request = ("\r\n".join(head)+"\r\n\r\n").encode('latin-1')
+        timeout = self.connection_pool.timeout
+        try:
+            (connection, reused) = await self.connection_pool.acquire(parsed_url.scheme, parsed_url.hostname, parsed_url.port)
+        except asyncio.TimeoutError:
+            raise IOError("Connecting to %s timed out after %s seconds" % (parsed_url.netloc, timeout))
+        try:
+            try:
+                sent = False
+                try:
+                    await asyncio.wait_for(self._write_request(connection, request, data), timeout)
+                    sent = True
+                    (response, body, keep_alive) = await asyncio.wait_for(self._read_response(connection, method), timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # the server closed the kept-alive connection in the
+                    # meantime; a request which was sent may have been
+                    # processed already, so only an idempotent one is resent
+                    if (not reused) or (sent and method not in IDEMPOTENT_METHODS):
+                        raise
+                    connection = await self.connection_pool.reconnect(connection)
+                    await asyncio.wait_for(self._write_request(connection, request, data), timeout)
+                    (response, body, keep_alive) = await asyncio.wait_for(self._read_response(connection, method), timeout)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                raise IOError("Error during request: %s: %s" % (type(e), e))
+            except asyncio.TimeoutError:
+                raise IOError("Request %s ...%s timed out after %s seconds" % (method, api_path, timeout))
+        except BaseException:
+            self.connection_pool.discard(connection)
+            raise
+        if keep_alive:
+            self.connection_pool.release(connection)
+        else:
+            self.connection_pool.discard(connection)
+        if self.debugging:
+            print("HTTP response status:", response.status, response.reason)
+            print("Body:")
+            print(body.decode('UTF-8', 'replace'))
+        if (response.status < 200) or (response.status > 299):
+            raise RuntimeError("API call returned status %s %s. Message: %s" % (response.status, response.reason, body.decode('UTF-8', 'replace')))
+        return (response, body)
+
+    async def _read_response(self, connection, method):
+        """ Read the complete response to the request sent by method.
+        Returns tuple (response, body, keep_alive).
+        """
+        status_line = await connection.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the server")
+        parts = status_line.decode('latin-1').rstrip("\r\n").split(" ", 2)
+        try:
+            version = parts[0]
+            status = int(parts[1])
+        except (IndexError, ValueError):
+            raise IOError("Invalid HTTP status line: %r" % status_line)
+        reason = ""
+        if len(parts) > 2:
+            reason = parts[2]
+        headers = dict()
+        while True:
+            line = await connection.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            (name, _sep, value) = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        response = _Response(status, reason, headers)
+        keep_alive = (version == "HTTP/1.1") and (headers.get('connection', '').lower() != 'close')
+        if (method == 'HEAD') or (status in (204, 304)) or (100 <= status < 200):
+            body = b""
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = await self._read_chunked(connection.reader)
+        elif 'content-length' in headers:
+            body = await connection.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await connection.reader.read()
+            keep_alive = False
+        return (response, body, keep_alive)
+
+    async def _read_chunked(self, reader):
+        """ Read body sent with chunked transfer encoding. """
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # skip trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    async def _set_image_status(self, image_id, new_status):
+        """ Set image status to a new value.
+        Returns image status after change.
+        Raises exception on error.
+        """
+        (_response, body) = await self._put_data('/images/%s/status.xml' % image_id, status_xml(new_status), 'application/xml')
+        response_xml = ET.fromstring(body)
+        status_elem = response_xml.find("status")
+        if status_elem is None:
+            raise KeyError("No status element in the returned XML: "+body.decode('UTF-8', 'replace'))
+        return status_elem.text
+
+    async def _write_request(self, connection, head, data):
+        """ Send the serialized request head followed by the body data
+        (bytes, _FileBody streamed from the file, or None).
+        """
+        connection.writer.write(head)
+        if isinstance(data, _FileBody):
+            loop = asyncio.get_running_loop()
+            with open(data.filename, 'rb') as f:
+                while True:
+                    chunk = await loop.run_in_executor(None, f.read, CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    connection.writer.write(chunk)
+                    await connection.writer.drain()
+        elif data is not None:
+            connection.writer.write(data)
+        await connection.writer.drain()
+
+
+class _FileBody:
+    """ Request body streamed from a file, with its size and MD5 hex digest. """
+
+    def __init__(self, filename, size, content_md5):
+        self.filename = filename
+        self.size = size
+        self.content_md5 = content_md5
+
+
+def _hash_file(filename):
+    """ Hash the file in chunks.
+    Returns _FileBody of the file.
+    """
+    with open(filename, 'rb') as f:
+        content_md5 = compute_md5_hex_stream(f)
+        size = f.tell()
+    return _FileBody(filename, size, content_md5)
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
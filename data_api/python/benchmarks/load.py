@@ -0,0 +1,253 @@
+"""
+Load benchmark of the kooaba Data API clients against a stand-in server.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'query_api', 'python'))
+
+from report import environment, latency_summary, max_rss_kb, write_report
+
+
+MODES = ['serial', 'pooled', 'threaded', 'async']
+
+# scenario name -> number of API requests per operation
+SCENARIOS = {
+    'status': 1,
+    'upload': 1,
+    'create': 4,
+    'query': 1,
+}
+
+GROUP_ID = 1
+
+
+def make_payload(size):
+    """ Return image-like payload of given size in bytes. """
+    header = b'\xff\xd8\xff\xe0'
+    return header + os.urandom(max(size - len(header), 0))
+
+
+def prepare_status_images(client, count):
+    """ Create item with count images for the status scenario.
+    Returns list of the image IDs.
+    """
+    item_id = client.create_item(GROUP_ID, 'Benchmark item')
+    upload_id = client.upload_data(make_payload(1024), 'image/jpeg')
+    image_ids = list()
+    for _i in range(count):
+        image_id = client.create_image_from_upload(item_id, upload_id)
+        client.activate_image(image_id)
+        image_ids.append(image_id)
+    return image_ids
+
+
+def scenario_operation(client, scenario, payload, query_client = None):
+    """ Return (function, setup) for the scenario.
+    The function performs one operation taking the operation index, setup
+    prepares the server state before the measurement. The query scenario
+    sends the queries by the query_client (QueryClient).
+    """
+    state = dict()
+    if scenario == 'status':
+        def setup():
+            state['image_ids'] = prepare_status_images(client, 16)
+
+        def operation(index):
+            image_ids = state['image_ids']
+            return client.get_image_status(image_ids[index % len(image_ids)])
+    elif scenario == 'query':
+        def setup():
+            # make the payload recognizable
+            item_id = client.create_item(GROUP_ID, 'Benchmark item')
+            upload_id = client.upload_data(payload, 'image/jpeg')
+            client.activate_image(client.create_image_from_upload(item_id, upload_id))
+
+        def operation(index):
+            return query_client.recognize(payload, [GROUP_ID])
+    elif scenario == 'upload':
+        def setup():
+            pass
+
+        def operation(index):
+            return client.upload_data(payload, 'image/jpeg')
+    else:
+        def setup():
+            pass
+
+        def operation(index):
+            item_id = client.create_item(GROUP_ID, 'Benchmark item %d' % index,
+                    {'reference_id': 'bench-%d-%d' % (os.getpid(), index)})
+            upload_id = client.upload_data(payload, 'image/jpeg')
+            image_id = client.create_image_from_upload(item_id, upload_id)
+            return client.activate_image(image_id)
+    return (operation, setup)
+
+
+def run_sync(options, endpoint):
+    """ Run the benchmark with BasicDataUploadClient.
+    Returns tuple (latencies, errors, duration, connection statistics).
+    """
+    from connection_pool import HTTPConnectionPool
+    from retry import RetryPolicy
+    from upload_client import BasicDataUploadClient
+    from workers import imap_unordered
+    if options.mode == 'serial':
+        # no connection reuse, every request opens a new connection
+        pool = HTTPConnectionPool(max_idle=0)
+        workers = 1
+    elif options.mode == 'pooled':
+        pool = HTTPConnectionPool()
+        workers = 1
+    else:
+        pool = HTTPConnectionPool(max_idle=options.concurrency)
+        workers = options.concurrency
+    client = BasicDataUploadClient('benchmark', 'benchmark-secret', endpoint, pool)
+    client.set_retry_policy(options.retries > 0 and RetryPolicy(options.retries) or None)
+    query_client = None
+    if options.scenario == 'query':
+        from query_client import QueryClient
+        query_client = QueryClient('benchmark', 'benchmark-secret', endpoint, pool, RetryPolicy(options.retries))
+    (operation, setup) = scenario_operation(client, options.scenario, make_payload(options.payload_size), query_client)
+    setup()
+
+    def timed(index):
+        start = time.time()
+        operation(index)
+        return time.time() - start
+
+    latencies = list()
+    errors = 0
+    start = time.time()
+    for (_index, latency, error) in imap_unordered(timed, range(options.operations), workers):
+        if error is None:
+            latencies.append(latency)
+        else:
+            errors += 1
+    duration = time.time() - start
+    stats = client.get_connection_stats()
+    client.close()
+    return (latencies, errors, duration, stats)
+
+
+def start_server(options):
+    """ Start the stand-in server in a child process.
+    Returns tuple (process, endpoint).
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stand_in_server.py')
+    command = [options.server_python or sys.executable, script,
+            '--latency', str(options.latency), '--error-rate', str(options.error_rate)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    # native string on both Python 2 and 3
+    endpoint = str(process.stdout.readline().decode('ascii').strip())
+    if not endpoint:
+        raise RuntimeError("Stand-in server failed to start")
+    return (process, endpoint)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-m', '--mode', type='choice', choices=MODES, default='pooled',
+            help="client mode: serial (new connection per request), pooled (reused connections), "
+            "threaded (--concurrency threads), async (asyncio, Python 3.8+) [%default]")
+    parser.add_option('-s', '--scenario', type='choice', choices=sorted(SCENARIOS.keys()), default='status',
+            help="operation to benchmark: status (get image status), upload (upload data), "
+            "create (create item, upload, create and activate image), query (recognize an image) [%default]")
+    parser.add_option('-n', '--operations', type='int', default=1000,
+            help="number of operations [%default]")
+    parser.add_option('-c', '--concurrency', type='int', default=16,
+            help="concurrent operations in threaded and async modes [%default]")
+    parser.add_option('--payload-size', type='int', default=64 * 1024,
+            help="size of uploaded images in bytes [%default]")
+    parser.add_option('--retries', type='int', default=0,
+            help="retries of failed requests (sync client only) [%default]")
+    parser.add_option('-E', '--endpoint', type='string', default=None,
+            help="benchmark given server instead of starting the stand-in server")
+    parser.add_option('--server-python', type='string', default=None,
+            help="interpreter running the stand-in server [current interpreter]")
+    parser.add_option('--latency', type='float', default=0.0,
+            help="average response delay of the stand-in server in seconds [%default]")
+    parser.add_option('--error-rate', type='float', default=0.0,
+            help="fraction of requests failing on the stand-in server [%default]")
+    parser.add_option('-o', '--output', type='string', default='-',
+            help="file to write the JSON report to, - for stdout [%default]")
+    (options, _arguments) = parser.parse_args()
+    if options.mode == 'async':
+        if options.scenario == 'query':
+            parser.error("query scenario is not available in async mode")
+        if sys.version_info < (3, 8):
+            parser.error("async mode requires Python 3.8 or newer")
+    elif sys.version_info[0] >= 3:
+        parser.error("%s mode requires Python 2 (upload_client.py)" % options.mode)
+    process = None
+    endpoint = options.endpoint
+    if endpoint is None:
+        (process, endpoint) = start_server(options)
+    try:
+        if options.mode == 'async':
+            from load_async import run_async
+            (latencies, errors, duration, stats) = run_async(options, endpoint)
+        else:
+            (latencies, errors, duration, stats) = run_sync(options, endpoint)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    operations = len(latencies)
+    report = {
+        'suite': 'load',
+        'mode': options.mode,
+        'scenario': options.scenario,
+        'concurrency': (options.mode in ('threaded', 'async')) and options.concurrency or 1,
+        'operations': operations,
+        'errors': errors,
+        'requests_per_operation': SCENARIOS[options.scenario],
+        'duration_s': duration,
+        'throughput_ops': operations / duration,
+        'throughput_requests': operations * SCENARIOS[options.scenario] / duration,
+        'latency': latency_summary(latencies),
+        'max_rss_kb': max_rss_kb(),
+        'connection_stats': stats,
+        'server': {'endpoint': endpoint, 'stand_in': process is not None,
+                'latency_s': options.latency, 'error_rate': options.error_rate},
+        'environment': environment(),
+    }
+    write_report(report, options.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
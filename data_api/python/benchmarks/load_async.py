@@ -0,0 +1,100 @@
+"""
+Asyncio part of the load benchmark (Python 3.8 and newer).
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import asyncio
+import os
+import time
+
+from async_upload_client import AsyncConnectionPool, AsyncDataUploadClient
+from load import GROUP_ID, make_payload
+
+
+async def prepare_status_images(client, count):
+    """ Create item with count images for the status scenario.
+    Returns list of the image IDs.
+    """
+    item_id = await client.create_item(GROUP_ID, 'Benchmark item')
+    upload_id = await client.upload_data(make_payload(1024), 'image/jpeg')
+    image_ids = list()
+    for _i in range(count):
+        image_id = await client.create_image_from_upload(item_id, upload_id)
+        await client.activate_image(image_id)
+        image_ids.append(image_id)
+    return image_ids
+
+
+async def run_operations(options, endpoint):
+    pool = AsyncConnectionPool(max_connections=options.concurrency)
+    client = AsyncDataUploadClient('benchmark', 'benchmark-secret', endpoint, pool)
+    payload = make_payload(options.payload_size)
+    image_ids = list()
+    if options.scenario == 'status':
+        image_ids = await prepare_status_images(client, 16)
+
+    async def operation(index):
+        if options.scenario == 'status':
+            return await client.get_image_status(image_ids[index % len(image_ids)])
+        if options.scenario == 'upload':
+            return await client.upload_data(payload, 'image/jpeg')
+        item_id = await client.create_item(GROUP_ID, 'Benchmark item %d' % index,
+                {'reference_id': 'bench-%d-%d' % (os.getpid(), index)})
+        upload_id = await client.upload_data(payload, 'image/jpeg')
+        image_id = await client.create_image_from_upload(item_id, upload_id)
+        return await client.activate_image(image_id)
+
+    latencies = list()
+    errors = [0]
+    indexes = iter(range(options.operations))
+
+    async def worker():
+        for index in indexes:
+            start = time.time()
+            try:
+                await operation(index)
+            except Exception:
+                errors[0] += 1
+            else:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    await asyncio.gather(*[worker() for _i in range(options.concurrency)])
+    duration = time.time() - start
+    stats = client.get_connection_stats()
+    client.close()
+    return (latencies, errors[0], duration, stats)
+
+
+def run_async(options, endpoint):
+    """ Run the benchmark with AsyncDataUploadClient.
+    Returns tuple (latencies, errors, duration, connection statistics).
+    """
+    return asyncio.run(run_operations(options, endpoint))
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,142 @@
+"""
+Micro-benchmarks of request signing and XML handling of the kooaba clients.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import optparse
+import os
+import sys
+import timeit
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from KWS import KWSSigner
+from report import environment, max_rss_kb, write_report
+import request_xml
+# the way the clients built the request documents before request_xml
+from test_request_xml import etree_item_xml, etree_status_xml
+
+if sys.version_info[0] < 3:
+    from upload_client import BasicDataUploadClient as Client, VERSION
+else:
+    # upload_client.py is Python 2 code, the asyncio client shares its XML helpers
+    from async_upload_client import AsyncDataUploadClient as Client, VERSION
+
+
+DATE = 'Mon, 04 Jul 2011 12:00:00 GMT'
+PATH = '/api/images/123456/status.xml'
+
+ITEM_XML_RESPONSE = ('<?xml version="1.0" encoding="UTF-8"?>\n<item>\n  <id type="integer">123456</id>\n'
+        '  <title>Benchmark item</title>\n  <images type="array">\n' +
+        ''.join(['    <image><id type="integer">%d</id><status>ACTIVE</status></image>\n' % i for i in range(10)]) +
+        '  </images>\n</item>\n').encode('utf-8')
+
+
+ITEM_EXTRAS = {'reference_id': 'REF-0001', 'external_id': 'EXT-0001', 'locale': 'en'}
+
+def benchmarks(client, signer, memo_signer):
+    """ Return list of (name, function) of the benchmarked operations. """
+    small_body = b'x' * 1024
+    large_body = b'x' * (1024 * 1024)
+    content_md5 = 'd41d8cd98f00b204e9800998ecf8427e'
+    batch = [('GET', '', None, DATE, '/api/images/%d.xml' % i) for i in range(100)]
+    return [
+        ('sign_with_no_content', lambda: signer.sign_with_no_content('GET', '', DATE, PATH)),
+        ('sign_with_no_content_memo', lambda: memo_signer.sign_with_no_content('GET', '', DATE, PATH)),
+        ('sign_many_100', lambda: signer.sign_many(batch)),
+        ('sign_with_content_md5', lambda: signer.sign_with_content_md5('PUT', content_md5, 'application/xml', DATE, PATH)),
+        ('sign_with_content_1k', lambda: signer.sign_with_content('PUT', small_body, 'application/xml', DATE, PATH)),
+        ('sign_with_content_1m', lambda: signer.sign_with_content('POST', large_body, 'image/jpeg', DATE, '/api/uploads.xml')),
+        ('sign_with_content_stream_1m', lambda: signer.sign_with_content_stream('POST', BytesIO(large_body), 'image/jpeg', DATE, '/api/uploads.xml')),
+        ('item_xml_etree', lambda: etree_item_xml(ITEM_EXTRAS, 'Benchmark item')),
+        ('item_xml', lambda: request_xml.item_xml(ITEM_EXTRAS, 'Benchmark item')),
+        ('status_xml_etree', lambda: etree_status_xml('ACTIVE')),
+        ('status_xml', lambda: request_xml.status_xml('ACTIVE')),
+        ('id_from_xml_string', lambda: client._id_from_xml_string(ITEM_XML_RESPONSE)),
+    ]
+
+
+def measure(function, seconds, repeat):
+    """ Time function.
+    Returns tuple (seconds per call, number of calls per timing run), the
+    time per call is the best of repeat runs.
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    # calibrate the number of calls to take about seconds per run
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= seconds / 5.0 or number >= 10 ** 7:
+            break
+        number *= 10
+    number = max(1, int(number * seconds / max(elapsed, 1e-9)))
+    best = min(timer.repeat(repeat, number))
+    return (best / number, number)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark_name ...]")
+    parser.add_option('-o', '--output', type='string', default='-',
+            help="file to write the JSON report to, - for stdout [%default]")
+    parser.add_option('--seconds', type='float', default=0.2,
+            help="approximate duration of one timing run [%default]")
+    parser.add_option('--repeat', type='int', default=5,
+            help="number of timing runs, the best one is reported [%default]")
+    (options, arguments) = parser.parse_args()
+    client = Client('benchmark', 'benchmark-secret', 'http://127.0.0.1:1')
+    signer = KWSSigner('benchmark-secret')
+    memo_signer = KWSSigner('benchmark-secret', memoize=True)
+    results = list()
+    for (name, function) in benchmarks(client, signer, memo_signer):
+        if arguments and name not in arguments:
+            continue
+        (per_call, number) = measure(function, options.seconds, options.repeat)
+        results.append({
+            'name': name,
+            'usec_per_call': per_call * 1e6,
+            'calls_per_second': 1.0 / per_call,
+            'calls_per_run': number,
+        })
+        sys.stderr.write("%-32s %12.2f usec\n" % (name, per_call * 1e6))
+    report = {
+        'suite': 'micro',
+        'client': Client.__name__,
+        'client_version': VERSION,
+        'environment': environment(),
+        'max_rss_kb': max_rss_kb(),
+        'results': results,
+    }
+    write_report(report, options.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,108 @@
+"""
+Result reporting shared by the kooaba client benchmarks.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import json
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+__all__ = ['environment', 'latency_summary', 'max_rss_kb', 'percentile', 'write_report']
+
+# Version of the report format, increased on incompatible changes
+REPORT_FORMAT = 1
+
+
+def environment():
+    """ Return dictionary describing the environment the benchmark runs in. """
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def latency_summary(latencies):
+    """ Return dictionary with statistics of latencies (in seconds).
+    The values in the result are in milliseconds.
+    """
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'count': 0}
+    return {
+        'count': len(latencies),
+        'mean_ms': 1000.0 * sum(latencies) / len(latencies),
+        'min_ms': 1000.0 * latencies[0],
+        'p50_ms': 1000.0 * percentile(latencies, 50),
+        'p95_ms': 1000.0 * percentile(latencies, 95),
+        'p99_ms': 1000.0 * percentile(latencies, 99),
+        'max_ms': 1000.0 * latencies[-1],
+    }
+
+
+def max_rss_kb():
+    """ Return peak resident set size of the process in kilobytes, None if unknown. """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes on Mac OS X
+        rss = rss // 1024
+    return rss
+
+
+def percentile(sorted_values, percent):
+    """ Return percentile of sorted values (nearest rank method). """
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def write_report(report, filename = None):
+    """ Write report (dictionary) as JSON to the file, stdout if filename is None or '-'. """
+    report = dict(report)
+    report['format'] = REPORT_FORMAT
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if filename is None or filename == '-':
+        sys.stdout.write(text + '\n')
+    else:
+        output = open(filename, 'w')
+        try:
+            output.write(text + '\n')
+        finally:
+            output.close()
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
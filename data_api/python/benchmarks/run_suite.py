@@ -0,0 +1,96 @@
+"""
+Runs all the kooaba client benchmarks and collects one JSON report.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+
+from report import environment, write_report
+
+
+def run_benchmark(python, script, arguments):
+    """ Run benchmark script with given interpreter.
+    Returns the parsed JSON report of the script.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    output = subprocess.check_output([python, path, '--output', '-'] + arguments)
+    return json.loads(output.decode('utf-8'))
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--python2', type='string', default='python2',
+            help="Python 2 interpreter running upload_client.py [%default]")
+    parser.add_option('--python3', type='string', default='python3',
+            help="Python 3.8+ interpreter running async_upload_client.py, empty to skip async mode [%default]")
+    parser.add_option('-n', '--operations', type='int', default=1000,
+            help="number of operations of each load benchmark [%default]")
+    parser.add_option('-c', '--concurrency', type='int', default=16,
+            help="concurrent operations in threaded and async modes [%default]")
+    parser.add_option('--latency', type='float', default=0.0,
+            help="average response delay of the stand-in server in seconds [%default]")
+    parser.add_option('--error-rate', type='float', default=0.0,
+            help="fraction of requests failing on the stand-in server [%default]")
+    parser.add_option('-o', '--output', type='string', default='-',
+            help="file to write the JSON report to, - for stdout [%default]")
+    (options, _arguments) = parser.parse_args()
+    load_arguments = ['--operations', str(options.operations), '--concurrency', str(options.concurrency),
+            '--latency', str(options.latency), '--error-rate', str(options.error_rate),
+            '--server-python', options.python2]
+    micro = [run_benchmark(options.python2, 'micro.py', [])]
+    if options.python3:
+        micro.append(run_benchmark(options.python3, 'micro.py', []))
+    load = list()
+    for scenario in ['status', 'upload', 'create', 'query']:
+        for mode in ['serial', 'pooled', 'threaded', 'async']:
+            if mode == 'async':
+                if (not options.python3) or (scenario == 'query'):
+                    continue
+                python = options.python3
+            else:
+                python = options.python2
+            sys.stderr.write("load: %s %s\n" % (scenario, mode))
+            load.append(run_benchmark(python, 'load.py', load_arguments + ['--mode', mode, '--scenario', scenario]))
+    report = {
+        'suite': 'all',
+        'environment': environment(),
+        'micro': micro,
+        'load': load,
+    }
+    write_report(report, options.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,391 @@
+"""
+Stand-in kooaba Data API server for benchmarking the clients.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import hashlib
+import itertools
+import optparse
+import random
+import re
+import sys
+import threading
+import time
+
+# Python 2 vs 3
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+
+
+__all__ = ['StandInServer', 'start_server']
+
+
+class _Store:
+    """ In-memory groups, items, images and uploads of the stand-in server. """
+
+    def __init__(self):
+        self.items = dict()
+        self.images = dict()
+        self.uploads = dict()
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1000)
+
+    def new_id(self):
+        with self.lock:
+            return next(self._ids)
+
+
+def _field(data, name):
+    """ Return text of the first element with given name in an XML body. """
+    match = re.search(r'<%s>([^<]*)</%s>' % (name, name), data)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Request handler mimicking the XML endpoints of the Data API (under
+    /api) and of the Query API.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # send each response in one segment, small writes of a keep-alive
+    # connection would be delayed by Nagle's algorithm
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    # (method, path pattern, handler method name)
+    routes = [
+        ('POST', r'/uploads\.xml', '_create_upload'),
+        ('GET', r'/groups/(\d+)\.xml', '_get_group'),
+        ('GET', r'/groups/(\d+)/items\.xml', '_get_group_items'),
+        ('POST', r'/groups/(\d+)/items\.xml', '_create_item'),
+        ('GET', r'/items/(\d+)\.xml', '_get_item'),
+        ('PUT', r'/items/(\d+)\.xml', '_update_item'),
+        ('DELETE', r'/items/(\d+)\.xml', '_delete_item'),
+        ('PUT', r'/items/(\d+)/medium\.xml', '_update_item'),
+        ('POST', r'/items/(\d+)/images\.xml', '_create_image'),
+        ('GET', r'/items/(\d+)/item_resources\.xml', '_get_resources'),
+        ('POST', r'/items/(\d+)/item_resources\.xml', '_create_resource'),
+        ('GET', r'/images/(\d+)\.xml', '_get_image'),
+        ('DELETE', r'/images/(\d+)\.xml', '_delete_image'),
+        ('PUT', r'/images/(\d+)/status\.xml', '_set_image_status'),
+    ]
+
+    # Query API routes
+    query_routes = [
+        ('GET', r'/groups\.xml', '_get_query_groups'),
+        ('POST', r'/queries\.xml', '_create_query'),
+    ]
+
+    def do_DELETE(self):
+        self._dispatch()
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def do_PUT(self):
+        self._dispatch()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _create_image(self, data, item_id):
+        item = self._item(item_id)
+        if item is None:
+            return (404, '<errors><error>Item not found</error></errors>')
+        upload_id = _field(data, 'upload-id')
+        image_id = self.server.store.new_id()
+        self.server.store.images[image_id] = {'item_id': int(item_id), 'status': 'INACTIVE',
+                'sha1': self.server.store.uploads.get(int(upload_id or 0), '')}
+        item['images'].append(image_id)
+        return (201, '<?xml version="1.0" encoding="UTF-8"?>\n<image>\n  <id type="integer">%d</id>\n</image>\n' % image_id)
+
+    def _create_item(self, data, group_id):
+        item_id = self.server.store.new_id()
+        self.server.store.items[item_id] = {'group_id': int(group_id), 'title': _field(data, 'title') or '',
+                'reference_id': _field(data, 'reference-id') or _field(data, 'reference_id'),
+                'external_id': _field(data, 'external-id') or _field(data, 'external_id'),
+                'images': [], 'resources': []}
+        return (201, '<?xml version="1.0" encoding="UTF-8"?>\n<item>\n  <id type="integer">%d</id>\n</item>\n' % item_id)
+
+    def _create_query(self, data):
+        # recognizes active images with exactly the same content
+        match = re.search(r'boundary=(\S+)', self.headers.get('Content-Type') or '')
+        if match is None:
+            return (400, '<errors><error>Not a multipart request</error></errors>')
+        boundary = match.group(1)
+        if not data.endswith('\r\n--%s--\r\n' % boundary):
+            return (400, '<errors><error>Malformed multipart body</error></errors>')
+        group_ids = [int(group_id) for group_id in re.findall(r'name="query\[group_ids\]\[\]"\r\n\r\n(\d+)\r\n', data)]
+        file_start = data.find('name="query[file]"')
+        if (file_start < 0) or (len(group_ids) == 0):
+            return (422, '<errors><error>Query requires an image and a group</error></errors>')
+        content_start = data.index('\r\n\r\n', file_start) + 4
+        content = data[content_start:-len('\r\n--%s--\r\n' % boundary)]
+        sha1 = hashlib.sha1(content.encode('latin-1')).hexdigest()
+        store = self.server.store
+        matched = list()
+        for image in list(store.images.values()):
+            item = store.items.get(image['item_id'])
+            if (image['sha1'] == sha1) and (image['status'] != 'INACTIVE') and (item is not None) and (item['group_id'] in group_ids):
+                if item not in matched:
+                    matched.append(item)
+        multiple = 'name="query[multiple_items]"' in data
+        items = list()
+        for item in matched:
+            reference = ''
+            if item['reference_id'] is not None:
+                reference = '<reference-id>%s</reference-id>' % item['reference_id']
+            matches = ''
+            if multiple:
+                matches = ' matches="%d"' % (999 - len(items))
+            items.append('<item medium-type="Book"%s><title>%s</title>%s</item>\n' % (matches, item['title'], reference))
+        if multiple:
+            result = '  <items type="array">\n%s  </items>\n' % ''.join(['    ' + item for item in items])
+        elif items:
+            result = '  ' + items[0]
+        else:
+            result = '  <item nil="true"/>\n'
+        return (201, '<?xml version="1.0" encoding="UTF-8"?>\n<query>\n  <uuid>%032x</uuid>\n%s  <response nil="true"/>\n</query>\n'
+                % (store.new_id(), result))
+
+    def _create_resource(self, data, item_id):
+        item = self._item(item_id)
+        if item is None:
+            return (404, '<errors><error>Item not found</error></errors>')
+        item['resources'].append((_field(data, 'title') or '', _field(data, 'section') or ''))
+        return (201, '<item-resource><id type="integer">%d</id></item-resource>' % self.server.store.new_id())
+
+    def _create_upload(self, data):
+        upload_id = self.server.store.new_id()
+        self.server.store.uploads[upload_id] = hashlib.sha1(data.encode('latin-1')).hexdigest()
+        return (201, '<?xml version="1.0" encoding="UTF-8"?>\n<upload>\n  <id type="integer">%d</id>\n</upload>\n' % upload_id)
+
+    def _delete_image(self, data, image_id):
+        if self.server.store.images.pop(int(image_id), None) is None:
+            return (404, '<errors><error>Image not found</error></errors>')
+        return (200, '')
+
+    def _delete_item(self, data, item_id):
+        if self.server.store.items.pop(int(item_id), None) is None:
+            return (404, '<errors><error>Item not found</error></errors>')
+        return (200, '')
+
+    def _dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        # latin-1 maps bytes to characters one to one
+        data = self.rfile.read(length).decode('latin-1')
+        server = self.server
+        if server.latency > 0:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        (status, body) = (404, '<errors><error>Not found</error></errors>')
+        (path, _separator, query) = self.path.partition('?')
+        self.query = parse_qs(query)
+        (routes, route_path) = (self.query_routes, path)
+        if path.startswith('/api/'):
+            (routes, route_path) = (self.routes, path[4:])
+        if (server.error_rate > 0) and (random.random() < server.error_rate):
+            (status, body) = (server.error_status, '<errors><error>Injected error</error></errors>')
+        else:
+            for (method, pattern, name) in routes:
+                match = re.match(pattern + '$', route_path)
+                if (method == self.command) and (match is not None):
+                    (status, body) = getattr(self, name)(data, *match.groups())
+                    break
+        body = body.encode('utf-8')
+        etag = None
+        if (self.command == 'GET') and (status == 200):
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                (status, body) = (304, b'')
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with server.lock:
+            server.request_count += 1
+
+    def _get_group(self, data, group_id):
+        return (200, '<?xml version="1.0" encoding="UTF-8"?>\n<group>\n  <id type="integer">%s</id>\n  <title>Benchmark group %s</title>\n</group>\n' % (group_id, group_id))
+
+    def _get_group_items(self, data, group_id):
+        items = self.server.store.items
+        item_ids = [item_id for item_id in sorted(items.keys()) if items[item_id]['group_id'] == int(group_id)]
+        for name in ['title', 'reference_id', 'external_id']:
+            values = self.query.get('item[%s]' % name)
+            if values:
+                item_ids = [item_id for item_id in item_ids if items[item_id][name] == values[0]]
+        if 'per_page' in self.query:
+            per_page = int(self.query['per_page'][0])
+            page = int(self.query.get('page', ['1'])[0])
+            item_ids = item_ids[(page - 1) * per_page:page * per_page]
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<items type="array">\n']
+        for item_id in item_ids:
+            parts.append(self._item_xml(item_id))
+        parts.append('</items>\n')
+        return (200, ''.join(parts))
+
+    def _get_image(self, data, image_id):
+        image = self.server.store.images.get(int(image_id))
+        if image is None:
+            return (404, '<errors><error>Image not found</error></errors>')
+        return (200, self._image_xml(int(image_id)))
+
+    def _get_item(self, data, item_id):
+        if self._item(item_id) is None:
+            return (404, '<errors><error>Item not found</error></errors>')
+        return (200, '<?xml version="1.0" encoding="UTF-8"?>\n' + self._item_xml(int(item_id)))
+
+    def _get_query_groups(self, data):
+        store = self.server.store
+        group_ids = sorted(set([item['group_id'] for item in list(store.items.values())]))
+        groups = ''.join(['  <group>\n    <id type="integer">%d</id>\n    <title>Benchmark group %d</title>\n  </group>\n' % (group_id, group_id)
+                for group_id in group_ids])
+        return (200, '<?xml version="1.0" encoding="UTF-8"?>\n<groups type="array">\n%s</groups>\n' % groups)
+
+    def _get_resources(self, data, item_id):
+        item = self._item(item_id)
+        if item is None:
+            return (404, '<errors><error>Item not found</error></errors>')
+        resources = ''.join(['  <item-resource><title>%s</title><section>%s</section></item-resource>\n' % resource
+                for resource in item['resources']])
+        return (200, '<?xml version="1.0" encoding="UTF-8"?>\n<item-resources type="array">\n%s</item-resources>\n' % resources)
+
+    def _image_xml(self, image_id):
+        image = self.server.store.images[image_id]
+        return ('<image>\n  <id type="integer">%d</id>\n  <item-id type="integer">%d</item-id>\n'
+                '  <file-sha1>%s</file-sha1>\n  <status>%s</status>\n</image>\n') % (image_id, image['item_id'], image['sha1'], image['status'])
+
+    def _item(self, item_id):
+        return self.server.store.items.get(int(item_id))
+
+    def _item_xml(self, item_id):
+        item = self.server.store.items[item_id]
+        images = ''.join([self._image_xml(image_id) for image_id in item['images'] if image_id in self.server.store.images])
+        reference = ''
+        if item['reference_id'] is not None:
+            reference = '  <reference-id>%s</reference-id>\n' % item['reference_id']
+        if item['external_id'] is not None:
+            reference += '  <external-id>%s</external-id>\n' % item['external_id']
+        return ('<item>\n  <id type="integer">%d</id>\n  <title>%s</title>\n%s'
+                '  <images type="array">\n%s</images>\n</item>\n') % (item_id, item['title'], reference, images)
+
+    def _set_image_status(self, data, image_id):
+        image = self.server.store.images.get(int(image_id))
+        if image is None:
+            return (404, '<errors><error>Image not found</error></errors>')
+        status = _field(data, 'name')
+        if status == 'ACTIVE':
+            # the real server indexes images asynchronously
+            status = 'ACTIVATION_QUEUED'
+        image['status'] = status
+        return (200, self._image_xml(int(image_id)))
+
+    def _update_item(self, data, item_id):
+        item = self._item(item_id)
+        if item is None:
+            return (404, '<errors><error>Item not found</error></errors>')
+        item['title'] = _field(data, 'title') or item['title']
+        return (200, '')
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """ Threaded HTTP/1.1 (keep-alive) server answering Data API and Query
+    API requests.
+
+    Every request is delayed by latency seconds (+-50%) and fails with
+    HTTP status error_status with probability error_rate. The requests are
+    not authenticated.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port = 0, latency = 0.0, error_rate = 0.0, error_status = 503):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self.store = _Store()
+
+    def endpoint(self):
+        """ Return URL of the server to be passed to the clients. """
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+def start_server(port = 0, latency = 0.0, error_rate = 0.0, error_status = 503):
+    """ Start server in a background thread.
+    Returns the StandInServer; call its shutdown() method to stop it.
+    """
+    server = StandInServer(port, latency, error_rate, error_status)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-p', '--port', type='int', default=0,
+            help="port to listen on, 0 picks a free port [%default]")
+    parser.add_option('--latency', type='float', default=0.0,
+            help="average delay of each response in seconds [%default]")
+    parser.add_option('--error-rate', type='float', default=0.0,
+            help="fraction of requests failing with --error-status [%default]")
+    parser.add_option('--error-status', type='int', default=503,
+            help="HTTP status of the injected errors [%default]")
+    (options, _arguments) = parser.parse_args()
+    server = StandInServer(options.port, options.latency, options.error_rate, options.error_status)
+    # the load harness reads the endpoint from the first line of the output
+    sys.stdout.write(server.endpoint() + '\n')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,286 @@
+"""
+Bulk ingestion of items into kooaba Data API.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from workers import WorkerPool, imap_unordered
+import csv
+import os
+
+try:
+    # Python 2.6 and newer
+    import json
+except ImportError:
+    # Python 2.5
+    import simplejson as json
+
+
+__all__ = ['BulkIngestor', 'BulkResult', 'read_manifest']
+
+
+# Item metadata entries which can be set directly in the manifest record
+EXTRAS_FIELDS = ['external_id', 'reference_id', 'locale']
+
+
+class BulkResult:
+    """ Outcome of processing one manifest record.
+
+    Attributes:
+       * record: The processed manifest record.
+       * item_id: ID of the created or updated item (None if the item was
+          not created).
+       * image_ids: IDs of the images added to the item.
+       * error: Exception which stopped processing of the record, or None
+          if the record was processed completely.
+    """
+
+    def __init__(self, record, item_id = None, image_ids = None, error = None):
+        self.record = record
+        self.item_id = item_id
+        if image_ids is None:
+            image_ids = list()
+        self.image_ids = image_ids
+        self.error = error
+
+    def succeeded(self):
+        """ Return True if the record was processed without error. """
+        return self.error is None
+
+
+class BulkIngestor:
+    """ Creates or updates items described by manifest records.
+
+    The records are processed concurrently on a pool of worker threads
+    sharing one client (and its connection pool). The steps for a single
+    record (create/update item, change medium type, add images, add
+    resources) are still performed in order; up to image_workers images of
+    a record are uploaded, created and activated at once, on a pool of
+    threads shared by all the records.
+    """
+
+    def __init__(self, client, workers = 4, activate_images = True, default_group_id = None, image_workers = 1):
+        """ Initialize ingestor using the client (BasicDataUploadClient).
+        Records without group_id or item_id are created in the
+        default_group_id.
+        """
+        self.client = client
+        self.workers = workers
+        self.image_workers = image_workers
+        self.activate_images = activate_images
+        self.default_group_id = default_group_id
+        # images of the records being processed by run()
+        self._image_pool = None
+
+    def ingest_record(self, record):
+        """ Create (or update) the item described by the record.
+        Returns BulkResult. The result records the error and any partial
+        progress if the processing fails.
+        """
+        result = BulkResult(record)
+        try:
+            if record.get('error') is not None:
+                # invalid record (see read_manifest())
+                raise ValueError(record['error'])
+            result.item_id = self._create_or_update_item(record)
+            if record['medium_type'] is not None:
+                self.client.change_item_medium_type(result.item_id, record['medium_type'], record['title'], record['metadata'])
+            image_error = None
+            for (_filename, image_id, error) in self.client.add_images(result.item_id, record['images'],
+                    self.activate_images, self.image_workers, self._image_pool):
+                if image_id is not None:
+                    result.image_ids.append(image_id)
+                if image_error is None:
+                    image_error = error
+            if image_error is not None:
+                raise image_error
+            for resource in record['resources']:
+                if resource.get('file') is not None:
+                    self.client.add_resource_file(result.item_id, resource['title'], resource['section'], resource['file'])
+                else:
+                    self.client.add_resource_uri(result.item_id, resource['title'], resource['section'], resource['uri'])
+        except Exception, e:
+            result.error = e
+        return result
+
+    def run(self, records):
+        """ Process the records (iterable of manifest records).
+        Generates BulkResult for every record in the order of completion.
+        """
+        self._image_pool = WorkerPool(self.workers * self.image_workers)
+        try:
+            for (_record, result, _error) in imap_unordered(self.ingest_record, records, self.workers):
+                yield result
+        finally:
+            self._image_pool.close()
+            self._image_pool = None
+
+    def _create_or_update_item(self, record):
+        """ Create the item or update the existing one. Returns item ID. """
+        extras = dict()
+        for name in EXTRAS_FIELDS:
+            extras[name] = record[name]
+        if record['item_id'] is not None:
+            extras['title'] = record['title']
+            if len([value for value in extras.values() if value is not None]) > 0:
+                self.client.update_item(record['item_id'], extras)
+            return record['item_id']
+        group_id = record['group_id']
+        if group_id is None:
+            group_id = self.default_group_id
+        if group_id is None:
+            raise ValueError("No group to create the item in (line %s)" % record['line'])
+        if record['title'] is None:
+            raise ValueError("Item title is missing (line %s)" % record['line'])
+        return self.client.create_item(group_id, record['title'], extras)
+
+
+def read_manifest(filename, report_invalid = False):
+    """ Read the manifest file describing items.
+
+    The manifest is in the CSV format (files with .csv extension) or in
+    JSON lines format (one JSON object per line). Each record may contain
+    the entries:
+       * group_id: Group to create the item in.
+       * item_id: Existing item to update instead of creating a new one.
+       * title, external_id, reference_id, locale: Item metadata.
+       * medium_type, metadata: Medium type and medium specific metadata
+          (dictionary; in CSV as 'name:value' pairs separated by '|').
+       * images: Image files to add (list; in CSV separated by '|').
+       * resources: Resources to add (list of dictionaries with entries
+          title, section and either uri or file; in CSV as JSON list).
+    Relative file names are relative to the directory of the manifest.
+
+    Generates normalized records (dictionaries with all the entries above
+    plus line, the line number of the record). With report_invalid, an
+    invalid record is generated as a dictionary with only the entries line
+    and error (the message) instead of stopping the reading.
+    Raises exception:
+        - ValueError: Invalid manifest record (unless report_invalid).
+    """
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    f = open(filename, 'rb')
+    try:
+        if filename.lower().endswith('.csv'):
+            reader = csv.DictReader(f)
+            for row in reader:
+                try:
+                    record = _normalize_csv_row(row, reader.line_num, base_dir)
+                except ValueError, e:
+                    if not report_invalid:
+                        raise
+                    record = {'line': reader.line_num, 'error': str(e)}
+                yield record
+        else:
+            line_number = 0
+            for line in f:
+                line_number += 1
+                if line.strip() == '':
+                    continue
+                try:
+                    try:
+                        entries = json.loads(line)
+                    except ValueError, e:
+                        raise ValueError("Invalid JSON on line %d: %s" % (line_number, e))
+                    record = normalize_record(entries, line_number, base_dir)
+                except ValueError, e:
+                    if not report_invalid:
+                        raise
+                    record = {'line': line_number, 'error': str(e)}
+                yield record
+    finally:
+        f.close()
+
+
+def normalize_record(entries, line_number, base_dir):
+    """ Normalize record entries read from a manifest.
+    Returns the record as dictionary (see read_manifest()).
+    Raises exception:
+        - ValueError: Invalid record.
+    """
+    if not isinstance(entries, dict):
+        raise ValueError("Manifest record on line %d is not an object" % line_number)
+    record = {'line': line_number}
+    for name in ['group_id', 'item_id', 'title', 'medium_type'] + EXTRAS_FIELDS:
+        record[name] = _text(entries.get(name))
+    if (record['group_id'] is not None) and (record['item_id'] is not None):
+        raise ValueError("Manifest record on line %d has both group_id and item_id" % line_number)
+    metadata = dict()
+    for (key, value) in (entries.get('metadata') or dict()).items():
+        metadata[_text(key)] = _text(value)
+    record['metadata'] = metadata
+    record['images'] = [os.path.join(base_dir, _text(filename)) for filename in entries.get('images') or list()]
+    resources = list()
+    for resource in entries.get('resources') or list():
+        normalized = dict()
+        for name in ['title', 'section', 'uri', 'file']:
+            normalized[name] = _text(resource.get(name))
+        if (normalized['title'] is None) or (normalized['section'] is None):
+            raise ValueError("Resource on line %d requires title and section" % line_number)
+        if (normalized['uri'] is None) == (normalized['file'] is None):
+            raise ValueError("Resource on line %d requires either an URI or a file" % line_number)
+        if normalized['file'] is not None:
+            normalized['file'] = os.path.join(base_dir, normalized['file'])
+        resources.append(normalized)
+    record['resources'] = resources
+    return record
+
+
+def _normalize_csv_row(row, line_number, base_dir):
+    """ Convert CSV row to record entries and normalize them. """
+    entries = dict()
+    for (key, value) in row.items():
+        if (key is not None) and (value is not None) and (value != ''):
+            entries[key.strip()] = value
+    if 'metadata' in entries:
+        metadata = dict()
+        for md in entries['metadata'].split('|'):
+            if not ':' in md:
+                raise ValueError("Metadata pair '%s' on line %d is invalid (it must be specified as 'name:value')." % (md, line_number))
+            split = md.split(':', 1)
+            metadata[split[0].strip()] = split[1]
+        entries['metadata'] = metadata
+    if 'images' in entries:
+        entries['images'] = entries['images'].split('|')
+    if 'resources' in entries:
+        try:
+            entries['resources'] = json.loads(entries['resources'])
+        except ValueError, e:
+            raise ValueError("Invalid resources on line %d: %s" % (line_number, e))
+    return normalize_record(entries, line_number, base_dir)
+
+
+def _text(value):
+    """ Convert manifest value to UTF-8 encoded str (None stays None). """
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    return str(value)
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
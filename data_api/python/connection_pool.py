@@ -0,0 +1,253 @@
+"""
+Pool of persistent HTTP connections for the kooaba API clients.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import select
+import socket
+import threading
+import time
+
+# Python 2 vs 3
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+
+__all__ = ['DEFAULT_TIMEOUT', 'HTTPConnectionPool', 'PooledResponse']
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Seconds a connection may block connecting, sending or waiting for data,
+# so that a stalled server does not block its caller forever
+DEFAULT_TIMEOUT = 60.0
+
+# Errors indicating that a reused keep-alive connection was closed by the server
+STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest,
+        httplib.ResponseNotReady, socket.error)
+
+
+class HTTPConnectionPool:
+    """ Thread-safe pool of persistent HTTP/1.1 connections.
+
+    Idle connections are kept separately for each (scheme, host, port) key
+    and at most max_idle of them are kept per key. Connections which were
+    idle for more than max_idle_time seconds are considered stale and are
+    closed instead of being reused.
+
+    By default, the number of connections in use is not limited (each
+    thread sending a request gets a connection). If max_connections is
+    given, at most that many connections per key are open (in use or
+    idle) and acquire() waits for a connection released by another thread.
+    """
+
+    def __init__(self, max_idle = 4, max_idle_time = 30.0, timeout = DEFAULT_TIMEOUT, max_connections = None):
+        """ Initialize empty pool.
+        The timeout (in seconds) is passed to new connections, None means
+        the default socket timeout (no timeout unless set by
+        socket.setdefaulttimeout()). None as max_connections means no limit.
+        """
+        self.max_idle = max_idle
+        self.max_idle_time = max_idle_time
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._idle = dict()
+        self._open = dict()
+        self._lock = threading.Condition()
+        self._stats = {'hits': 0, 'new_connections': 0, 'evictions': 0, 'reconnects': 0}
+
+    def acquire(self, scheme, host, port = None):
+        """ Take a connection to given server out of the pool.
+        A new connection is created if there is no usable idle one (once
+        there are fewer than max_connections open connections to the server).
+        Every acquired connection has to be given back by release() or
+        discard().
+        Returns tuple (connection, reused), reused is True for connections
+        taken from the pool.
+        Raises exception:
+            - RuntimeError: Unsupported transport scheme.
+        """
+        if scheme not in DEFAULT_PORTS:
+            raise RuntimeError("URL scheme '%s' not supported" % scheme)
+        if port is None:
+            port = DEFAULT_PORTS[scheme]
+        key = (scheme, host, port)
+        stale = list()
+        connection = None
+        with self._lock:
+            while True:
+                now = time.time()
+                idle = self._idle.get(key, [])
+                while idle and (connection is None):
+                    (candidate, released_at) = idle.pop()
+                    if (now - released_at > self.max_idle_time) or self._is_dropped(candidate):
+                        self._stats['evictions'] += 1
+                        self._open[key] -= 1
+                        stale.append(candidate)
+                    else:
+                        self._stats['hits'] += 1
+                        connection = candidate
+                if connection is not None:
+                    break
+                if (self.max_connections is None) or (self._open.get(key, 0) < self.max_connections):
+                    self._stats['new_connections'] += 1
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+                self._lock.wait()
+        for candidate in stale:
+            candidate.close()
+        if connection is not None:
+            return (connection, True)
+        return (self._new_connection(key), False)
+
+    def close(self):
+        """ Close all idle connections. """
+        with self._lock:
+            idle = self._idle
+            self._idle = dict()
+            for (key, connections) in idle.items():
+                self._open[key] -= len(connections)
+            self._lock.notify_all()
+        for connections in idle.values():
+            for (connection, _released_at) in connections:
+                connection.close()
+
+    def discard(self, connection):
+        """ Close connection instead of returning it to the pool. """
+        with self._lock:
+            self._open[connection.pool_key] -= 1
+            self._lock.notify()
+        connection.close()
+
+    def reconnect(self, connection):
+        """ Replace a connection found stale by a new one to the same server.
+        Returns the new connection.
+        """
+        connection.close()
+        with self._lock:
+            self._stats['reconnects'] += 1
+            self._stats['new_connections'] += 1
+        return self._new_connection(connection.pool_key)
+
+    def release(self, connection):
+        """ Return connection to the pool for reuse.
+        The response to the last request must be completely read.
+        """
+        evicted = False
+        with self._lock:
+            idle = self._idle.setdefault(connection.pool_key, [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, time.time()))
+            else:
+                self._stats['evictions'] += 1
+                self._open[connection.pool_key] -= 1
+                evicted = True
+            self._lock.notify()
+        if evicted:
+            connection.close()
+
+    def stats(self):
+        """ Return pool statistics as dictionary.
+        The entries are hits (connections reused), new_connections,
+        evictions (idle connections closed), reconnects (reused connections
+        found stale while sending a request), idle (connections currently
+        in the pool) and open (connections in use or idle).
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = sum([len(idle) for idle in self._idle.values()])
+            stats['open'] = sum(self._open.values())
+        return stats
+
+    def _is_dropped(self, connection):
+        """ Return True if the server closed an idle connection.
+        An idle keep-alive socket is readable only when the server closed it
+        (or sent unexpected data), neither of which allows its reuse.
+        """
+        sock = connection.sock
+        if sock is None:
+            return False
+        try:
+            (readable, _writable, _errors) = select.select([sock], [], [], 0)
+        except (select.error, ValueError):
+            return True
+        return len(readable) > 0
+
+    def _new_connection(self, key):
+        """ Create a new (not yet connected) connection for the key. """
+        (scheme, host, port) = key
+        kwargs = dict()
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, **kwargs)
+        else:
+            connection = httplib.HTTPConnection(host, port, **kwargs)
+        connection.pool_key = key
+        return connection
+
+
+class PooledResponse:
+    """ File-like object reading body of a response incrementally.
+
+    Closing the object returns the connection of the response to the pool
+    if the body was read completely, the connection is closed otherwise.
+    """
+
+    def __init__(self, pool, connection, response):
+        self.pool = pool
+        self.connection = connection
+        self.response = response
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def close(self):
+        """ Release the connection (can be called repeatedly). """
+        connection = self.connection
+        if connection is None:
+            return
+        self.connection = None
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(connection)
+        else:
+            self.pool.discard(connection)
+
+    def read(self, size = -1):
+        """ Read up to size bytes of the body, everything if size is negative. """
+        if size is None or size < 0:
+            return self.response.read()
+        return self.response.read(size)
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
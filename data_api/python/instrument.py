@@ -0,0 +1,258 @@
+"""
+Instrumentation of the requests made by the data API client.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+try:
+    # Python 2.6 and newer
+    import json
+except ImportError:
+    # Python 2.5
+    import simplejson as json
+
+
+__all__ = ['JSONLinesExporter', 'MetricsCollector', 'PHASES', 'RequestHooks', 'RequestInfo']
+
+
+# Phases of a request attempt in the order in which they happen
+PHASES = ('rate_limit', 'connect', 'sign', 'send', 'ttfb', 'read', 'parse')
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class RequestInfo:
+    """ Description of a request attempt passed to the hooks.
+
+    The timings map the phases (see PHASES) to the seconds spent in them:
+    waiting for the rate limiter, connecting (including the DNS lookup,
+    zero for reused connections), signing (including hashing of streamed
+    content), sending the request, waiting for the first byte of the
+    response (time to first byte), reading the body and parsing it. Only
+    the phases the attempt went through are present, the body of a
+    streamed response is read and parsed by the caller and not timed.
+    """
+
+    def __init__(self, method, api_path, endpoint, attempt, request_size):
+        self.method = method
+        self.api_path = api_path
+        # API path with IDs replaced by ':id' (see ratelimit.endpoint_of())
+        self.endpoint = endpoint
+        # 1 for the first attempt, 2 for the first retry, etc.
+        self.attempt = attempt
+        self.request_size = request_size
+        self.status = None
+        self.response_size = None
+        self.reused_connection = None
+        self.started_at = time.time()
+        self.duration = None
+        self.timings = dict()
+
+    def as_dict(self):
+        """ Return the description as a dictionary. """
+        return {'method': self.method, 'api_path': self.api_path, 'endpoint': self.endpoint,
+                'attempt': self.attempt, 'request_size': self.request_size, 'status': self.status,
+                'response_size': self.response_size, 'reused_connection': self.reused_connection,
+                'started_at': self.started_at, 'duration': self.duration, 'timings': dict(self.timings)}
+
+
+class RequestHooks:
+    """ Receiver of the request events, the methods do nothing unless
+    overridden.
+
+    The hooks are called by the threads making the requests, so they have
+    to be thread-safe and quick. Exceptions raised by them propagate to
+    the caller of the client.
+    """
+
+    def after_response(self, info):
+        """ Called after a response with status 2xx (or 304 for conditional
+        requests) has been read and parsed.
+        """
+        pass
+
+    def before_request(self, info):
+        """ Called before an attempt to send the request. """
+        pass
+
+    def on_error(self, info, error):
+        """ Called when the attempt failed with the error (an exception),
+        including error statuses returned by the server (info.status).
+        """
+        pass
+
+
+class JSONLinesExporter(RequestHooks):
+    """ Writes description of every finished request attempt (see
+    RequestInfo.as_dict()) as a JSON record on a separate line, failed
+    attempts get an additional 'error' entry.
+    """
+
+    def __init__(self, stream):
+        """ Write the records to the file-like object stream. """
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def after_response(self, info):
+        self._write(info.as_dict())
+
+    def on_error(self, info, error):
+        record = info.as_dict()
+        record['error'] = '%s: %s' % (type(error).__name__, error)
+        self._write(record)
+
+    def _write(self, record):
+        """ Write the record and flush the stream. """
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+class _EndpointMetrics:
+    """ Metrics of the requests to one endpoint. """
+
+    def __init__(self, buckets):
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.duration_sum = 0.0
+        self.statuses = dict()
+        self.errors = 0
+        self.phase_sums = dict()
+
+
+class MetricsCollector(RequestHooks):
+    """ Aggregates latency histograms, request counts and time spent in
+    each phase per endpoint (HTTP method and path with IDs replaced).
+    """
+
+    def __init__(self, buckets = DEFAULT_BUCKETS, prefix = 'kooaba_data_api'):
+        """ Use the latency histogram buckets (upper bounds in seconds) and
+        name the metrics with the prefix.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._endpoints = dict()
+
+    def after_response(self, info):
+        self._record(info, False)
+
+    def on_error(self, info, error):
+        self._record(info, True)
+
+    def prometheus_text(self):
+        """ Return the metrics in the Prometheus text exposition format. """
+        prefix = self.prefix
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            lines = [
+                    '# HELP %s_requests_total Request attempts by response status (0 for no response).' % prefix,
+                    '# TYPE %s_requests_total counter' % prefix]
+            for ((method, endpoint), metrics) in endpoints:
+                for (status, count) in sorted(metrics.statuses.items()):
+                    lines.append('%s_requests_total{%s,status="%d"} %d' % (prefix, _labels(method, endpoint), status, count))
+            lines += [
+                    '# HELP %s_request_errors_total Failed request attempts.' % prefix,
+                    '# TYPE %s_request_errors_total counter' % prefix]
+            for ((method, endpoint), metrics) in endpoints:
+                lines.append('%s_request_errors_total{%s} %d' % (prefix, _labels(method, endpoint), metrics.errors))
+            lines += [
+                    '# HELP %s_request_duration_seconds Duration of request attempts.' % prefix,
+                    '# TYPE %s_request_duration_seconds histogram' % prefix]
+            for ((method, endpoint), metrics) in endpoints:
+                labels = _labels(method, endpoint)
+                cumulative = 0
+                for (bound, count) in zip(self.buckets, metrics.bucket_counts):
+                    cumulative += count
+                    lines.append('%s_request_duration_seconds_bucket{%s,le="%s"} %d' % (prefix, labels, _number(bound), cumulative))
+                cumulative += metrics.bucket_counts[-1]
+                lines.append('%s_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (prefix, labels, cumulative))
+                lines.append('%s_request_duration_seconds_sum{%s} %s' % (prefix, labels, _number(metrics.duration_sum)))
+                lines.append('%s_request_duration_seconds_count{%s} %d' % (prefix, labels, cumulative))
+            lines += [
+                    '# HELP %s_request_phase_seconds_total Time spent in the phases of request attempts.' % prefix,
+                    '# TYPE %s_request_phase_seconds_total counter' % prefix]
+            for ((method, endpoint), metrics) in endpoints:
+                for phase in PHASES:
+                    if phase in metrics.phase_sums:
+                        lines.append('%s_request_phase_seconds_total{%s,phase="%s"} %s' % (prefix, _labels(method, endpoint), phase, _number(metrics.phase_sums[phase])))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        """ Write the metrics in the Prometheus text format to the file
+        (atomically replacing it, e.g. for the node exporter textfile
+        collector).
+        """
+        temporary = filename + '.tmp'
+        f = open(temporary, 'w')
+        try:
+            f.write(self.prometheus_text())
+        finally:
+            f.close()
+        try:
+            os.rename(temporary, filename)
+        except OSError:
+            # Windows does not replace existing files
+            os.remove(filename)
+            os.rename(temporary, filename)
+
+    def _record(self, info, failed):
+        """ Add the finished attempt to the metrics. """
+        key = (info.method, info.endpoint)
+        bucket = bisect.bisect_left(self.buckets, info.duration)
+        with self._lock:
+            metrics = self._endpoints.get(key)
+            if metrics is None:
+                metrics = _EndpointMetrics(self.buckets)
+                self._endpoints[key] = metrics
+            metrics.bucket_counts[bucket] += 1
+            metrics.duration_sum += info.duration
+            status = info.status or 0
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            if failed:
+                metrics.errors += 1
+            for (phase, seconds) in info.timings.items():
+                metrics.phase_sums[phase] = metrics.phase_sums.get(phase, 0.0) + seconds
+
+
+def _labels(method, endpoint):
+    """ Format labels of an endpoint. """
+    return 'method="%s",endpoint="%s"' % (method, endpoint.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _number(value):
+    """ Format a number for the Prometheus text format. """
+    return repr(float(value))
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
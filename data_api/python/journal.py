@@ -0,0 +1,241 @@
+"""
+Write-ahead journal of the changes made by the data API client.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import threading
+import time
+
+try:
+    # Python 2.6 and newer
+    import json
+except ImportError:
+    # Python 2.5
+    import simplejson as json
+
+
+__all__ = ['Journal', 'read_journal_header']
+
+
+class Journal:
+    """ Append-only record of the changes made through the client.
+
+    Every change (a step) is written to the journal file (one JSON record
+    per line) before it is made and again after it succeeded or failed.
+    A step is identified by its kind, its arguments and the number of
+    identical steps made before it, so that the same job run again with
+    the same journal finds its completed steps: their recorded results
+    are returned instead of making the changes again.
+
+    The records are flushed to the operating system as they are written,
+    so they survive a crash of the process (but not of the computer).
+    The journal can be shared by threads.
+    """
+
+    def __init__(self, filename):
+        """ Open (or create) the journal stored in the file filename and
+        load the steps completed by the previous runs.
+        """
+        self.filename = filename
+        self.header = None
+        self._lock = threading.Lock()
+        self._completed = dict()
+        self._started = set()
+        self._results = dict()
+        self._counts = dict()
+        self._load()
+        cut_short = os.path.exists(filename) and (os.path.getsize(filename) > 0) and (not self._ends_with_newline())
+        self._file = open(filename, 'ab')
+        if cut_short:
+            # the last record was cut short by a crash
+            self._file.write('\n')
+
+    def close(self):
+        """ Close the journal file. """
+        with self._lock:
+            self._file.close()
+
+    def find_arguments(self, kind, result):
+        """ Return arguments of a completed step of the kind which had the
+        result (numbers converted to strings), None if there is no such step.
+        """
+        with self._lock:
+            return self._results.get((kind, result))
+
+    def run(self, kind, arguments, function, max_age = None, recover = None):
+        """ Perform the step made by calling function (without arguments)
+        unless it was completed before, less than max_age seconds ago (if
+        not None). If the step was started but not finished before, recover
+        (if not None) is called first, a value other than None it returns
+        is taken as the result of the step.
+        Returns result of the step.
+        Raises exception raised by the function.
+        """
+        with self._lock:
+            key = self._next_key(kind, arguments)
+            completed = self._completed.get(key)
+            interrupted = key in self._started
+        if (completed is not None) and ((max_age is None) or (time.time() - completed[1] < max_age)):
+            return completed[0]
+        result = None
+        if interrupted and (recover is not None):
+            result = recover()
+        if result is None:
+            self._write({'step': key, 'event': 'begin'})
+            try:
+                result = function()
+            except Exception, e:
+                self._write({'step': key, 'event': 'fail', 'error': str(e)})
+                raise
+        self._write({'step': key, 'event': 'end', 'result': result})
+        with self._lock:
+            self._completed[key] = (result, time.time())
+            self._results[(kind, result)] = _key_value(arguments)
+        return result
+
+    def start(self, argv, cwd):
+        """ Record the command line arguments and the working directory of
+        the job unless the journal already belongs to a job.
+        """
+        with self._lock:
+            if self.header is not None:
+                return
+            self.header = {'argv': list(argv), 'cwd': cwd}
+        self._write(dict(self.header, event='start'))
+
+    def _ends_with_newline(self):
+        """ Check whether the journal file ends with a newline. """
+        f = open(self.filename, 'rb')
+        try:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == '\n'
+        finally:
+            f.close()
+
+    def _load(self):
+        """ Load the steps recorded in the journal file (if it exists). """
+        if not os.path.exists(self.filename):
+            return
+        f = open(self.filename, 'rb')
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last record was cut short by a crash
+                    continue
+                event = record.get('event')
+                if event == 'start':
+                    if self.header is None:
+                        self.header = {'argv': [_text(arg) for arg in record['argv']], 'cwd': _text(record['cwd'])}
+                    continue
+                key = _text(record['step'])
+                if event == 'begin':
+                    self._started.add(key)
+                elif event == 'end':
+                    result = _native(record.get('result'))
+                    self._completed[key] = (result, record['time'])
+                    (kind, arguments) = _split_key(key)
+                    self._results[(kind, result)] = arguments
+        finally:
+            f.close()
+
+    def _next_key(self, kind, arguments):
+        """ Return key of the next step of the kind with the arguments. """
+        key = '%s %s' % (kind, json.dumps(_key_value(arguments), sort_keys=True))
+        count = self._counts.get(key, 0) + 1
+        self._counts[key] = count
+        return '%s #%d' % (key, count)
+
+    def _write(self, record):
+        """ Append the record (with the current time) to the journal file. """
+        record['time'] = time.time()
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+
+def read_journal_header(filename):
+    """ Return tuple (command line arguments, working directory) of the job
+    recorded in the journal file.
+    Raises exception:
+        - IOError: The journal cannot be read.
+        - ValueError: The journal does not record the job.
+    """
+    f = open(filename, 'rb')
+    try:
+        for line in f:
+            record = json.loads(line)
+            if record.get('event') == 'start':
+                return ([_text(arg) for arg in record['argv']], _text(record['cwd']))
+            break
+    finally:
+        f.close()
+    raise ValueError("Journal %s does not record the command line of the job" % filename)
+
+
+def _key_value(value):
+    """ Convert step arguments to the form used in the step keys (numbers
+    become strings, as IDs are passed both as numbers and as strings).
+    """
+    if isinstance(value, (list, tuple)):
+        return [_key_value(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_text(key), _key_value(item)) for (key, item) in value.items())
+    if (value is None) or isinstance(value, (str, unicode, bool)):
+        return value
+    return str(value)
+
+
+def _native(value):
+    """ Convert strings loaded from JSON to UTF-8 encoded str. """
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    if isinstance(value, list):
+        return [_native(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_native(key), _native(item)) for (key, item) in value.items())
+    return value
+
+
+def _split_key(key):
+    """ Split step key into kind and arguments. """
+    (kind, rest) = key.split(' ', 1)
+    return (kind, _native(json.loads(rest.rsplit(' #', 1)[0])))
+
+
+def _text(value):
+    """ Convert value to UTF-8 encoded str. """
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    return str(value)
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
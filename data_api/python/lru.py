@@ -0,0 +1,129 @@
+"""
+Thread-safe LRU cache with expiring entries.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+__all__ = ['LRUCache']
+
+
+class LRUCache:
+    """ Cache keeping the most recently used entries.
+
+    At most max_entries entries are kept and their total size (as given
+    to put()) is at most max_size, None means no limit. Entries older than
+    ttl seconds are expired, None means they never expire. The least
+    recently used entries are evicted first.
+    """
+
+    def __init__(self, max_entries = 1000, max_size = None, ttl = None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self._lock = threading.Lock()
+        # key -> (value, size, stored_at), the most recently used last
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """ Remove all entries. """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get(self, key, default = None):
+        """ Return value of the entry, default if there is no such
+        (unexpired) entry.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            if (self.ttl is not None) and (time.time() - entry[2] > self.ttl):
+                self.size -= entry[1]
+                return default
+            self._entries[key] = entry
+            return entry[0]
+
+    def get_with_age(self, key):
+        """ Return tuple (value, seconds since it was stored) of the entry
+        regardless of its expiration, None if there is no such entry.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+            return (entry[0], time.time() - entry[2])
+
+    def pop(self, key, default = None):
+        """ Remove the entry. Returns its value, default if there was none. """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.size -= entry[1]
+            return entry[0]
+
+    def put(self, key, value, size = 1, stored_at = None):
+        """ Add (or replace) an entry of given size.
+        The stored_at time (by default the current time) determines the
+        expiration of the entry.
+        """
+        if stored_at is None:
+            stored_at = time.time()
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            if (self.max_size is not None) and (size > self.max_size):
+                return
+            self._entries[key] = (value, size, stored_at)
+            self.size += size
+            while (len(self._entries) > self.max_entries) or ((self.max_size is not None) and (self.size > self.max_size)):
+                (_key, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted[1]
+
+    def remove_if(self, predicate):
+        """ Remove entries whose keys satisfy the predicate.
+        Returns number of the removed entries.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self.size -= self._entries.pop(key)[1]
+        return len(keys)
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
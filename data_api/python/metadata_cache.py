@@ -0,0 +1,301 @@
+"""
+Cache of kooaba Data API responses revalidated with conditional requests.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from lru import LRUCache
+import re
+import sqlite3
+import threading
+import time
+
+
+__all__ = ['MetadataCache']
+
+
+DEFAULT_TTL = 60.0
+
+# Number of remembered items and images of other objects, more are forgotten
+MAX_PARENTS = 100000
+
+_ITEM_RE = re.compile(r'<item(?:\s[^>]*)?>(.*?)</item>'.encode('ascii'), re.S)
+_IMAGE_RE = re.compile(r'<image(?:\s[^>]*)?>(.*?)</image>'.encode('ascii'), re.S)
+_IMAGES_RE = re.compile(r'<images(?:\s[^>]*)?>.*?</images>'.encode('ascii'), re.S)
+_ID_RE = re.compile(r'<id(?:\s[^>]*)?>\s*(\d+)\s*</id>'.encode('ascii'))
+_ITEM_ID_RE = re.compile(r'<item-id(?:\s[^>]*)?>\s*(\d+)\s*</item-id>'.encode('ascii'))
+_GROUP_ID_RE = re.compile(r'<group-id(?:\s[^>]*)?>\s*(\d+)\s*</group-id>'.encode('ascii'))
+
+
+class MetadataCache:
+    """ Read-through cache of the documents returned by GET requests.
+
+    The documents are kept in memory (at most max_entries of them taking
+    at most max_size bytes) and optionally in a SQLite database file
+    shared by processes. They are cached separately for every scope (the
+    client's endpoint and access key), so that clients of different
+    accounts or servers never see each other's documents. A document
+    younger than ttl seconds is used without asking the server. Older
+    documents are revalidated with a conditional request if the server
+    sent a validator (ETag or Last-Modified) with them, they are
+    downloaded again otherwise.
+
+    The client drops the documents possibly affected by its own changes
+    (see invalidate_after()). Changes made by other clients (or processes
+    sharing only the database file) are seen once the documents expire.
+
+    The cache remembers the item of every image and the group of every
+    item it has seen (in the cached documents or by note_parent()), so
+    that a change of an image drops only the documents of its item and
+    group.
+    """
+
+    def __init__(self, max_entries = 1000, max_size = 16 * 1024 * 1024, ttl = DEFAULT_TTL, filename = None):
+        """ Create cache, the documents are stored also in the database
+        file filename unless it is None.
+        """
+        self.ttl = ttl
+        self._memory = LRUCache(max_entries, max_size)
+        self._lock = threading.Lock()
+        # (scope, 'images', image ID) -> item ID, (scope, 'items', item ID) -> group ID
+        self._parents = dict()
+        # (scope, 'items', item ID) -> set of image IDs
+        self._children = dict()
+        self._parents_lock = threading.Lock()
+        self._db = None
+        if filename is not None:
+            self._db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+            with self._lock:
+                columns = [row[1] for row in self._db.execute("PRAGMA table_info(documents)").fetchall()]
+                if columns and ('scope' not in columns):
+                    # documents cached without scope by older versions
+                    self._db.execute("DROP TABLE documents")
+                self._db.execute("CREATE TABLE IF NOT EXISTS documents ("
+                        "scope TEXT NOT NULL, api_path TEXT NOT NULL, body BLOB NOT NULL, etag TEXT, "
+                        "last_modified TEXT, stored_at REAL NOT NULL, PRIMARY KEY (scope, api_path))")
+                # invalidation looks up the paths in all the scopes
+                self._db.execute("CREATE INDEX IF NOT EXISTS documents_by_path ON documents (api_path)")
+                self._db.commit()
+
+    def close(self):
+        """ Close the cache database. """
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+
+    def invalidate(self, prefixes):
+        """ Drop documents whose API paths start with any of the prefixes
+        (in all the scopes).
+        """
+        self._memory.remove_if(lambda key: _starts_with_any(key[1], prefixes))
+        if self._db is not None:
+            with self._lock:
+                for prefix in prefixes:
+                    # a range of the index, the paths sort right after the prefix
+                    self._db.execute("DELETE FROM documents WHERE api_path >= ? AND api_path < ?",
+                            (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+                self._db.commit()
+
+    def invalidate_after(self, scope, method, api_path):
+        """ Drop documents possibly changed by a request of the client with
+        the scope modifying the API node api_path (e.g. PUT /items/12.xml
+        drops the item, its resources and the documents of its group). When
+        the item of a changed image (or the group of a changed item) is not
+        known, the documents of all the items (groups) are dropped.
+        """
+        segments = api_path.split('?', 1)[0].split('/')
+        if segments[1] == 'uploads.xml':
+            return
+        if (len(segments) < 3) or (segments[1] not in ('groups', 'items', 'images')):
+            self.invalidate(['/groups/', '/items/', '/images/'])
+            return
+        kind = segments[1]
+        object_id = segments[2].split('.', 1)[0]
+        prefixes = ['/%s/%s.' % (kind, object_id), '/%s/%s/' % (kind, object_id)]
+        if kind == 'images':
+            # the image is described also by its item and group
+            item_id = self._parent(scope, 'images', object_id)
+            if item_id is None:
+                prefixes.extend(['/items/', '/groups/'])
+            else:
+                prefixes.extend(self._item_prefixes(scope, item_id))
+        elif kind == 'items':
+            prefixes.extend(self._item_prefixes(scope, object_id)[2:])
+            if method == 'DELETE':
+                # images of the item are deleted with it
+                with self._parents_lock:
+                    image_ids = list(self._children.get((scope, 'items', object_id), ()))
+                if (len(image_ids) == 0) and (self._parent(scope, 'items', object_id) is None):
+                    # nothing is known about the item
+                    prefixes.append('/images/')
+                for image_id in image_ids:
+                    prefixes.extend(['/images/%s.' % image_id, '/images/%s/' % image_id])
+        self.invalidate(prefixes)
+
+    def lookup(self, scope, api_path):
+        """ Return tuple (body, etag, last_modified, fresh) of the document
+        cached in the scope, None if it is not cached. Fresh is False if
+        the document has to be revalidated before its use.
+        """
+        found = self._memory.get_with_age((scope, api_path))
+        if found is not None:
+            ((body, etag, last_modified), age) = found
+        elif self._db is not None:
+            with self._lock:
+                row = self._db.execute("SELECT body, etag, last_modified, stored_at FROM documents WHERE scope = ? AND api_path = ?",
+                        (scope, api_path)).fetchone()
+            if row is None:
+                return None
+            (body, etag, last_modified, stored_at) = (bytes(row[0]), _native(row[1]), _native(row[2]), row[3])
+            self._memory.put((scope, api_path), (body, etag, last_modified), len(body), stored_at)
+            self._learn_parents(scope, api_path, body)
+            age = time.time() - stored_at
+        else:
+            return None
+        return (body, etag, last_modified, age <= self.ttl)
+
+    def note_parent(self, scope, kind, object_id, parent_id):
+        """ Remember that the image (kind 'images') belongs to the item
+        parent_id, or that the item (kind 'items') belongs to the group
+        parent_id, e.g. when the client creates them.
+        """
+        object_id = str(object_id)
+        parent_id = str(parent_id)
+        with self._parents_lock:
+            if len(self._parents) >= MAX_PARENTS:
+                self._parents.clear()
+                self._children.clear()
+            self._parents[(scope, kind, object_id)] = parent_id
+            if kind == 'images':
+                self._children.setdefault((scope, 'items', parent_id), set()).add(object_id)
+
+    def purge(self, max_age = 86400):
+        """ Remove documents stored (or revalidated) more than max_age
+        seconds ago from the database.
+        """
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("DELETE FROM documents WHERE stored_at < ?", (time.time() - max_age,))
+                self._db.commit()
+
+    def refresh(self, scope, api_path):
+        """ Mark the document as fresh after its successful revalidation. """
+        found = self._memory.get_with_age((scope, api_path))
+        if found is not None:
+            (entry, _age) = found
+            self._memory.put((scope, api_path), entry, len(entry[0]))
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("UPDATE documents SET stored_at = ? WHERE scope = ? AND api_path = ?", (time.time(), scope, api_path))
+                self._db.commit()
+
+    def store(self, scope, api_path, body, etag = None, last_modified = None):
+        """ Cache the document returned for api_path in the scope with its
+        validators.
+        """
+        now = time.time()
+        self._memory.put((scope, api_path), (body, etag, last_modified), len(body), now)
+        self._learn_parents(scope, api_path, body)
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("INSERT OR REPLACE INTO documents (scope, api_path, body, etag, last_modified, stored_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (scope, api_path, sqlite3.Binary(body), etag, last_modified, now))
+                self._db.commit()
+
+    def _item_prefixes(self, scope, item_id):
+        """ Return prefixes of the documents describing the item. """
+        prefixes = ['/items/%s.' % item_id, '/items/%s/' % item_id]
+        group_id = self._parent(scope, 'items', item_id)
+        if group_id is None:
+            prefixes.append('/groups/')
+        else:
+            prefixes.extend(['/groups/%s.' % group_id, '/groups/%s/' % group_id])
+        return prefixes
+
+    def _learn_parents(self, scope, api_path, body):
+        """ Remember the items of the images and the groups of the items
+        described by the document (image, item or listing of group items).
+        """
+        segments = api_path.split('?', 1)[0].split('/')
+        group_id = None
+        if (len(segments) == 4) and (segments[1] == 'groups') and segments[3].startswith('items.'):
+            group_id = segments[2]
+        for match in _ITEM_RE.finditer(body):
+            item = match.group(1)
+            # the images have their own IDs
+            own = _IMAGES_RE.sub(b'', item)
+            item_id = _first(_ID_RE, own)
+            if item_id is None:
+                continue
+            item_group_id = _first(_GROUP_ID_RE, own) or group_id
+            if item_group_id is not None:
+                self.note_parent(scope, 'items', item_id, item_group_id)
+            for image in _IMAGE_RE.finditer(item):
+                image_id = _first(_ID_RE, image.group(1))
+                if image_id is not None:
+                    self.note_parent(scope, 'images', image_id, item_id)
+        if (len(segments) == 3) and (segments[1] == 'images'):
+            image_id = _first(_ID_RE, body)
+            item_id = _first(_ITEM_ID_RE, body)
+            if (image_id is not None) and (item_id is not None):
+                self.note_parent(scope, 'images', image_id, item_id)
+
+    def _parent(self, scope, kind, object_id):
+        """ Return ID of the item of the image or of the group of the item,
+        None if it is not known.
+        """
+        with self._parents_lock:
+            return self._parents.get((scope, kind, str(object_id)))
+
+
+def _first(pattern, text):
+    """ Return the first group of the first match of the pattern as
+    native string, None if there is no match.
+    """
+    match = pattern.search(text)
+    if match is None:
+        return None
+    value = match.group(1)
+    if not isinstance(value, str):
+        value = value.decode('ascii')
+    return value
+
+
+def _native(text):
+    """ Return text read from the database as native string (or None). """
+    if text is None:
+        return None
+    return str(text)
+
+
+def _starts_with_any(text, prefixes):
+    for prefix in prefixes:
+        if text.startswith(prefix):
+            return True
+    return False
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
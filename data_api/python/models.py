@@ -0,0 +1,188 @@
+"""
+Lazily parsed records of kooaba Data API responses.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+try:
+    # C implementation (Python 2), much faster to parse with
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+
+__all__ = ['Group', 'Image', 'Item', 'Record', 'Resource', 'decode_element', 'iter_records',
+        'parse_records', 'parse_xml']
+
+
+def decode_element(element):
+    """ Convert text of the element to a Python value according to its
+    type attribute: integer to int, boolean to bool, elements with
+    attribute nil="true" (and missing elements, element is None) to None,
+    anything else (including dates) to string.
+    """
+    if element is None or element.get('nil') == 'true':
+        return None
+    text = element.text
+    if text is None:
+        text = ''
+    value_type = element.get('type')
+    if value_type == 'integer':
+        return int(text)
+    if value_type == 'boolean':
+        return text.strip() == 'true'
+    return text
+
+
+def iter_records(stream, tag, record_class):
+    """ Parse XML document read incrementally from stream (file-like
+    object) and generate record_class instances for the elements with
+    given tag which are children of the root element.
+
+    Each element is dropped from the document as soon as its record is
+    generated, so only records kept by the caller stay in memory.
+    """
+    root = None
+    depth = 0
+    for (event, element) in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if depth == 0:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            if element.tag == tag:
+                yield record_class(element)
+            # release the parsed children of the root
+            root.clear()
+
+
+def parse_records(xml_string, record_class):
+    """ Return list of record_class instances for children of the root
+    element of the XML document (e.g. listing of group items).
+    """
+    return [record_class(element) for element in list(ET.fromstring(xml_string))]
+
+
+def parse_xml(xml_string):
+    """ Parse XML document from a string.
+    Returns the root element.
+    """
+    return ET.fromstring(xml_string)
+
+
+class Record(object):
+    """ Record of an API response parsed lazily.
+
+    The record keeps the XML element it was created from. Its fields are
+    decoded (see decode_element) on first access and remembered; field
+    name_of_field comes from sub-element name-of-field.
+    """
+
+    __slots__ = ('element',)
+    fields = ()
+
+    def __init__(self, element):
+        self.element = element
+
+    def __getattr__(self, name):
+        # called only for fields not decoded yet
+        if name not in self.fields:
+            raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+        value = self._decode_field(name)
+        setattr(self, name, value)
+        return value
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.id)
+
+    def get(self, name, default = None):
+        """ Return decoded value of any sub-element given by its XML name
+        (e.g. file-size), default if there is no such sub-element.
+        """
+        element = self.element.find(name)
+        if element is None:
+            return default
+        return decode_element(element)
+
+    @classmethod
+    def from_xml(cls, xml_string):
+        """ Return record parsed from XML document (e.g. body of a response). """
+        return cls(ET.fromstring(xml_string))
+
+    def _decode_field(self, name):
+        """ Decode field from the XML element. """
+        return decode_element(self.element.find(name.replace('_', '-')))
+
+
+class Image(Record):
+    """ Image of an item. """
+
+    __slots__ = ('id', 'item_id', 'status', 'file_name', 'file_sha1', 'file_size', 'file_type',
+            'external_id', 'uri', 'created_at', 'updated_at')
+    fields = __slots__
+
+
+class Item(Record):
+    """ Item of a group, the images are Image records. """
+
+    __slots__ = ('id', 'group_id', 'title', 'reference_id', 'external_id', 'locale',
+            'created_at', 'updated_at', 'images')
+    fields = __slots__
+
+    def _decode_field(self, name):
+        if name == 'images':
+            return [Image(element) for element in self.element.findall('images/image')]
+        return Record._decode_field(self, name)
+
+
+class Group(Record):
+    """ Group with item and image statistics. """
+
+    __slots__ = ('id', 'title', 'item_count', 'image_counts')
+    fields = __slots__
+
+    def _decode_field(self, name):
+        if name == 'item_count':
+            return decode_element(self.element.find('items/count'))
+        if name == 'image_counts':
+            # number of images by status, e.g. {'ACTIVE': 9, 'INACTIVE': 0}
+            counts = dict()
+            for element in self.element.findall('images/status/*'):
+                counts[element.tag.upper()] = decode_element(element)
+            return counts
+        return Record._decode_field(self, name)
+
+
+class Resource(Record):
+    """ Resource (file or URI) of an item. """
+
+    __slots__ = ('id', 'item_id', 'title', 'section', 'uri', 'created_at', 'updated_at')
+    fields = __slots__
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,195 @@
+"""
+Downscaling and re-encoding of images before their upload.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from KWS import iterate_chunks
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# PIL is optional, images are uploaded unchanged without it
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+
+__all__ = ['ImagePreprocessor', 'preprocess_image']
+
+
+DEFAULT_MAX_DIMENSION = 1600
+DEFAULT_QUALITY = 85
+
+# Increased whenever the output of preprocess_image() changes
+PREPROCESS_VERSION = 1
+
+# EXIF tag of the image orientation
+EXIF_ORIENTATION = 274
+
+# Transpositions turning an image with given EXIF orientation upright
+if Image is not None:
+    _UPRIGHT = {
+        2: [Image.FLIP_LEFT_RIGHT],
+        3: [Image.ROTATE_180],
+        4: [Image.FLIP_TOP_BOTTOM],
+        5: [Image.ROTATE_90, Image.FLIP_TOP_BOTTOM],
+        6: [Image.ROTATE_270],
+        7: [Image.ROTATE_90, Image.FLIP_LEFT_RIGHT],
+        8: [Image.ROTATE_90],
+    }
+    # LANCZOS in Pillow, ANTIALIAS in PIL
+    _RESAMPLE = getattr(Image, 'LANCZOS', None) or getattr(Image, 'ANTIALIAS')
+
+
+def preprocess_image(source, destination, max_dimension = DEFAULT_MAX_DIMENSION, quality = DEFAULT_QUALITY):
+    """ Write image from the file source to the file destination as JPEG
+    with the given quality, downscaled to fit into max_dimension x
+    max_dimension pixels and turned upright according to its EXIF
+    orientation. Metadata (EXIF, ICC profile, comments) are not copied.
+    Returns True if the destination was written, False if the source should
+    be uploaded as it is: it is not an image readable by PIL (also when
+    PIL refuses to decode it, e.g. a decompression bomb), or it was not
+    downscaled and the result would not be smaller.
+    """
+    try:
+        image = Image.open(source)
+        image.load()
+    except Exception:
+        # IOError for unknown formats, DecompressionBombError, and decoder
+        # errors raised as SyntaxError, ValueError etc. by some plugins
+        return False
+    orientation = None
+    try:
+        exif = image._getexif()
+        if exif is not None:
+            orientation = exif.get(EXIF_ORIENTATION)
+    except Exception:
+        # no EXIF (e.g. PNG) or unreadable EXIF
+        pass
+    for method in _UPRIGHT.get(orientation, []):
+        image = image.transpose(method)
+    resized = max(image.size) > max_dimension
+    if resized:
+        scale = float(max_dimension) / max(image.size)
+        size = (max(int(round(image.size[0] * scale)), 1), max(int(round(image.size[1] * scale)), 1))
+        image = image.resize(size, _RESAMPLE)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.save(destination, 'JPEG', quality=quality, optimize=True)
+    if (not resized) and (orientation in (None, 1)) and (os.path.getsize(destination) >= os.path.getsize(source)):
+        os.remove(destination)
+        return False
+    return True
+
+
+def _preprocess_file(arguments):
+    """ Run preprocess_image() in a worker process. """
+    return preprocess_image(*arguments)
+
+
+class ImagePreprocessor:
+    """ Shrinks images before their upload (see preprocess_image()).
+
+    The images are processed by a pool of processes, so that images
+    uploaded by concurrent threads are processed on all the CPU cores.
+    The results are cached in cache_dir by the hash of the source file
+    content and the settings, so images uploaded repeatedly (also by
+    later runs sharing the directory) are processed only once.
+    """
+
+    def __init__(self, max_dimension = DEFAULT_MAX_DIMENSION, quality = DEFAULT_QUALITY, cache_dir = None, processes = None):
+        """ Initialize preprocessor with a pool of processes (as many as
+        there are CPUs by default). Without cache_dir, the results are
+        kept in a temporary directory removed by close().
+        Raises exception:
+            - RuntimeError: PIL is not installed.
+        """
+        if Image is None:
+            raise RuntimeError("Image preprocessing requires PIL (Pillow)")
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self._temporary_dir = cache_dir is None
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix='kooaba-preprocess-')
+        elif not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self._pool = multiprocessing.Pool(processes)
+
+    def close(self):
+        """ Stop the worker processes, remove temporary results. """
+        self._pool.close()
+        self._pool.join()
+        if self._temporary_dir:
+            shutil.rmtree(self.cache_dir, True)
+
+    def prepare(self, filename):
+        """ Preprocess image from the file.
+        Returns name of the file to be uploaded instead: the processed
+        image (JPEG), or filename if the original is better left as is.
+        Raises exception:
+            - IOError: The file cannot be read.
+        """
+        key = self._cache_key(filename)
+        processed = os.path.join(self.cache_dir, key + '.jpg')
+        # marks sources which are uploaded unchanged
+        unchanged = os.path.join(self.cache_dir, key + '.orig')
+        if os.path.exists(processed):
+            return processed
+        if os.path.exists(unchanged):
+            return filename
+        (handle, temporary) = tempfile.mkstemp(suffix='.jpg', dir=self.cache_dir)
+        os.close(handle)
+        try:
+            written = self._pool.apply_async(_preprocess_file,
+                    ((filename, temporary, self.max_dimension, self.quality),)).get()
+            if written:
+                # atomic, concurrent preparations of the same file write the same result
+                os.rename(temporary, processed)
+                return processed
+            open(unchanged, 'w').close()
+            return filename
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def _cache_key(self, filename):
+        """ Return cache key of the file content and the settings. """
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iterate_chunks(f):
+                h.update(chunk)
+        return '%s-%d-q%d-v%d' % (h.hexdigest(), self.max_dimension, self.quality, PREPROCESS_VERSION)
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,216 @@
+"""
+Client-side limiting of API request rates.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import fnmatch
+import hashlib
+import os
+import re
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+
+__all__ = ['FileTokenBucket', 'RequestRateLimiter', 'TokenBucket', 'parse_rate_limit']
+
+
+class TokenBucket:
+    """ Thread-safe token bucket limiting the rate of requests.
+
+    The bucket is refilled by rate tokens per second up to burst tokens.
+    Each request takes one token. When the bucket is empty, the requests
+    reserve the future tokens in the order of their arrival and wait for
+    them, so the waiting requests are served first come, first served.
+    """
+
+    def __init__(self, rate, burst = None):
+        """ Initialize full bucket.
+        None as burst means one second worth of tokens (at least one).
+        Raises exception:
+            - ValueError: The rate is not positive.
+        """
+        if rate <= 0:
+            raise ValueError("Rate %s must be positive" % rate)
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1.0, self.rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens = 1):
+        """ Take tokens from the bucket, waiting until they are available. """
+        with self._lock:
+            now = time.time()
+            (self._tokens, wait) = _reserve(self._tokens, self._updated, now, self.rate, self.burst, tokens)
+            self._updated = now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class FileTokenBucket:
+    """ Token bucket shared by processes via a state file.
+
+    Behaves like TokenBucket, but the state of the bucket is kept in the
+    file filename (created if missing) which is locked while taking the
+    tokens. All processes using the same file share one budget. Requires
+    fcntl (i.e. Unix-like system).
+    """
+
+    def __init__(self, filename, rate, burst = None):
+        """ Initialize bucket stored in the file.
+        Raises exception:
+            - RuntimeError: File locking not supported on this platform.
+        """
+        if fcntl is None:
+            raise RuntimeError("File based rate limiting is not supported on this platform")
+        self.filename = filename
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1.0, self.rate)
+        self.burst = float(burst)
+
+    def acquire(self, tokens = 1):
+        """ Take tokens from the bucket, waiting until they are available. """
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            state = os.read(fd, 16)
+            if len(state) == 16:
+                (available, updated) = struct.unpack('<dd', state)
+            else:
+                (available, updated) = (self.burst, now)
+            (available, wait) = _reserve(available, updated, now, self.rate, self.burst, tokens)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, struct.pack('<dd', available, now))
+        finally:
+            # closing the file releases the lock
+            os.close(fd)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RequestRateLimiter:
+    """ Limits the rate of API requests according to a set of budgets.
+
+    Each budget applies to the requests matching the HTTP method and the
+    API path patterns (see add_budget()). A request matching several
+    budgets takes a token from each of them. The limiter is plugged into
+    the client by BasicDataUploadClient.set_rate_limiter().
+    """
+
+    def __init__(self):
+        self._budgets = list()
+
+    def acquire(self, method, api_path):
+        """ Wait until the request may be sent. """
+        endpoint = endpoint_of(api_path)
+        for (method_pattern, path_pattern, bucket) in self._budgets:
+            if ((method_pattern == '*') or (method_pattern == method)) and fnmatch.fnmatchcase(endpoint, path_pattern):
+                bucket.acquire()
+
+    def add_budget(self, bucket, method = '*', path = '*'):
+        """ Add budget (TokenBucket or FileTokenBucket) for the requests
+        with the HTTP method ('*' means any method) and the API path
+        matching the shell-style pattern (e.g. '/images/*/status.xml',
+        numeric IDs in the request path are replaced by ':id' before
+        matching).
+        """
+        self._budgets.append((method.upper(), path, bucket))
+
+
+def endpoint_of(api_path):
+    """ Return API path (without query) with numeric IDs replaced by ':id'. """
+    return _ID_SEGMENT.sub('/:id', api_path.split('?', 1)[0])
+
+
+def parse_rate_limit(spec, state_dir = None):
+    """ Parse rate limit specification [METHOD] [PATH]=RATE[/BURST] (only
+    RATE applies to all requests), e.g. 'POST /uploads.xml=2'.
+    The state of the bucket is kept in the directory state_dir to share
+    the budget with other processes, None means budget of this process.
+    Returns tuple (bucket, method, path) as accepted by
+    RequestRateLimiter.add_budget().
+    Raises exception:
+        - ValueError: Invalid specification.
+    """
+    if '=' in spec:
+        (pattern, limit) = spec.rsplit('=', 1)
+    else:
+        (pattern, limit) = ('', spec)
+    method = '*'
+    path = '*'
+    for part in pattern.split():
+        if part.startswith('/') or ('*' in part):
+            path = part
+        else:
+            method = part.upper()
+    try:
+        if '/' in limit:
+            (rate, burst) = limit.split('/', 1)
+            (rate, burst) = (float(rate), float(burst))
+        else:
+            (rate, burst) = (float(limit), None)
+    except ValueError:
+        raise ValueError("Invalid rate limit '%s' (expected [METHOD] [PATH]=RATE[/BURST])" % spec)
+    if rate <= 0:
+        raise ValueError("Rate limit '%s' must be positive" % spec)
+    if state_dir is None:
+        bucket = TokenBucket(rate, burst)
+    else:
+        name = hashlib.sha1(("%s %s %s" % (method, path, limit)).encode('UTF-8')).hexdigest()
+        bucket = FileTokenBucket(os.path.join(state_dir, 'rate-%s' % name), rate, burst)
+    return (bucket, method, path)
+
+
+_ID_SEGMENT = re.compile(r'/[0-9]+(?=[/.]|$)')
+
+
+def _reserve(available, updated, now, rate, burst, tokens):
+    """ Refill the bucket and reserve tokens.
+    Returns tuple (available, wait). The available tokens are negative
+    when future tokens were reserved, wait is the time until the reserved
+    tokens are available.
+    """
+    available = min(burst, available + (now - updated) * rate)
+    available -= tokens
+    if available >= 0:
+        return (available, 0.0)
+    return (available, -available / rate)
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
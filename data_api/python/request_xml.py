@@ -0,0 +1,130 @@
+"""
+Serialization of the Data API request documents.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+__all__ = ['image_xml', 'item_xml', 'medium_xml', 'resource_file_xml', 'resource_uri_xml', 'status_xml']
+
+
+# The documents are written from templates instead of building and
+# serializing ElementTree trees, the output is identical to that of
+# ElementTree.write(encoding="UTF-8", xml_declaration=True, method="xml").
+XML_DECLARATION = "<?xml version='1.0' encoding='UTF-8'?>\n"
+
+IMAGE_TEMPLATE = XML_DECLARATION + "<image><file>%s</file></image>"
+RESOURCE_FILE_TEMPLATE = XML_DECLARATION + "<resource>%s%s<file>%s</file></resource>"
+RESOURCE_URI_TEMPLATE = XML_DECLARATION + "<resource>%s%s%s</resource>"
+STATUS_TEMPLATE = XML_DECLARATION + "<status>%s</status>"
+
+# Python 2 vs 3
+try:
+    _text_type = unicode
+except NameError:
+    _text_type = str
+
+
+def image_xml(upload_id):
+    """ Return document creating an image from the upload. """
+    return _encode(IMAGE_TEMPLATE % _element("upload-id", upload_id))
+
+
+def item_xml(extras, title = None):
+    """ Return item document with the title (unless None) followed by the
+    entries of extras (dictionary, entries with value None are skipped).
+    """
+    elements = list()
+    if title is not None:
+        elements.append(_element("title", title))
+    for (key, value) in extras.items():
+        if value is not None:
+            elements.append(_element(key, value))
+    return _encode(_document("item", elements))
+
+
+def medium_xml(medium_type, title, metadata):
+    """ Return document setting the medium type of an item with the title
+    and metadata (dictionary), empty document (removing the medium type) if
+    medium_type is None or empty.
+    """
+    elements = list()
+    if (medium_type is not None) and (medium_type != ""):
+        elements.append(_element("type", 'Medium::'+medium_type))
+        elements.append(_element("title", title))
+        for (key, value) in metadata.items():
+            elements.append(_element(key, value))
+    return _encode(_document("medium", elements))
+
+
+def resource_file_xml(title, section, upload_id):
+    """ Return document adding the uploaded file as an item resource. """
+    return _encode(RESOURCE_FILE_TEMPLATE % (_element("title", title), _element("section", section),
+        _element("upload_id", upload_id)))
+
+
+def resource_uri_xml(title, section, uri):
+    """ Return document adding the URI as an item resource. """
+    return _encode(RESOURCE_URI_TEMPLATE % (_element("title", title), _element("section", section),
+        _element("uri", uri)))
+
+
+def status_xml(name):
+    """ Return document setting the image status. """
+    return _encode(STATUS_TEMPLATE % _element("name", name))
+
+
+def _document(name, elements):
+    """ Return document with root element name containing the elements. """
+    if len(elements) == 0:
+        return "%s<%s />" % (XML_DECLARATION, name)
+    return "%s<%s>%s</%s>" % (XML_DECLARATION, name, "".join(elements), name)
+
+
+def _element(name, text):
+    """ Return element name with the text (UTF-8 encoded bytes, text or a
+    value converted to text) escaped.
+    """
+    if isinstance(text, bytes):
+        text = text.decode('UTF-8')
+    elif not isinstance(text, _text_type):
+        text = _text_type(text)
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if text:
+        return "<%s>%s</%s>" % (name, text, name)
+    return "<%s />" % name
+
+
+def _encode(document):
+    """ Return the document as UTF-8 encoded bytes. """
+    return document.encode('UTF-8', 'xmlcharrefreplace')
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,128 @@
+"""
+Retrying of failed API requests.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import random
+import threading
+import time
+
+
+__all__ = ['RetryBudget', 'RetryPolicy']
+
+
+# HTTP statuses indicating a transient failure
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# Requests which can be repeated without changing the outcome
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+class RetryBudget:
+    """ Limits retries to a fraction of all the requests.
+
+    Every request adds ratio to the budget (at most up to minimum) and
+    every retry takes one from it, so a failing server gets at most
+    minimum retries at once and then one retry per 1/ratio requests
+    instead of a retry storm.
+    """
+
+    def __init__(self, ratio = 0.2, minimum = 10.0):
+        self.ratio = ratio
+        self.minimum = minimum
+        self._balance = minimum
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """ Record a request. """
+        with self._lock:
+            self._balance = min(self.minimum, self._balance + self.ratio)
+
+    def withdraw(self):
+        """ Take one retry from the budget.
+        Returns False if the budget is exhausted.
+        """
+        with self._lock:
+            if self._balance < 1.0:
+                return False
+            self._balance -= 1.0
+            return True
+
+
+class RetryPolicy:
+    """ Decides which failed requests are retried and when.
+
+    Transport failures (IOError) and responses with transient error
+    statuses (see RETRYABLE_STATUSES) are retried up to max_retries times
+    after exponentially growing delays with full jitter (random delay
+    between 0 and base_delay * 2^retry, at most max_delay). A Retry-After
+    sent by the server is respected. All retries are limited by the
+    RetryBudget, which may be shared by several clients.
+    """
+
+    def __init__(self, max_retries = 3, base_delay = 0.5, max_delay = 30.0, budget = None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        if budget is None:
+            budget = RetryBudget()
+        self.budget = budget
+
+    def backoff(self, retry, error = None):
+        """ Return delay (in seconds) before the retry (numbered from 1). """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (retry - 1))))
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            delay = max(delay, min(self.max_delay, retry_after))
+        return delay
+
+    def is_retryable(self, error):
+        """ Return True if the error may be transient. """
+        status = getattr(error, 'status', None)
+        if status is not None:
+            return status in RETRYABLE_STATUSES
+        return isinstance(error, EnvironmentError)
+
+    def record_request(self):
+        """ Record a new (not retried) request in the budget. """
+        self.budget.deposit()
+
+    def should_retry(self, error, retry):
+        """ Return True if the request failing with the error should be
+        retried for the retry-th time (numbered from 1).
+        """
+        if (retry > self.max_retries) or (not self.is_retryable(error)):
+            return False
+        return self.budget.withdraw()
+
+    def wait(self, retry, error = None):
+        """ Sleep before the retry. """
+        time.sleep(self.backoff(retry, error))
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
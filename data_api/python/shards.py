@@ -0,0 +1,352 @@
+"""
+Work queue of manifest records split into shards leased by workers.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from bulk import read_manifest
+import errno
+import hashlib
+import os
+import shutil
+import socket
+import threading
+import time
+
+try:
+    # Python 2.6 and newer
+    import json
+except ImportError:
+    # Python 2.5
+    import simplejson as json
+
+
+__all__ = ['Lease', 'ShardQueue', 'open_queue', 'shard_of', 'worker_name']
+
+
+DEFAULT_SHARDS = 64
+
+# Seconds a lease lasts unless renewed (the holder renews it every third)
+DEFAULT_LEASE = 120.0
+
+
+def shard_of(record, shards):
+    """ Return shard (number from 0 to shards - 1) of the manifest record,
+    given by a hash of its reference ID or external ID (or line number
+    if it has neither), so that it does not depend on the other records.
+    """
+    if record.get('reference_id') is not None:
+        key = 'reference_id:%s' % record['reference_id']
+    elif record.get('external_id') is not None:
+        key = 'external_id:%s' % record['external_id']
+    else:
+        key = 'line:%s' % record['line']
+    return int(hashlib.md5(key).hexdigest()[:8], 16) % shards
+
+
+def worker_name():
+    """ Return name identifying this process among the workers. """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def open_queue(directory, manifest, shards = DEFAULT_SHARDS):
+    """ Open the queue stored in the directory, creating it from the
+    manifest (see bulk.read_manifest()) split into the shards if it does
+    not exist. Any number of workers may do so at once, only one of them
+    creates the queue.
+    Returns ShardQueue.
+    Raises exception:
+        - ValueError: Invalid manifest, the directory is not a queue or
+           the queue was created for another manifest or number of shards.
+    """
+    manifest = os.path.abspath(manifest)
+    if not os.path.exists(os.path.join(directory, 'queue.json')):
+        _create_queue(directory, manifest, shards)
+    queue = ShardQueue(directory)
+    if (queue.manifest != manifest) or (queue.shards != shards):
+        raise ValueError("Queue %s was created for %d shards of %s" % (directory, queue.shards, queue.manifest))
+    return queue
+
+
+class ShardQueue:
+    """ Manifest records split into shards processed by workers.
+
+    The queue is a directory (which may be on a filesystem shared by
+    several computers) with the records of every shard, the leases of the
+    shards being processed, the shards completed and a journal for every
+    shard. A worker claims a shard by creating its lease file, which it
+    keeps renewing while processing the shard. The lease of a killed
+    worker expires and the shard is claimed by another worker, which
+    skips the changes recorded as completed in the journal of the shard.
+    The clocks of the computers sharing the queue must be synchronized.
+    """
+
+    def __init__(self, directory):
+        """ Open the queue stored in the directory (see open_queue()). """
+        self.directory = directory
+        f = open(os.path.join(directory, 'queue.json'), 'rb')
+        try:
+            description = json.load(f)
+        finally:
+            f.close()
+        self.manifest = _native(description['manifest'])
+        self.shards = description['shards']
+        self.records = description['records']
+
+    def claim(self, worker, lease_seconds = DEFAULT_LEASE, skip = ()):
+        """ Claim a shard which is neither completed nor leased (or whose
+        lease expired), nor one of the shards in skip.
+        Returns Lease of the shard, None if there is no such shard.
+        """
+        completed = self._completed()
+        generations = self._lease_generations()
+        now = time.time()
+        # workers start looking at different shards to avoid collisions
+        offset = int(hashlib.md5(worker).hexdigest()[:8], 16)
+        for i in range(self.shards):
+            shard = (offset + i) % self.shards
+            if (shard in completed) or (shard in skip):
+                continue
+            generation = generations.get(shard)
+            if generation is not None:
+                try:
+                    if os.path.getmtime(self._lease_path(shard, generation)) + lease_seconds > now:
+                        continue
+                except OSError:
+                    # released or replaced meanwhile, look again next time
+                    continue
+                generation += 1
+            else:
+                generation = 0
+            # only one of the workers can create the next lease file
+            try:
+                fd = os.open(self._lease_path(shard, generation), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+            except OSError, e:
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+            os.write(fd, json.dumps({'worker': worker, 'claimed': now}, sort_keys=True) + '\n')
+            os.close(fd)
+            lease = Lease(self, shard, generation, worker, lease_seconds)
+            if os.path.exists(self._done_path(shard)):
+                # completed by the previous holder meanwhile
+                lease.release()
+                continue
+            for old in range(generation):
+                _remove(self._lease_path(shard, old))
+            return lease
+        return None
+
+    def finished(self, skip = ()):
+        """ Check whether all the shards except those in skip are completed. """
+        return len(self._completed() | set(skip)) == self.shards
+
+    def journal_path(self, shard):
+        """ Return name of the journal file of the shard. """
+        return os.path.join(self.directory, 'journals', '%04d.jsonl' % shard)
+
+    def read_records(self, shard):
+        """ Generate manifest records of the shard. """
+        f = open(os.path.join(self.directory, 'shards', '%04d.jsonl' % shard), 'rb')
+        try:
+            for line in f:
+                yield _native(json.loads(line))
+        finally:
+            f.close()
+
+    def status(self):
+        """ Return tuple (completed shards, failed records in them). """
+        completed = self._completed()
+        failed = 0
+        for shard in completed:
+            f = open(self._done_path(shard), 'rb')
+            try:
+                failed += json.load(f)['failed']
+            finally:
+                f.close()
+        return (len(completed), failed)
+
+    def _completed(self):
+        """ Return set of the completed shards. """
+        return set([int(name) for name in os.listdir(os.path.join(self.directory, 'done')) if name.isdigit()])
+
+    def _done_path(self, shard):
+        return os.path.join(self.directory, 'done', '%04d' % shard)
+
+    def _lease_generations(self):
+        """ Return dictionary mapping leased shards to the generation of
+        their latest lease.
+        """
+        generations = dict()
+        for name in os.listdir(os.path.join(self.directory, 'leases')):
+            (shard, _sep, generation) = name.partition('.')
+            if shard.isdigit() and generation.isdigit():
+                generations[int(shard)] = max(generations.get(int(shard), 0), int(generation))
+        return generations
+
+    def _lease_path(self, shard, generation):
+        return os.path.join(self.directory, 'leases', '%04d.%d' % (shard, generation))
+
+
+class Lease:
+    """ Claim of a worker to process a shard (see ShardQueue.claim()).
+
+    Attributes:
+       * shard: The leased shard.
+       * worker: Name of the worker holding the lease.
+       * lost: True once the lease expired and was claimed by another
+          worker (the worker should stop processing the shard).
+    """
+
+    def __init__(self, queue, shard, generation, worker, lease_seconds):
+        self.queue = queue
+        self.shard = shard
+        self.generation = generation
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._path = queue._lease_path(shard, generation)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def complete(self, records, failed):
+        """ Record the shard as completed after processing the records
+        (failed of them failed) and release the lease.
+        """
+        done_path = self.queue._done_path(self.shard)
+        temp_path = '%s.%s.tmp' % (done_path, self.generation)
+        f = open(temp_path, 'wb')
+        try:
+            f.write(json.dumps({'worker': self.worker, 'records': records, 'failed': failed,
+                'completed': time.time()}, sort_keys=True) + '\n')
+        finally:
+            f.close()
+        os.rename(temp_path, done_path)
+        self._stop_renewing()
+        _remove(self._path)
+
+    def keep_alive(self):
+        """ Renew the lease in the background until it is released. """
+        def renew():
+            while True:
+                self._stop.wait(self.lease_seconds / 3.0)
+                if self._stop.isSet() or not self.renew():
+                    return
+        self._thread = threading.Thread(target=renew)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def release(self):
+        """ Give up the lease (another worker may claim the shard). """
+        self._stop_renewing()
+        if not self.lost:
+            # expire the lease rather than removing it, the next lease of
+            # the shard must have a higher generation than this one
+            try:
+                os.utime(self._path, (0, 0))
+            except OSError:
+                pass
+
+    def renew(self):
+        """ Extend the lease.
+        Returns False if the lease was lost.
+        """
+        if os.path.exists(self.queue._lease_path(self.shard, self.generation + 1)):
+            self.lost = True
+            return False
+        try:
+            os.utime(self._path, None)
+        except OSError:
+            self.lost = True
+            return False
+        return True
+
+    def _stop_renewing(self):
+        """ Stop the renewal started by keep_alive(). """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _create_queue(directory, manifest, shards):
+    """ Split the manifest records into the shards of a new queue in the
+    directory (unless another worker creates it first).
+    """
+    temp_directory = '%s.%s.tmp' % (directory.rstrip(os.sep), worker_name())
+    for name in ['shards', 'leases', 'done', 'journals']:
+        os.makedirs(os.path.join(temp_directory, name))
+    try:
+        files = [open(os.path.join(temp_directory, 'shards', '%04d.jsonl' % shard), 'wb') for shard in range(shards)]
+        records = 0
+        try:
+            # invalid records fail when processed, like in a single process
+            for record in read_manifest(manifest, True):
+                files[shard_of(record, shards)].write(json.dumps(record, sort_keys=True) + '\n')
+                records += 1
+        finally:
+            for f in files:
+                f.close()
+        f = open(os.path.join(temp_directory, 'queue.json'), 'wb')
+        try:
+            f.write(json.dumps({'manifest': manifest, 'shards': shards, 'records': records}, sort_keys=True) + '\n')
+        finally:
+            f.close()
+        try:
+            # the complete queue appears at once
+            os.rename(temp_directory, directory)
+        except OSError, e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            # created by another worker meanwhile (open_queue() checks it
+            # is the same queue), or a directory with other content
+            if not os.path.exists(os.path.join(directory, 'queue.json')):
+                raise ValueError("Directory %s exists and is not a shard queue" % directory)
+    finally:
+        if os.path.exists(temp_directory):
+            shutil.rmtree(temp_directory)
+
+
+def _native(value):
+    """ Convert strings loaded from JSON to UTF-8 encoded str. """
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    if isinstance(value, list):
+        return [_native(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_native(key), _native(item)) for (key, item) in value.items())
+    return value
+
+
+def _remove(path):
+    """ Remove the file if it exists. """
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
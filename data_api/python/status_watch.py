@@ -0,0 +1,229 @@
+"""
+Tracking of image activation in kooaba Data API.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from ratelimit import TokenBucket
+import heapq
+import random
+import sys
+import threading
+import time
+
+# Python 2 vs 3
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+__all__ = ['ImageStatusWatcher', 'StatusTransition', 'wait_until_active']
+
+
+ACTIVE = 'ACTIVE'
+
+# Polling intervals (initial, maximum) in seconds for the image states. The
+# interval grows by BACKOFF_FACTOR with every poll not showing a change and
+# is reset when the image changes its state.
+POLL_INTERVALS = {
+    'INACTIVE': (60.0, 600.0),
+    'ACTIVATION_QUEUED': (30.0, 300.0),
+    'ACTIVATING': (5.0, 60.0),
+    'DEACTIVATION_QUEUED': (60.0, 600.0),
+}
+DEFAULT_POLL_INTERVAL = (30.0, 300.0)
+ERROR_POLL_INTERVAL = (10.0, 300.0)
+BACKOFF_FACTOR = 1.5
+
+# Images failing this many polls in a row are not tracked any further
+MAX_CONSECUTIVE_ERRORS = 5
+
+
+class StatusTransition:
+    """ Change of image status observed while tracking.
+
+    Attributes:
+       * image_id: ID of the image.
+       * old_status: Previously observed status (None for the first poll).
+       * new_status: Current status (None if the poll failed).
+       * elapsed: Seconds since the tracking started.
+       * error: Exception raised by the poll (None if successful).
+    """
+
+    def __init__(self, image_id, old_status, new_status, elapsed, error = None):
+        self.image_id = image_id
+        self.old_status = old_status
+        self.new_status = new_status
+        self.elapsed = elapsed
+        self.error = error
+
+
+class ImageStatusWatcher:
+    """ Tracks status of many images until they become ACTIVE.
+
+    The images are polled concurrently by a pool of worker threads. All
+    polls share one request rate budget (max_rate requests per second) and
+    each image is polled with an interval adapted to its current status
+    (see POLL_INTERVALS).
+    """
+
+    def __init__(self, client, workers = 8, max_rate = 10.0, poll_intervals = None):
+        """ Initialize watcher polling via the client (BasicDataUploadClient). """
+        self.client = client
+        self.workers = workers
+        self.rate_limiter = TokenBucket(max_rate)
+        if poll_intervals is None:
+            poll_intervals = POLL_INTERVALS
+        self.poll_intervals = poll_intervals
+        self.pending = dict()
+        self.failed = dict()
+
+    def watch(self, image_ids, timeout = None):
+        """ Track the images until all of them are ACTIVE, or until timeout
+        seconds elapse (None means no timeout).
+        Generates StatusTransition for every observed change of image status
+        and for every failed poll.
+        After the generator finishes, the pending attribute maps images not
+        active to their last known status, and the failed attribute maps
+        images abandoned after repeated errors to the last error.
+        """
+        started = time.time()
+        deadline = None
+        if timeout is not None:
+            deadline = started + timeout
+        self.pending = dict()
+        self.failed = dict()
+        schedule = []
+        intervals = dict()
+        errors = dict()
+        for image_id in image_ids:
+            if image_id not in self.pending:
+                self.pending[image_id] = None
+                heapq.heappush(schedule, (started, image_id))
+        tasks = queue.Queue()
+        results = queue.Queue()
+        threads = [threading.Thread(target=self._poll, args=(tasks, results)) for _i in range(self.workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        in_flight = 0
+        try:
+            while schedule or (in_flight > 0):
+                now = time.time()
+                if (deadline is not None) and (now >= deadline):
+                    break
+                # keep the queue short, so that the polls happen on time
+                while schedule and (schedule[0][0] <= now) and (in_flight < 2 * self.workers):
+                    (_due, image_id) = heapq.heappop(schedule)
+                    tasks.put(image_id)
+                    in_flight += 1
+                wait = None
+                if schedule and (in_flight < 2 * self.workers):
+                    wait = max(0.0, schedule[0][0] - now)
+                if (deadline is not None) and ((wait is None) or (wait > deadline - now)):
+                    wait = deadline - now
+                try:
+                    (image_id, status, error) = results.get(True, wait)
+                except queue.Empty:
+                    continue
+                in_flight -= 1
+                now = time.time()
+                old_status = self.pending[image_id]
+                if error is not None:
+                    errors[image_id] = errors.get(image_id, 0) + 1
+                    yield StatusTransition(image_id, old_status, None, now - started, error)
+                    if errors[image_id] >= MAX_CONSECUTIVE_ERRORS:
+                        self.failed[image_id] = error
+                        continue
+                    interval = self._next_interval(intervals, image_id, ERROR_POLL_INTERVAL, False)
+                else:
+                    errors.pop(image_id, None)
+                    changed = (status != old_status)
+                    if changed:
+                        self.pending[image_id] = status
+                        yield StatusTransition(image_id, old_status, status, now - started)
+                    if status == ACTIVE:
+                        del self.pending[image_id]
+                        continue
+                    limits = self.poll_intervals.get(status, DEFAULT_POLL_INTERVAL)
+                    interval = self._next_interval(intervals, image_id, limits, changed)
+                # spread the polls of images in the same state
+                heapq.heappush(schedule, (now + interval * random.uniform(0.9, 1.1), image_id))
+        finally:
+            # drop polls not started yet and stop the workers
+            try:
+                while True:
+                    tasks.get_nowait()
+            except queue.Empty:
+                pass
+            for _thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+
+    def _next_interval(self, intervals, image_id, limits, reset):
+        """ Return polling interval of the image adapted to its state. """
+        (initial, maximum) = limits
+        previous = intervals.get(image_id)
+        if reset or (previous is None):
+            interval = initial
+        else:
+            interval = min(maximum, max(initial, previous * BACKOFF_FACTOR))
+        intervals[image_id] = interval
+        return interval
+
+    def _poll(self, tasks, results):
+        """ Worker thread polling image status. """
+        while True:
+            image_id = tasks.get()
+            if image_id is None:
+                return
+            self.rate_limiter.acquire()
+            try:
+                results.put((image_id, self.client.get_image_status(image_id), None))
+            except Exception:
+                results.put((image_id, None, sys.exc_info()[1]))
+
+
+def wait_until_active(client, image_ids, timeout = None, workers = 8, max_rate = 10.0):
+    """ Wait until all the images are ACTIVE (or until timeout seconds
+    elapse, None means no timeout).
+    Returns dictionary mapping the images which are not active to their
+    last known status (None if it could not be retrieved), so the result
+    is empty when all the images are active.
+    """
+    watcher = ImageStatusWatcher(client, workers, max_rate)
+    for _transition in watcher.watch(image_ids, timeout):
+        pass
+    not_active = dict(watcher.pending)
+    for image_id in watcher.failed.keys():
+        not_active.setdefault(image_id, None)
+    return not_active
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,443 @@
+"""
+Incremental synchronization of a local catalog with a kooaba group.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from bulk import EXTRAS_FIELDS
+from models import Item, parse_records
+from workers import imap_unordered
+import hashlib
+import os
+import threading
+
+try:
+    # Python 2.6 and newer
+    import json
+except ImportError:
+    # Python 2.5
+    import simplejson as json
+
+
+__all__ = ['CatalogSync', 'SyncResult', 'index_group_items', 'parse_group_items', 'record_key']
+
+
+# Actions performed for the synchronized items
+CREATED = 'created'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+DELETED = 'deleted'
+FAILED = 'failed'
+
+# Number of synchronized records between saves of the state file
+STATE_SAVE_INTERVAL = 100
+
+
+class SyncResult:
+    """ Outcome of synchronizing one item.
+
+    Attributes:
+       * key: Key matching the manifest record to the item in the group.
+       * record: The manifest record (None for deleted items).
+       * action: One of CREATED, UPDATED, UNCHANGED, DELETED or FAILED.
+       * item_id: ID of the item (None if it could not be created).
+       * requests: Number of API calls made for the item.
+       * error: Exception which stopped the synchronization (FAILED only).
+    """
+
+    def __init__(self, key, record, action, item_id = None, requests = 0, error = None):
+        self.key = key
+        self.record = record
+        self.action = action
+        self.item_id = item_id
+        self.requests = requests
+        self.error = error
+
+
+class CatalogSync:
+    """ Synchronizes manifest records with items of a group.
+
+    Manifest records (see bulk.read_manifest()) are matched to the items
+    of the group by their reference_id (or external_id when there is no
+    reference ID). The items in the group are fetched only once. Only the
+    differences are uploaded:
+       * items missing in the group are created,
+       * item metadata (title, extras, medium type and medium metadata) are
+          updated when changed since the last synchronization,
+       * images are matched by SHA-1 hash of the image files, new images
+          are added and images no longer listed are deleted (images of the
+          group are identified by their IDs, their hashes are taken from
+          the state file or requested from the server; an image whose hash
+          is unknown is never deleted),
+       * resources not added yet are added (resources are never removed;
+          the resources of items not synchronized before are requested
+          from the server, so those added otherwise are not added again).
+    Items of the group with a key not present in the manifest are deleted
+    if requested.
+
+    What was pushed is recorded in a local JSON state file, so unchanged
+    items do not cost any API call.
+    """
+
+    def __init__(self, client, group_id, state_filename, workers = 4, activate_images = True, delete_missing = False):
+        """ Initialize synchronization of the group using the client
+        (BasicDataUploadClient).
+        """
+        self.client = client
+        self.group_id = group_id
+        self.state_filename = state_filename
+        self.workers = workers
+        self.activate_images = activate_images
+        self.delete_missing = delete_missing
+        self._lock = threading.Lock()
+        self._state = None
+        self._server_items = None
+        self._server_ids = None
+        self._seen = None
+        self._matched_ids = None
+
+    def run(self, records):
+        """ Synchronize the group with the records (iterable of manifest
+        records).
+        Generates SyncResult for every record (and every deleted item) in
+        the order of completion.
+        """
+        self._state = self._load_state()
+        self._server_items = index_group_items(self.client.iter_group_items(self.group_id))
+        self._server_ids = dict()
+        for server_item in self._server_items.values():
+            self._server_ids[server_item['item_id']] = server_item
+        self._seen = set()
+        self._matched_ids = set()
+        processed = 0
+        try:
+            for (_record, result, _error) in imap_unordered(self._sync_record, records, self.workers):
+                processed += 1
+                if processed % STATE_SAVE_INTERVAL == 0:
+                    self._save_state()
+                yield result
+            if self.delete_missing:
+                for (_missing, result, _error) in imap_unordered(self._delete_item, self._missing_items(), self.workers):
+                    yield result
+        finally:
+            self._save_state()
+
+    def _current_images(self, server_item, entry, requests):
+        """ Return images of the existing item as dictionary mapping image
+        hashes to image IDs. Hashes of images not pushed by earlier
+        synchronizations (nor given by the group listing) are requested from
+        the server; images whose hash cannot be found out are left out.
+        """
+        pushed = dict()
+        for (sha1, image_id) in entry.get('images', dict()).items():
+            pushed.setdefault(image_id, list()).append(sha1)
+        images = dict()
+        for (image_id, sha1) in server_item['images'].items():
+            if (sha1 is None) and (image_id not in pushed):
+                try:
+                    sha1 = self._call(requests, self.client.get_image_record, image_id).file_sha1
+                except Exception:
+                    # kept, as it cannot be told whether it is still listed
+                    sha1 = None
+            if sha1 is not None:
+                images[sha1] = image_id
+            # the server hash differs from the hash of the pushed file when
+            # the image is modified by the server or preprocessed before upload
+            for pushed_sha1 in pushed.get(image_id, list()):
+                images[pushed_sha1] = image_id
+        return images
+
+    def _delete_item(self, missing):
+        """ Delete the item which is not in the manifest. Returns SyncResult. """
+        (key, item_id) = missing
+        try:
+            self.client.delete_item(item_id)
+        except Exception, e:
+            return SyncResult(key, None, FAILED, item_id, 1, e)
+        with self._lock:
+            self._state['items'].pop(key, None)
+        return SyncResult(key, None, DELETED, item_id, 1)
+
+    def _file_sha1(self, filename):
+        """ Return SHA-1 hash of the file content.
+        The hashes are remembered in the state together with file size and
+        modification time, so unchanged files are not read again.
+        """
+        stat = os.stat(filename)
+        with self._lock:
+            known = self._state['files'].get(filename)
+        if (known is not None) and (known[0] == stat.st_size) and (known[1] == stat.st_mtime):
+            return known[2]
+        h = hashlib.sha1()
+        f = open(filename, 'rb')
+        try:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                h.update(chunk)
+        finally:
+            f.close()
+        sha1 = h.hexdigest()
+        with self._lock:
+            self._state['files'][filename] = [stat.st_size, stat.st_mtime, sha1]
+        return sha1
+
+    def _missing_items(self):
+        """ Return items of the group not present in the manifest as list
+        of tuples (key, item_id). Items without reference ID and external ID
+        are considered missing only if they were pushed by earlier
+        synchronizations.
+        """
+        missing = dict()
+        for (key, server_item) in self._server_items.items():
+            if (key not in self._seen) and (not key.startswith('id:')):
+                missing[server_item['item_id']] = key
+        for (key, entry) in self._state['items'].items():
+            if (key not in self._seen) and (entry.get('item_id') in self._server_ids):
+                missing[entry['item_id']] = key
+        return [(key, item_id) for (item_id, key) in missing.items() if item_id not in self._matched_ids]
+
+    def _load_state(self):
+        """ Load the state file (empty state if there is no such file). """
+        state = {'group_id': self.group_id, 'items': dict(), 'files': dict()}
+        if os.path.exists(self.state_filename):
+            f = open(self.state_filename, 'rb')
+            try:
+                loaded = json.load(f)
+            finally:
+                f.close()
+            if str(loaded.get('group_id')) != str(self.group_id):
+                raise ValueError("State file %s belongs to group %s" % (self.state_filename, loaded.get('group_id')))
+            for (key, entry) in loaded.get('items', dict()).items():
+                state['items'][_text(key)] = entry
+            for (filename, known) in loaded.get('files', dict()).items():
+                state['files'][_text(filename)] = known
+        return state
+
+    def _save_state(self):
+        """ Write the state file (atomically replacing the previous one). """
+        with self._lock:
+            serialized = json.dumps(self._state, sort_keys=True)
+        temporary = self.state_filename + '.tmp'
+        f = open(temporary, 'wb')
+        try:
+            f.write(serialized)
+        finally:
+            f.close()
+        try:
+            os.rename(temporary, self.state_filename)
+        except OSError:
+            # Windows does not replace existing files
+            os.remove(self.state_filename)
+            os.rename(temporary, self.state_filename)
+
+    def _sync_record(self, record):
+        """ Synchronize item described by the record. Returns SyncResult. """
+        key = None
+        item_id = None
+        requests = [0]
+        lookups = 0
+        entry = dict()
+        try:
+            key = record_key(record)
+            with self._lock:
+                if key in self._seen:
+                    raise ValueError("Duplicate item %s (line %s)" % (key, record['line']))
+                self._seen.add(key)
+                entry = dict(self._state['items'].get(key, dict()))
+            metadata_hash = _hash_of([record['title'], record['medium_type'], record['metadata']] +
+                    [record[name] for name in EXTRAS_FIELDS])
+            image_hashes = [self._file_sha1(filename) for filename in record['images']]
+            resource_hashes = [_hash_of(resource) for resource in record['resources']]
+
+            server_item = self._server_items.get(key)
+            if (server_item is None) and (entry.get('item_id') in self._server_ids):
+                server_item = self._server_ids[entry['item_id']]
+            if server_item is not None:
+                with self._lock:
+                    self._matched_ids.add(server_item['item_id'])
+            if server_item is None:
+                action = CREATED
+                entry = {'images': dict(), 'resources': list()}
+                extras = dict()
+                for name in EXTRAS_FIELDS:
+                    extras[name] = record[name]
+                item_id = self._call(requests, self.client.create_item, self.group_id, record['title'], extras)
+                entry['item_id'] = item_id
+                current_images = dict()
+            else:
+                action = UNCHANGED
+                item_id = server_item['item_id']
+                entry['item_id'] = item_id
+                current_images = self._current_images(server_item, entry, requests)
+                if ('resources' not in entry) and record['resources']:
+                    # e.g. created by --bulk, adopt the resources it already has
+                    listed = self._call(requests, self.client.get_item_resource_records, item_id)
+                    entry['resources'] = [resource_hash for (resource, resource_hash) in zip(record['resources'], resource_hashes)
+                            if _is_listed(resource, listed)]
+                # reading the image hashes and resources changes nothing
+                lookups = requests[0]
+                if entry.get('metadata') != metadata_hash:
+                    action = UPDATED
+                    extras = {'title': record['title']}
+                    for name in EXTRAS_FIELDS:
+                        extras[name] = record[name]
+                    self._call(requests, self.client.update_item, item_id, extras)
+            if (action == CREATED) or (entry.get('metadata') != metadata_hash):
+                if record['medium_type'] is not None:
+                    self._call(requests, self.client.change_item_medium_type, item_id, record['medium_type'], record['title'], record['metadata'])
+                entry['metadata'] = metadata_hash
+
+            # images
+            images = dict()
+            for (filename, sha1) in zip(record['images'], image_hashes):
+                if sha1 in images:
+                    continue
+                if sha1 in current_images:
+                    images[sha1] = current_images[sha1]
+                    continue
+                upload_id = self._call(requests, self.client.upload_from_file, filename)
+                image_id = self._call(requests, self.client.create_image_from_upload, item_id, upload_id)
+                images[sha1] = image_id
+                entry['images'] = dict(images)
+                if self.activate_images:
+                    self._call(requests, self.client.activate_image, image_id)
+            kept = set(images.values())
+            for image_id in set(current_images.values()):
+                if image_id not in kept:
+                    self._call(requests, self.client.delete_image, image_id)
+            entry['images'] = images
+
+            # resources
+            pushed = list(entry.get('resources', list()))
+            for (resource, resource_hash) in zip(record['resources'], resource_hashes):
+                if resource_hash in pushed:
+                    continue
+                if resource['file'] is not None:
+                    self._call(requests, self.client.add_resource_file, item_id, resource['title'], resource['section'], resource['file'])
+                else:
+                    self._call(requests, self.client.add_resource_uri, item_id, resource['title'], resource['section'], resource['uri'])
+                pushed.append(resource_hash)
+                entry['resources'] = list(pushed)
+            entry['resources'] = pushed
+
+            if (action == UNCHANGED) and (requests[0] > lookups):
+                action = UPDATED
+            return SyncResult(key, record, action, item_id, requests[0])
+        except Exception, e:
+            return SyncResult(key, record, FAILED, item_id, requests[0], e)
+        finally:
+            if (key is not None) and ('item_id' in entry):
+                with self._lock:
+                    self._state['items'][key] = entry
+
+    def _call(self, requests, method, *args):
+        """ Call client method counting the API calls made. """
+        requests[0] += 1
+        return method(*args)
+
+
+def index_group_items(items):
+    """ Index items of a group (iterable of Item, as generated by
+    iter_group_items()).
+    Returns dictionary mapping item keys (see record_key()) to dictionaries
+    with entries item_id and images (dictionary mapping image IDs to SHA-1
+    hashes of the image files, None unless the listing includes them).
+    Items without reference ID and external ID are listed under key
+    'id:ITEM_ID'.
+    """
+    index = dict()
+    for item in items:
+        element = item.element
+        item_id = element.findtext('id')
+        images = dict()
+        for image in element.findall('images/image'):
+            images[image.findtext('id')] = image.findtext('file-sha1') or None
+        key = _key_of(element.findtext('reference-id'), element.findtext('external-id'))
+        if key is None:
+            key = 'id:%s' % item_id
+        index[key] = {'item_id': item_id, 'images': images}
+    return index
+
+
+def parse_group_items(xml_string):
+    """ Parse listing of group items (as returned by get_group_items()),
+    see index_group_items().
+    """
+    return index_group_items(parse_records(xml_string, Item))
+
+
+def record_key(record):
+    """ Return key matching manifest record with an item in the group.
+    Raises exception:
+        - ValueError: The record has no reference_id nor external_id.
+    """
+    key = _key_of(record['reference_id'], record['external_id'])
+    if key is None:
+        raise ValueError("Item on line %s has no reference_id nor external_id" % record['line'])
+    return key
+
+
+def _hash_of(value):
+    """ Return SHA-1 hash of JSON serializable value. """
+    return hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+
+
+def _is_listed(resource, listed):
+    """ Check whether the manifest resource is among the listed resources
+    of the item (list of Resource). The section and URI are compared only
+    if the server lists them.
+    """
+    for candidate in listed:
+        if _text(candidate.title or '') != resource['title']:
+            continue
+        if (candidate.section is not None) and (_text(candidate.section) != resource['section']):
+            continue
+        if (resource['uri'] is not None) and (candidate.uri is not None) and (_text(candidate.uri) != resource['uri']):
+            continue
+        return True
+    return False
+
+
+def _key_of(reference_id, external_id):
+    """ Return item key for given IDs, None if both IDs are empty. """
+    if (reference_id is not None) and (reference_id != ''):
+        return 'reference_id:%s' % _text(reference_id)
+    if (external_id is not None) and (external_id != ''):
+        return 'external_id:%s' % _text(external_id)
+    return None
+
+
+def _text(value):
+    """ Convert value to UTF-8 encoded str. """
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    return str(value)
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,143 @@
+"""
+Tests of the request documents built by request_xml against ElementTree.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import unittest
+import xml.etree.ElementTree as ET
+from io import BytesIO
+
+import request_xml
+
+
+# Texts covering the escaping and encoding of the request documents
+XML_TEXTS = ['Benchmark item', '', '0', 'a & b <c> "d" \'e\' ]]>', ' \t\r\n ', b'Z\xc3\xbcrich',
+        u'\u65e5\u672c', u'\U0001f600', '&amp;', 12345]
+
+
+def etree_element(root, name, text):
+    """ Add a text sub-element to root the way the clients did before
+    using request_xml.
+    """
+    elem = ET.SubElement(root, name)
+    if isinstance(text, bytes):
+        text = text.decode('UTF-8')
+    elif not isinstance(text, type(u'')):
+        text = u'%s' % text
+    elem.text = text
+    return elem
+
+
+def etree_serialize(root):
+    """ Serialize ElementTree document the way the clients did before
+    using request_xml.
+    """
+    buf = BytesIO()
+    ET.ElementTree(root).write(buf, encoding="UTF-8", xml_declaration=True, method="xml")
+    return buf.getvalue()
+
+
+def etree_image_xml(upload_id):
+    xml = ET.Element("image")
+    etree_element(ET.SubElement(xml, "file"), "upload-id", upload_id)
+    return etree_serialize(xml)
+
+
+def etree_item_xml(extras, title = None):
+    xml = ET.Element("item")
+    if title is not None:
+        etree_element(xml, "title", title)
+    for (key, value) in extras.items():
+        if value is not None:
+            etree_element(xml, key, value)
+    return etree_serialize(xml)
+
+
+def etree_medium_xml(medium_type, title, metadata):
+    xml = ET.Element("medium")
+    if (medium_type is not None) and (medium_type != ""):
+        etree_element(xml, "type", 'Medium::'+medium_type)
+        etree_element(xml, "title", title)
+        for (key, value) in metadata.items():
+            etree_element(xml, key, value)
+    return etree_serialize(xml)
+
+
+def etree_resource_file_xml(title, section, upload_id):
+    xml = ET.Element("resource")
+    etree_element(xml, "title", title)
+    etree_element(xml, "section", section)
+    etree_element(ET.SubElement(xml, "file"), "upload_id", upload_id)
+    return etree_serialize(xml)
+
+
+def etree_resource_uri_xml(title, section, uri):
+    xml = ET.Element("resource")
+    etree_element(xml, "title", title)
+    etree_element(xml, "section", section)
+    etree_element(xml, "uri", uri)
+    return etree_serialize(xml)
+
+
+def etree_status_xml(name):
+    xml = ET.Element("status")
+    etree_element(xml, "name", name)
+    return etree_serialize(xml)
+
+
+def xml_cases():
+    """ Generate tuples (name, arguments) of request documents to compare. """
+    for text in XML_TEXTS:
+        yield ('image_xml', (text,))
+        yield ('item_xml', ({'reference_id': text, 'external_id': None, 'locale': 'en'}, text))
+        yield ('item_xml', ({'title': text},))
+        yield ('medium_xml', ('Book', text, {'author': text, 'isbn': '0-00-000000-0'}))
+        yield ('resource_file_xml', (text, text, '4f2a'))
+        yield ('resource_uri_xml', ('Shop', text, text))
+        yield ('status_xml', (text,))
+    yield ('item_xml', (dict(),))
+    yield ('medium_xml', (None, 'Title', dict()))
+    yield ('medium_xml', ('', 'Title', {'author': 'A'}))
+
+
+class RequestXMLTest(unittest.TestCase):
+    """ The documents built by request_xml must be byte-identical to the
+    ElementTree output the clients sent before.
+    """
+
+    def test_matches_etree(self):
+        for (name, arguments) in xml_cases():
+            expected = globals()['etree_' + name](*arguments)
+            actual = getattr(request_xml, name)(*arguments)
+            self.assertEqual(actual, expected, "%s%r: %r != %r" % (name, arguments, actual, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,92 @@
+"""
+Persistent cache of upload IDs keyed by content hash.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import sqlite3
+import threading
+import time
+
+
+__all__ = ['UploadCache']
+
+
+# Uploads not assigned to an image or a resource are removed by the server
+# an hour after the upload, cached upload IDs must expire well before that
+# (the upload ID may be used some time after it is found in the cache).
+DEFAULT_TTL = 3000
+
+
+class UploadCache:
+    """ Persistent cache mapping uploaded content to the upload ID.
+
+    The entries are keyed by the MD5 hash and the size of the content and
+    expire ttl seconds after the upload. The cache is stored in a SQLite
+    database, so it can be shared by threads as well as by processes.
+    """
+
+    def __init__(self, filename, ttl = DEFAULT_TTL):
+        """ Open (or create) cache stored in the file filename. """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS uploads ("
+                    "content_md5 TEXT NOT NULL, size INTEGER NOT NULL, upload_id TEXT NOT NULL, "
+                    "uploaded_at REAL NOT NULL, PRIMARY KEY (content_md5, size))")
+            self._db.commit()
+
+    def close(self):
+        """ Close the cache database. """
+        with self._lock:
+            self._db.close()
+
+    def lookup(self, content_md5, size):
+        """ Return cached upload ID of the content, None if there is none. """
+        with self._lock:
+            row = self._db.execute("SELECT upload_id FROM uploads WHERE content_md5 = ? AND size = ? AND uploaded_at > ?",
+                    (content_md5, size, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def purge(self):
+        """ Remove expired entries from the cache. """
+        with self._lock:
+            self._db.execute("DELETE FROM uploads WHERE uploaded_at <= ?", (time.time() - self.ttl,))
+            self._db.commit()
+
+    def store(self, content_md5, size, upload_id):
+        """ Remember upload ID of the content. """
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO uploads (content_md5, size, upload_id, uploaded_at) VALUES (?, ?, ?, ?)",
+                    (content_md5, size, upload_id, time.time()))
+            self._db.commit()
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -28,14 +28,29 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
-from KWS import KWSSigner
+from KWS import KWSSigner, compute_md5_hex, compute_md5_hex_stream
+from connection_pool import DEFAULT_TIMEOUT, HTTPConnectionPool, PooledResponse, STALE_CONNECTION_ERRORS
+from instrument import RequestInfo
+from models import Group, Image, Item, Resource, iter_records, parse_records, parse_xml
+from ratelimit import endpoint_of
+from request_xml import image_xml, item_xml, medium_xml, resource_file_xml, resource_uri_xml, status_xml
+from retry import IDEMPOTENT_METHODS, RetryPolicy
+from upload_cache import DEFAULT_TTL
+from workers import imap_prefetch, imap_unordered
 from StringIO import StringIO
 from textwrap import dedent
+from urllib import urlencode
 from urlparse import urlparse
 import email.utils
 import httplib
 import mimetypes
+import optparse
 import os
+import shlex
+import socket
+import stat
+import sys
+import time
 import xml.etree.ElementTree as ET
 
 VERSION = '1.1.0'
@@ -45,22 +60,88 @@ VERSION = '1.1.0'
 QUERY_ENDPOINT = 'http://my.kooaba.com'
 RESULTS_LIMIT  = 1
 
+# Retry policy shared by the clients by default
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+# Actions changing many items or images: (client method, what is changed,
+# past participle of the change)
+BULK_CHANGES = {
+        'activate-images': ('activate_images', 'images', 'activated'),
+        'deactivate-images': ('deactivate_images', 'images', 'deactivated'),
+        'delete-images': ('delete_images', 'images', 'deleted'),
+        'delete-items': ('delete_items', 'items', 'deleted'),
+        }
+
+# Options configuring the client, given once for all the commands run by
+# --batch or --daemon
+GLOBAL_OPTIONS = ('batch', 'batch_workers', 'daemon', 'debug', 'endpoint', 'jpeg_quality',
+        'journal', 'max_dimension', 'metadata_cache', 'metadata_cache_ttl', 'metrics',
+        'preprocess_cache', 'rate_limit', 'rate_limit_dir', 'request_log', 'resume',
+        'retries', 'socket_timeout', 'upload_cache', 'upload_cache_ttl')
+
+# Options reading standard input when given '-'
+STDIN_OPTIONS = ('activate_images', 'deactivate_images', 'delete_images', 'delete_items', 'wait_until_active')
+
+
+class APIError(RuntimeError):
+    """ API call returned an error status.
+
+    Attributes:
+       * status: HTTP status code of the response.
+       * reason: HTTP reason phrase of the response.
+       * body: Body of the response (usually XML with error messages).
+       * retry_after: Seconds to wait before retrying as requested by the
+          server (None if not specified).
+    """
+
+    def __init__(self, status, reason, body, retry_after = None):
+        RuntimeError.__init__(self, "API call returned status %s %s. Message: %s" % (status, reason, body))
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.retry_after = None
+        if retry_after is not None:
+            try:
+                self.retry_after = int(retry_after)
+            except ValueError:
+                # HTTP date is not used by the API
+                pass
+
 
 class BasicDataUploadClient:
     """ Client for kooaba Data Upload API. """
 
-    def __init__(self, access_key, secret_key, endpoint = None):
+    def __init__(self, access_key, secret_key, endpoint = None, connection_pool = None, retry_policy = DEFAULT_RETRY_POLICY):
         """ Initialize client for given query endpoint.
         None as endpoint means default endpoint.
+        The client keeps its connections to the API server open for reuse
+        in the connection_pool (HTTPConnectionPool). None as connection_pool
+        means a new pool used only by this client.
+        Failed requests are retried according to the retry_policy
+        (RetryPolicy), None disables retrying. By default, all the clients
+        share one policy and its retry budget.
         """
         self.access_key = access_key
-        self.kws = KWSSigner(secret_key)
+        self.kws = KWSSigner(secret_key, memoize=True)
         api_path = '/api'
         if endpoint is not None:
             self.api_url = endpoint+api_path
         else:
             self.api_url = QUERY_ENDPOINT+api_path
+        # documents of other accounts or servers must not be served from the metadata cache
+        self._cache_scope = '%s %s' % (access_key, self.api_url)
+        if connection_pool is None:
+            connection_pool = HTTPConnectionPool()
+        self.connection_pool = connection_pool
         self.debugging = False
+        self.debug_out = None
+        self.upload_cache = None
+        self.journal = None
+        self.metadata_cache = None
+        self.preprocessor = None
+        self.rate_limiter = None
+        self.retry_policy = retry_policy
+        self.request_hooks = list()
 
     def activate_image(self, image_id):
         """ Activate the image.
@@ -68,23 +149,71 @@ class BasicDataUploadClient:
         """
         return self._set_image_status(image_id, 'ACTIVE')
 
+    def activate_images(self, image_ids, workers = 4):
+        """ Activate the images, up to workers of them at once.
+        Generates tuples (image ID, current status of the image, error) in
+        the order of completion. The error is the exception which stopped
+        the activation (the status is None then) or None.
+        """
+        return imap_unordered(self.activate_image, image_ids, workers)
+
+    def add_images(self, item_id, filenames, activate = True, workers = 4, pool = None):
+        """ Add images from files to the item.
+        Each file is uploaded, added to the item and activated (unless
+        activate is False) independently of the others, up to workers
+        files at once. The images can thus be created in a different order
+        than the files are given, except with one worker. The files are
+        preprocessed and hashed ahead by the threads of upload_files().
+        With pool (workers.WorkerPool shared e.g. by the items of a bulk
+        run), the files are processed on its threads instead of threads
+        started for this call, each file being hashed just before upload.
+        Generates tuples (filename, image ID, error) in the order of
+        completion. The image ID is None if the image was not created, the
+        error is the exception which stopped processing of the file or None.
+        """
+        if pool is not None:
+            def add_file(filename):
+                return self._add_image(item_id, self._prepare_and_hash(filename, None), activate)
+            results = pool.imap_unordered(add_file, filenames, workers)
+        else:
+            def add_image(prepared):
+                (_filename, prepared_file, error) = prepared
+                if error is not None:
+                    raise error
+                return self._add_image(item_id, prepared_file, activate)
+            results = imap_unordered(add_image, self._prepare_files(filenames, None, 2, workers), workers)
+        for (argument, result, error) in results:
+            if pool is None:
+                argument = argument[0]
+            if error is not None:
+                yield (argument, None, error)
+            else:
+                yield (argument, result[0], result[1])
+
+    def add_request_hooks(self, hooks):
+        """ Call the hooks (instrument.RequestHooks) for every request
+        attempt made by the client.
+        """
+        self.request_hooks.append(hooks)
+
     def add_resource_file(self, item_id, title, section, filename):
         """ Add a file resource to an item.
         Raises exception on error.
         """
-        upload_id = self.upload_from_file(filename)
-        xml = self._generate_basic_resource_xml(title, section)
-        file_elem = ET.SubElement(xml, "file")
-        self._add_xml_subelement(file_elem, "upload_id", upload_id)
-        (_response, _body) = self._post_data("/items/%s/item_resources.xml" % item_id, self._serialize_xml(xml), 'application/xml')
+        upload_id = self._upload_file(filename, None)
+        data = resource_file_xml(title, section, upload_id)
+        def add():
+            (_response, _body) = self._post_data("/items/%s/item_resources.xml" % item_id, data, 'application/xml')
+        self._journaled('add_resource', [item_id, title, section, 'file', self._upload_content(upload_id)], add)
 
     def add_resource_uri(self, item_id, title, section, uri):
         """ Add a URI resource to an item.
         Raises exception on error.
         """
-        xml = self._generate_basic_resource_xml(title, section)
-        self._add_xml_subelement(xml, "uri", uri)
-        (_response, _body) = self._post_data("/items/%s/item_resources.xml" % item_id, self._serialize_xml(xml), 'application/xml')
+        data = resource_uri_xml(title, section, uri)
+        def add():
+            (_response, _body) = self._post_data("/items/%s/item_resources.xml" % item_id, data, 'application/xml')
+        self._journaled('add_resource', [item_id, title, section, 'uri', uri], add)
 
     def change_item_medium_type(self, item_id, medium_type, title, metadata):
         """ Change the medium type of the item and upload new metadata.
@@ -94,23 +223,24 @@ class BasicDataUploadClient:
         item.
         Raises exception on error.
         """
-        xml = ET.Element("medium")
-        if (medium_type is not None) and (medium_type != ""):
-            self._add_xml_subelement(xml, "type", 'Medium::'+medium_type)
-            self._add_xml_subelement(xml, 'title', title)
-            for (key, value) in metadata.items():
-                self._add_xml_subelement(xml, key, value)
-        (_response, _body) = self._put_data("/items/%s/medium.xml" % item_id, self._serialize_xml(xml), 'application/xml')
+        data = medium_xml(medium_type, title, metadata)
+        def change():
+            (_response, _body) = self._put_data("/items/%s/medium.xml" % item_id, data, 'application/xml')
+        self._journaled('change_item_medium_type', [item_id, medium_type, title, metadata], change)
 
     def create_image_from_upload(self, item_id, upload_id):
         """ Associate uploaded image with an item.
         Returns image ID.
         """
-        xml = ET.Element("image")
-        file_elem = ET.SubElement(xml, "file")
-        self._add_xml_subelement(file_elem, "upload-id", upload_id)
-        (_response, body) = self._post_data("/items/%s/images.xml" % item_id, self._serialize_xml(xml), 'application/xml')
-        return self._id_from_xml_string(body)
+        data = image_xml(upload_id)
+        def create():
+            (_response, image_id) = self._post_data("/items/%s/images.xml" % item_id, data, 'application/xml', self._id_from_xml_string)
+            return image_id
+        image_id = self._journaled('create_image', [item_id, self._upload_content(upload_id)], create)
+        if self.metadata_cache is not None:
+            # later changes of the image drop only the documents of the item
+            self.metadata_cache.note_parent(self._cache_scope, 'images', image_id, item_id)
+        return image_id
 
     def create_item(self, group_id, title, extras = dict()):
         """ Create a new item with title in the group with group_id.
@@ -118,16 +248,42 @@ class BasicDataUploadClient:
         specified as dictionary in extras (any entries with value None are
         ignored).
         Returns ID of the created item.
+        A failed request is retried only if the item has a reference_id or
+        external_id, the group is checked for an item with the same ID
+        before each retry (the request could have succeeded despite the
+        failure).
         Raises exception:
             - RuntimeError: API call failed with an error.
         """
-        xml = ET.Element("item")
-        self._add_xml_subelement(xml, "title", title)
-        for (key, value) in extras.items():
-            if value is not None:
-                self._add_xml_subelement(xml, key, value)
-        (_response, body) = self._post_data("/groups/%s/items.xml" % group_id, self._serialize_xml(xml), 'application/xml')
-        return self._id_from_xml_string(body)
+        data = item_xml(extras, title)
+        def create():
+            retry = 0
+            while True:
+                try:
+                    (_response, item_id) = self._post_data("/groups/%s/items.xml" % group_id, data, 'application/xml', self._id_from_xml_string)
+                    return item_id
+                except Exception, e:
+                    retry += 1
+                    if (self.retry_policy is None) or (extras.get('reference_id') is None and extras.get('external_id') is None):
+                        raise
+                    if not self.retry_policy.should_retry(e, retry):
+                        raise
+                    if self.debugging:
+                        print >>self.debug_out, "Retrying item creation (%d) after error: %s" % (retry, e)
+                    self.retry_policy.wait(retry, e)
+                    item_id = self._find_item_id(group_id, extras.get('reference_id'), extras.get('external_id'))
+                    if item_id is not None:
+                        return item_id
+        def recover():
+            # the interrupted run could have created the item
+            return self._find_item_id(group_id, extras.get('reference_id'), extras.get('external_id'))
+        if (extras.get('reference_id') is None) and (extras.get('external_id') is None):
+            recover = None
+        set_extras = dict((key, value) for (key, value) in extras.items() if value is not None)
+        item_id = self._journaled('create_item', [group_id, title, set_extras], create, recover=recover)
+        if self.metadata_cache is not None:
+            self.metadata_cache.note_parent(self._cache_scope, 'items', item_id, group_id)
+        return item_id
 
     def deactivate_image(self, image_id):
         """ Deactivate the image.
@@ -135,51 +291,192 @@ class BasicDataUploadClient:
         """
         return self._set_image_status(image_id, 'INACTIVE')
 
+    def deactivate_images(self, image_ids, workers = 4):
+        """ Deactivate the images, up to workers of them at once.
+        Generates tuples (image ID, current status of the image, error) as
+        activate_images() does.
+        """
+        return imap_unordered(self.deactivate_image, image_ids, workers)
+
+    def close(self):
+        """ Close idle connections to the API server. """
+        self.connection_pool.close()
+
     def delete_image(self, image_id):
         """ Delete the image.
         Raises exception on error.
         """
-        (_response, _body) = self._send_request('DELETE', "/images/%s.xml" % image_id)
+        def delete():
+            (_response, _body) = self._send_request('DELETE', "/images/%s.xml" % image_id)
+        self._journaled('delete_image', [image_id], delete)
+
+    def delete_images(self, image_ids, workers = 4):
+        """ Delete the images, up to workers of them at once.
+        Generates tuples (image ID, None, error) in the order of completion.
+        The error is the exception which stopped the deletion or None.
+        """
+        return imap_unordered(self.delete_image, image_ids, workers)
 
     def delete_item(self, item_id):
         """ Delete the item.
         Raises exception on error.
         """
-        (_response, _body) = self._send_request('DELETE', "/items/%s.xml" % item_id)
+        def delete():
+            (_response, _body) = self._send_request('DELETE', "/items/%s.xml" % item_id)
+        self._journaled('delete_item', [item_id], delete)
+
+    def delete_items(self, item_ids, workers = 4):
+        """ Delete the items, up to workers of them at once.
+        Generates tuples (item ID, None, error) as delete_images() does.
+        """
+        return imap_unordered(self.delete_item, item_ids, workers)
 
     def get_group(self, group_id):
         """ Return description of the group. """
-        (_response, body) = self._send_request('GET', "/groups/%s.xml" % group_id)
+        body = self._get("/groups/%s.xml" % group_id)
         return body
 
     def get_group_items(self, group_id):
         """ Return items from the group. """
-        (_response, body) = self._send_request('GET', "/groups/%s/items.xml" % group_id)
+        body = self._get("/groups/%s/items.xml" % group_id)
         return body
 
+    def get_group_record(self, group_id):
+        """ Return description of the group as Group. """
+        return self._get("/groups/%s.xml" % group_id, Group.from_xml)
+
     def get_image(self, image_id):
         """ Return description of the image. """
-        (_response, body) = self._send_request('GET', "/images/%s.xml" % image_id)
+        body = self._get("/images/%s.xml" % image_id)
         return body
 
+    def get_image_record(self, image_id):
+        """ Return description of the image as Image. """
+        return self._get("/images/%s.xml" % image_id, Image.from_xml)
+
     def get_image_status(self, image_id):
-        """ Return current image status. """
-        (_response, body) = self._send_request('GET', "/images/%s.xml" % image_id)
-        return self._status_from_xml_string(body)
+        """ Return current image status.
+        The status is always read from the server (not from the metadata
+        cache), as it is polled while the image is being activated.
+        """
+        (_response, status) = self._send_request('GET', "/images/%s.xml" % image_id, parse=self._status_from_xml_string)
+        return status
+
+    def get_connection_stats(self):
+        """ Return statistics of the connection pool (see HTTPConnectionPool.stats()). """
+        return self.connection_pool.stats()
 
     def get_item(self, item_id):
         """ Return description of the item. """
-        (_response, body) = self._send_request('GET', "/items/%s.xml" % item_id)
+        body = self._get("/items/%s.xml" % item_id)
         return body
 
+    def get_item_record(self, item_id):
+        """ Return description of the item as Item. """
+        return self._get("/items/%s.xml" % item_id, Item.from_xml)
+
+    def get_item_resource_records(self, item_id):
+        """ Return list of resources (Resource) of the item. """
+        def parse(body):
+            return parse_records(body, Resource)
+        return self._get("/items/%s/item_resources.xml" % item_id, parse)
+
     def get_item_resources(self, item_id):
         """ Return resources of the item. """
-        (_response, body) = self._send_request('GET', "/items/%s/item_resources.xml" % item_id)
+        body = self._get("/items/%s/item_resources.xml" % item_id)
         return body
 
-    def set_debug(self, flag):
-        """ Enable/disable debugging printouts according to the flag. """
+    def iter_group_items(self, group_id, page_size = None, filters = None):
+        """ Generate items (Item) of the group.
+        The listing is parsed while it is being received, so the items are
+        available before the whole listing arrives and only the items kept
+        by the caller stay in memory.
+        If page_size is given, the listing is requested in pages of at most
+        page_size items (parameters page and per_page) until a page with
+        fewer items; a server ignoring these parameters is detected by
+        repeated items and is read only once. The filters (dictionary
+        mapping attribute title, reference_id or external_id to its value)
+        select only the items with these attribute values.
+        Raises exception:
+            - ValueError: page_size is not positive (before any request).
+        """
+        if (page_size is not None) and (page_size < 1):
+            raise ValueError("Page size must be positive")
+        parameters = list()
+        if filters is not None:
+            for (name, value) in sorted(filters.items()):
+                if isinstance(value, unicode):
+                    value = value.encode('UTF-8')
+                parameters.append(('item[%s]' % name, value))
+        if page_size is None:
+            for item in self._iter_group_items_page(group_id, parameters):
+                yield item
+            return
+        page = 1
+        first_id = None
+        previous_first_id = None
+        while True:
+            count = 0
+            for item in self._iter_group_items_page(group_id, parameters + [('page', page), ('per_page', page_size)]):
+                if count == 0:
+                    first_id = item.element.findtext('id')
+                    if first_id == previous_first_id:
+                        # the server does not paginate, the page was already read
+                        return
+                count += 1
+                yield item
+            if count != page_size:
+                return
+            previous_first_id = first_id
+            page += 1
+
+    def set_debug(self, flag, out = None):
+        """ Enable/disable debugging printouts according to the flag. The
+        printouts are written to the file out (standard output if None).
+        """
         self.debugging = flag
+        self.debug_out = out
+
+    def set_journal(self, journal):
+        """ Record the changes made by the client in the journal
+        (journal.Journal) and skip the changes it records as completed,
+        None disables journaling.
+        """
+        self.journal = journal
+
+    def set_metadata_cache(self, metadata_cache):
+        """ Serve repeated reads of groups, items, images and resources
+        from the metadata_cache (MetadataCache), None disables caching.
+        The cached documents can be up to the cache TTL old.
+        """
+        self.metadata_cache = metadata_cache
+
+    def set_preprocessor(self, preprocessor):
+        """ Shrink images uploaded from files by upload_from_file(),
+        upload_files() and add_images() with the preprocessor
+        (preprocess.ImagePreprocessor), None uploads the files unchanged.
+        """
+        self.preprocessor = preprocessor
+
+    def set_rate_limiter(self, rate_limiter):
+        """ Limit the rate of requests by the rate_limiter (e.g.
+        RequestRateLimiter), None disables limiting.
+        The limiter's acquire(method, api_path) is called before every
+        request and has to block until the request may be sent.
+        """
+        self.rate_limiter = rate_limiter
+
+    def set_retry_policy(self, retry_policy):
+        """ Retry failed requests according to the retry_policy
+        (RetryPolicy), None disables retrying.
+        """
+        self.retry_policy = retry_policy
+
+    def set_upload_cache(self, upload_cache):
+        """ Reuse upload IDs of identical content from the upload_cache
+        (UploadCache), None disables the cache.
+        """
+        self.upload_cache = upload_cache
 
     def update_item(self, item_id, extras = dict()):
         """ Update the item according to metadata in extras.
@@ -188,32 +485,69 @@ class BasicDataUploadClient:
         Raises exception:
             - RuntimeError: API call failed with an error.
         """
-        xml = ET.Element("item")
+        set_extras = dict()
         for (key, value) in extras.items():
             if value is not None:
-                self._add_xml_subelement(xml, key, value)
-        (_response, _body) = self._put_data("/items/%s.xml" % item_id, self._serialize_xml(xml), 'application/xml')
+                set_extras[key] = value
+        data = item_xml(extras)
+        def update():
+            (_response, _body) = self._put_data("/items/%s.xml" % item_id, data, 'application/xml')
+        self._journaled('update_item', [item_id, set_extras], update)
 
     def upload_data(self, data, content_type):
         """ Upload data from memory.
         Returns upload ID.
         """
-        (_response, body) = self._post_data('/uploads.xml', data, content_type)
-        return self._id_from_xml_string(body)
+        return self._upload(data, content_type)
+
+    def upload_files(self, filenames, content_type = None, hash_workers = 2, prefetch = 4):
+        """ Upload files, hashing the following files while a file is sent.
+        MD5 hashes of up to prefetch files following the one being sent are
+        computed by hash_workers threads, so that hashing and sending of the
+        files overlap. Each request is signed just before it is sent. None
+        as content_type means the type of each file is guessed from its name.
+        Images are preprocessed (see set_preprocessor()) by the same threads.
+        Generates tuples (filename, upload ID) in the order of filenames.
+        Raises exception:
+            - IOError: A file cannot be read.
+            - RuntimeError: API call failed with an error.
+        """
+        for (filename, prepared, error) in self._prepare_files(filenames, content_type, hash_workers, prefetch):
+            if error is not None:
+                raise error
+            yield (filename, self._upload_prepared(prepared))
 
     def upload_from_file(self, filename, content_type = None):
         """ Upload a file.
+        The file is streamed, it is never held in memory as a whole. Images
+        are preprocessed first (see set_preprocessor()).
         Returns upload ID.
         """
-        if content_type is None:
-            (content_type, _encoding) = mimetypes.guess_type(filename)
-        with open(filename, 'rb') as f:
-            return self.upload_data(f.read(), content_type)
+        (filename, content_type) = self._prepare_file(filename, content_type)
+        return self._upload_file(filename, content_type)
+
+    def upload_stream(self, stream, content_type):
+        """ Upload data read from a file-like object.
+        The data from the current position to the end of the stream are
+        uploaded in chunks. The stream is read twice (for signing and for
+        sending), so it must support seek() and tell().
+        Returns upload ID.
+        """
+        return self._upload(stream, content_type)
 
-    def _add_xml_subelement(self, root, name, text):
-        """ Add a text sub-element to root. """
-        elem = ET.SubElement(root, name)
-        elem.text = unicode(text, "UTF-8")
+    def _add_image(self, item_id, prepared, activate):
+        """ Upload the prepared file (see _prepare_files()), create image of
+        the item from it and activate it.
+        Returns tuple (image ID, error of the activation or None).
+        """
+        upload_id = self._upload_prepared(prepared)
+        image_id = self.create_image_from_upload(item_id, upload_id)
+        if activate:
+            try:
+                self.activate_image(image_id)
+            except Exception, e:
+                return (image_id, e)
+        return (image_id, None)
 
     def _element_from_xml(self, xml, name):
         """ Extract element name from supplied XML string.
@@ -225,12 +559,67 @@ class BasicDataUploadClient:
             raise KeyError("No '"+name+"' element in the supplied XML: "+ET.tostring(xml))
         return elem.text
 
-    def _generate_basic_resource_xml(self, title, section):
-        """ Return resource upload XML fragment with title and section. """
-        xml = ET.Element("resource")
-        self._add_xml_subelement(xml, "title", title)
-        self._add_xml_subelement(xml, "section", section)
-        return xml
+    def _find_item_id(self, group_id, reference_id, external_id):
+        """ Return ID of the item with given reference ID (or external ID
+        if reference_id is None) in the group, None if there is no such item.
+        The server selects the item, the group is never listed as a whole.
+        Raises exception:
+            - RuntimeError: The server does not select items by the ID, so
+               it is unknown whether the group contains the item.
+        """
+        if reference_id is not None:
+            (attribute, name, value) = ('reference_id', 'reference-id', reference_id)
+        else:
+            (attribute, name, value) = ('external_id', 'external-id', external_id)
+        if not isinstance(value, unicode):
+            value = unicode(str(value), 'UTF-8')
+        items = self.iter_group_items(group_id, filters={attribute: value})
+        try:
+            for item in items:
+                if item.element.findtext(name) != value:
+                    raise RuntimeError("Cannot find out whether group %s contains item with %s %s, "
+                            "the server does not select items by %s" % (group_id, attribute, value.encode('UTF-8'), attribute))
+                return str(item.id)
+        finally:
+            items.close()
+        return None
+
+    def _get(self, api_path, parse = None):
+        """ Return body of the response to GET of api_path, which is read
+        from the metadata cache if possible. The body is converted by the
+        function parse unless it is None.
+        """
+        if parse is None:
+            parse = _unparsed
+        cache = self.metadata_cache
+        if cache is None:
+            (_response, parsed) = self._send_request('GET', api_path, parse=parse)
+            return parsed
+        cached = cache.lookup(self._cache_scope, api_path)
+        headers = dict()
+        if cached is not None:
+            (cached_body, etag, last_modified, fresh) = cached
+            if fresh:
+                return parse(cached_body)
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+        def parse_and_keep(body):
+            return (body, parse(body))
+        (response, result) = self._send_request('GET', api_path, headers=headers, parse=parse_and_keep)
+        if response.status == 304:
+            cache.refresh(self._cache_scope, api_path)
+            return parse(cached_body)
+        (body, parsed) = result
+        cache.store(self._cache_scope, api_path, body, response.getheader('ETag'), response.getheader('Last-Modified'))
+        return parsed
+
+    def _hash_file(self, filename):
+        """ Return tuple (MD5 hex digest, size) of the file content. """
+        with open(filename, 'rb') as f:
+            content_md5 = compute_md5_hex_stream(f)
+            return (content_md5, f.tell())
 
     def _id_from_xml(self, xml):
         """ Extract id element from supplied XML string.
@@ -244,41 +633,262 @@ class BasicDataUploadClient:
         Returns the ID as string.
         Raises KeyError if there is no ID element.
         """
-        xml = ET.fromstring(xml_string)
+        xml = parse_xml(xml_string)
         return self._id_from_xml(xml)
 
-    def _post_data(self, api_path, data, content_type):
+    def _iter_group_items_page(self, group_id, parameters):
+        """ Generate items (Item) of one request for group items with given
+        query parameters (list of name, value tuples).
+        """
+        api_path = "/groups/%s/items.xml" % group_id
+        if parameters:
+            api_path += '?' + urlencode(parameters)
+        (_response, body) = self._send_request('GET', api_path, stream=True)
+        try:
+            for item in iter_records(body, 'item', Item):
+                yield item
+        finally:
+            body.close()
+
+    def _journaled(self, kind, arguments, function, max_age = None, recover = None):
+        """ Make the change by calling function, as a step of the kind with
+        the arguments recorded in the journal (see journal.Journal.run()).
+        Returns result of the function (or of the completed step).
+        """
+        if self.journal is None:
+            return function()
+        return self.journal.run(kind, arguments, function, max_age, recover)
+
+    def _post_data(self, api_path, data, content_type, parse = None):
         """ Post data to an API node specified by api_path.
         See _send_request() for further details.
         """
-        return self._send_request('POST', api_path, data, content_type)
+        return self._send_request('POST', api_path, data, content_type, parse=parse)
+
+    def _prepare_file(self, filename, content_type):
+        """ Preprocess the file if it is an image and there is a preprocessor.
+        None as content_type means the type is guessed from the file name.
+        Returns tuple (name of the file to upload, its content type).
+        """
+        if content_type is None:
+            (content_type, _encoding) = mimetypes.guess_type(filename)
+        if (self.preprocessor is None) or (content_type is None) or (not content_type.startswith('image/')):
+            return (filename, content_type)
+        prepared_filename = self.preprocessor.prepare(filename)
+        if prepared_filename == filename:
+            return (filename, content_type)
+        return (prepared_filename, 'image/jpeg')
+
+    def _prepare_and_hash(self, filename, content_type):
+        """ Preprocess (see _prepare_file()) and hash the file.
+        Returns tuple (name of the file to upload, its content type, MD5
+        hex digest, size).
+        """
+        (prepared_filename, file_type) = self._prepare_file(filename, content_type)
+        return (prepared_filename, file_type) + self._hash_file(prepared_filename)
+
+    def _prepare_files(self, filenames, content_type, hash_workers, prefetch):
+        """ Preprocess (see _prepare_file()) and hash the files by
+        hash_workers threads, up to prefetch files ahead of the consumer.
+        Generates tuples (filename, prepared, error) in the order of
+        filenames, prepared is tuple (name of the file to upload, its
+        content type, MD5 hex digest, size) unless error is not None.
+        """
+        def prepare_and_hash(filename):
+            return self._prepare_and_hash(filename, content_type)
+        return imap_prefetch(prepare_and_hash, filenames, hash_workers, prefetch)
 
-    def _put_data(self, api_path, data, content_type):
+    def _put_data(self, api_path, data, content_type, parse = None):
         """ Put data to an API node specified by api_path.
         See _send_request() for further details.
         """
-        return self._send_request('PUT', api_path, data, content_type)
+        return self._send_request('PUT', api_path, data, content_type, parse=parse)
 
-    def _send_request(self, method, api_path, data=None, content_type=None):
+    def _read_response(self, http, timings):
+        """ Wait for the response to the request sent over the connection
+        http, adding the time spent waiting to the timings.
+        Returns the response (HTTPResponse) with the body not read yet.
+        Raises exception on error:
+            - STALE_CONNECTION_ERRORS: Connection closed by the server.
+        """
+        mark = time.time()
+        response = http.getresponse()
+        _add_time(timings, 'ttfb', time.time() - mark)
+        return response
+
+    def _send_attempt(self, method, api_path, parsed_url, data, content_type, content_md5, content_length, stream, extra_headers, parse, idempotent, attempt):
+        """ Sign and send the request once, calling the request hooks.
+        See _send_request().
+        """
+        if not self.request_hooks:
+            return self._send_attempt_timed(method, api_path, parsed_url, data, content_type, content_md5, content_length, stream, extra_headers, parse, idempotent, None)
+        info = RequestInfo(method, api_path, endpoint_of(api_path), attempt, content_length)
+        for hooks in self.request_hooks:
+            hooks.before_request(info)
+        try:
+            result = self._send_attempt_timed(method, api_path, parsed_url, data, content_type, content_md5, content_length, stream, extra_headers, parse, idempotent, info)
+        except Exception, e:
+            info.duration = time.time() - info.started_at
+            for hooks in self.request_hooks:
+                hooks.on_error(info, e)
+            raise
+        info.duration = time.time() - info.started_at
+        for hooks in self.request_hooks:
+            hooks.after_response(info)
+        return result
+
+    def _send_attempt_timed(self, method, api_path, parsed_url, data, content_type, content_md5, content_length, stream, extra_headers, parse, idempotent, info):
+        """ Sign and send the request once, recording the timings and the
+        response in info (RequestInfo) unless it is None. A request failing
+        on a reused connection closed by the server is sent once more over
+        a new connection if it was not sent or if it is idempotent.
+        See _send_request().
+        """
+        timings = dict()
+        if info is not None:
+            timings = info.timings
+        streamed = hasattr(data, 'read')
+        if streamed:
+            stream_start = data.tell()
+        if self.rate_limiter is not None:
+            mark = time.time()
+            self.rate_limiter.acquire(method, api_path)
+            _add_time(timings, 'rate_limit', time.time() - mark)
+        (http, reused) = self.connection_pool.acquire(parsed_url.scheme, parsed_url.hostname, parsed_url.port)
+        if info is not None:
+            info.reused_connection = reused
+        mark = time.time()
+        # the signature covers only the path, the query is sent along
+        request_path = parsed_url.path
+        if parsed_url.query:
+            request_path += '?' + parsed_url.query
+        try:
+            date = email.utils.formatdate(None, localtime=False, usegmt=True)
+            if content_md5 is not None:
+                signature = self.kws.sign_with_content_md5(method, content_md5, content_type, date, parsed_url.path)
+            elif streamed:
+                signature = self.kws.sign_with_content_stream(method, data, content_type, date, parsed_url.path)
+                data.seek(stream_start)
+            elif data is not None:
+                signature = self.kws.sign_with_content(method, data, content_type, date, parsed_url.path)
+            else:
+                signature = self.kws.sign_with_no_content(method, content_type, date, parsed_url.path)
+            _add_time(timings, 'sign', time.time() - mark)
+            headers = {
+                    'Authorization': 'KWS %s:%s' % (self.access_key, signature),
+                    'Date': date
+                    }
+            if content_type is not None:
+                headers['Content-Type'] = content_type
+            if extra_headers:
+                headers.update(extra_headers)
+            if data is not None:
+                headers['Content-Length'] = str(content_length)
+            try:
+                sent = False
+                try:
+                    self._perform_request(http, method, request_path, headers, data, timings)
+                    sent = True
+                    response = self._read_response(http, timings)
+                except socket.timeout:
+                    # a stalled server rather than a closed connection, the
+                    # retry policy decides whether to send the request again
+                    raise
+                except STALE_CONNECTION_ERRORS:
+                    # the server closed the kept-alive connection in the
+                    # meantime; a request which was sent may have been
+                    # processed already, so only an idempotent one is resent
+                    if (not reused) or (sent and not idempotent):
+                        raise
+                    http = self.connection_pool.reconnect(http)
+                    if streamed:
+                        data.seek(stream_start)
+                    self._perform_request(http, method, request_path, headers, data, timings)
+                    response = self._read_response(http, timings)
+                if info is not None:
+                    info.status = response.status
+                if stream and (response.status >= 200) and (response.status <= 299):
+                    if self.debugging:
+                        print >>self.debug_out, "HTTP response status:", response.status, response.reason
+                    return (response, PooledResponse(self.connection_pool, http, response))
+                # the response has to be read completely before the connection is reused
+                mark = time.time()
+                body = response.read()
+                _add_time(timings, 'read', time.time() - mark)
+            except (httplib.HTTPException, socket.error), e:
+                raise IOError("Error during request: %s: %s" % (type(e), e))
+        except:
+            self.connection_pool.discard(http)
+            raise
+        if response.will_close:
+            self.connection_pool.discard(http)
+        else:
+            self.connection_pool.release(http)
+        if self.debugging:
+            print >>self.debug_out, "HTTP response status:", response.status, response.reason
+            print >>self.debug_out, "Body:"
+            print >>self.debug_out, body
+        if info is not None:
+            info.response_size = len(body)
+        if response.status == 304 and extra_headers:
+            # not modified since the version given by a conditional request
+            return (response, None)
+        if (response.status < 200) or (response.status > 299):
+            raise APIError(response.status, response.reason, body, response.getheader('Retry-After'))
+        if parse is not None:
+            mark = time.time()
+            body = parse(body)
+            _add_time(timings, 'parse', time.time() - mark)
+        return (response, body)
+
+    def _send_request(self, method, api_path, data=None, content_type=None, content_md5=None, idempotent=None, stream=False, headers=None, parse=None):
         """ Send (POST/PUT/GET/DELETE according to the method) data to an API
         node specified by api_path.
 
+        The data are either a string or a file-like object supporting
+        seek() and tell(), which is streamed from its current position to
+        the end. The content_md5 is MD5 hash of the data if already known
+        by the caller, None means it is computed from the data.
+
+        Failed requests are retried according to the retry policy if they
+        are idempotent, None as idempotent means that GET, PUT and DELETE
+        requests are idempotent. Every attempt is signed anew.
+
         Returns tuple (response, body) as returned by the API call. The
         response is a HttpResponse object describint HTTP headers and status
-        line.
+        line. If stream is True, the body of a successful response is
+        returned unread as PooledResponse, which the caller has to close.
+        The headers (dictionary) are added to the request; status 304 (Not
+        Modified) is not an error if they make the request conditional (the
+        body is None then). The body of a successful response is converted
+        by the function parse unless it is None.
+
+        The request hooks are called for every attempt (see
+        instrument.RequestHooks).
+
+        Requests other than GET drop the documents they can change from
+        the metadata cache, whether they succeed or not.
 
         Raises exception on error:
             - IOError: Failure performing HTTP call
             - RuntimeError: Unsupported transport scheme.
-            - RuntimeError: API call returned an error.
+            - APIError: API call returned an error.
         """
+        streamed = hasattr(data, 'read')
+        if data is None:
+            content_length = None
+        elif streamed:
+            stream_start = data.tell()
+            content_length = self._stream_length(data)
+        else:
+            content_length = len(data)
         if self.debugging:
             if data is None:
-                print "%s ...%s" % (method, api_path)
-            elif len(data) < 4096:
-                print "%s ...%s:\n%s" % (method, api_path, data)
+                print >>self.debug_out, "%s ...%s" % (method, api_path)
+            elif (not streamed) and (content_length < 4096):
+                print >>self.debug_out, "%s ...%s:\n%s" % (method, api_path, data)
             else:
-                print "%s ...%s: %sB" % (method, api_path, len(data))
+                print >>self.debug_out, "%s ...%s: %sB" % (method, api_path, content_length)
         if '://' not in self.api_url:
             # endpoint as a host or host:port
             parsed_url = urlparse('http://'+self.api_url+api_path)
@@ -286,69 +896,69 @@ class BasicDataUploadClient:
             parsed_url = urlparse(self.api_url+api_path)
         if (parsed_url.scheme != 'http') and (parsed_url.scheme != 'https'):
             raise RuntimeError("URL scheme '%s' not supported" % parsed_url.scheme)
-        port = parsed_url.port
-        if port is None:
-            port = 80
-        host = parsed_url.hostname
-        http = httplib.HTTPConnection(host, port)
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        if self.retry_policy is not None:
+            self.retry_policy.record_request()
         try:
-            date = email.utils.formatdate(None, localtime=False, usegmt=True)
-            if data is not None:
-                signature = self.kws.sign_with_content(method, data, content_type, date, parsed_url.path)
-            else:
-                signature = self.kws.sign_with_no_content(method, content_type, date, parsed_url.path)
-            headers = {
-                    'Authorization': 'KWS %s:%s' % (self.access_key, signature),
-                    'Date': date
-                    }
-            if content_type is not None:
-                headers['Content-Type'] = content_type
-            if data is not None:
-                headers['Content-Length'] = str(len(data))
-            try:
-                http.request(method, parsed_url.path, headers=headers, body=data)
-            except Exception, e:
-                raise IOError("Error during request: %s: %s" % (type(e), e))
-            response = http.getresponse()
-            # we have to read the response before the http connection is closed
-            body = response.read()
-            if self.debugging:
-                print "HTTP response status:", response.status, response.reason
-                print "Body:"
-                print body
-            if (response.status < 200) or (response.status > 299):
-                raise RuntimeError("API call returned status %s %s. Message: %s" % (response.status, response.reason, body))
-            return (response, body)
+            retry = 0
+            while True:
+                try:
+                    return self._send_attempt(method, api_path, parsed_url, data, content_type, content_md5, content_length, stream, headers, parse, idempotent, retry + 1)
+                except Exception, e:
+                    retry += 1
+                    if (not idempotent) or (self.retry_policy is None) or (not self.retry_policy.should_retry(e, retry)):
+                        raise
+                    if self.debugging:
+                        print >>self.debug_out, "Retrying %s ...%s (%d) after error: %s" % (method, api_path, retry, e)
+                    self.retry_policy.wait(retry, e)
+                    if streamed:
+                        data.seek(stream_start)
         finally:
-            http.close()
+            if (method != 'GET') and (self.metadata_cache is not None):
+                self.metadata_cache.invalidate_after(self._cache_scope, method, api_path)
 
-    def _serialize_xml(self, xml):
-        """ Serialize ElementTree document. """
-        tree = ET.ElementTree(xml)
-        buf = StringIO()
+    def _perform_request(self, http, method, path, headers, data, timings):
+        """ Send the request over the connection http, adding the time spent
+        connecting and sending to the timings.
+        Raises exception on error:
+            - IOError: Failure sending the request.
+            - STALE_CONNECTION_ERRORS: Connection closed by the server.
+        """
+        started = time.time()
         try:
-            # ElementTree 1.3
-            tree.write(buf, encoding="UTF-8", xml_declaration=True, method="xml")
-        except:
-            # older ElementTree version
-            tree.write(buf, encoding="UTF-8")
-        serialized = buf.getvalue()
-        buf.close()
-        return serialized
+            if http.sock is None:
+                http.connect()
+            connected = time.time()
+            _add_time(timings, 'connect', connected - started)
+            http.request(method, path, headers=headers, body=data)
+        except STALE_CONNECTION_ERRORS:
+            raise
+        except Exception, e:
+            raise IOError("Error during request: %s: %s" % (type(e), e))
+        _add_time(timings, 'send', time.time() - connected)
 
     def _set_image_status(self, image_id, new_status):
         """ Set image status to a new value.
         Returns image status after change.
         Raises exception on error.
         """
-        xml = ET.Element("status")
-        self._add_xml_subelement(xml, "name", new_status)
-        (_response, body) = self._put_data('/images/%s/status.xml' % image_id, self._serialize_xml(xml), 'application/xml')
-        response_xml = ET.fromstring(body)
-        status_elem = response_xml.find("status")
-        if status_elem is None:
-            raise KeyError("No status element in the returned XML: "+body)
-        return status_elem.text
+        data = status_xml(new_status)
+        def set_status():
+            (_response, response_xml) = self._put_data('/images/%s/status.xml' % image_id, data, 'application/xml', parse_xml)
+            status_elem = response_xml.find("status")
+            if status_elem is None:
+                raise KeyError("No status element in the returned XML: "+ET.tostring(response_xml))
+            return status_elem.text
+        return self._journaled('set_image_status', [image_id, new_status], set_status)
+
+    def _stream_length(self, stream):
+        """ Return number of bytes from the current position to the end of the stream. """
+        start = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        length = stream.tell() - start
+        stream.seek(start)
+        return length
 
     def _status_from_xml(self, xml):
         """ Extract status element from supplied XML string.
@@ -362,18 +972,128 @@ class BasicDataUploadClient:
         Returns the ID as string.
         Raises KeyError if there is no ID element.
         """
-        xml = ET.fromstring(xml_string)
+        xml = parse_xml(xml_string)
         return self._status_from_xml(xml)
 
+    def _upload(self, data, content_type, content_md5 = None, size = None):
+        """ Upload data (string or stream) unless the upload cache (or the
+        journal) contains upload ID of the same content. The MD5 hex digest and size of the
+        data are computed unless given.
+        Returns upload ID.
+        """
+        if ((self.upload_cache is not None) or (self.journal is not None)) and (content_md5 is None):
+            if hasattr(data, 'read'):
+                start = data.tell()
+                content_md5 = compute_md5_hex_stream(data)
+                size = data.tell() - start
+                data.seek(start)
+            else:
+                content_md5 = compute_md5_hex(data)
+                size = len(data)
+        def upload():
+            if self.upload_cache is not None:
+                upload_id = self.upload_cache.lookup(content_md5, size)
+                if upload_id is not None:
+                    if self.debugging:
+                        print >>self.debug_out, "Reusing upload %s of content with MD5 %s" % (upload_id, content_md5)
+                    return upload_id
+            # repeated upload only leaves an unused upload, which expires
+            (_response, upload_id) = self._send_request('POST', '/uploads.xml', data, content_type, content_md5, idempotent=True, parse=self._id_from_xml_string)
+            if self.upload_cache is not None:
+                self.upload_cache.store(content_md5, size, upload_id)
+            return upload_id
+        if self.journal is None:
+            return upload()
+        # uploads recorded by earlier runs may have been removed by the server
+        return self._journaled('upload', [content_md5, size], upload, max_age=DEFAULT_TTL)
+
+    def _upload_content(self, upload_id):
+        """ Identify the uploaded content for the journal: by the MD5 hash
+        and size if the upload is recorded there, by the upload ID otherwise.
+        """
+        if self.journal is None:
+            return upload_id
+        content = self.journal.find_arguments('upload', upload_id)
+        if content is None:
+            return upload_id
+        return content
+
+    def _upload_prepared(self, prepared):
+        """ Upload the prepared file (see _prepare_files()).
+        Returns upload ID.
+        """
+        (prepared_filename, file_type, content_md5, size) = prepared
+        with open(prepared_filename, 'rb') as f:
+            return self._upload(f, file_type, content_md5, size)
 
-def parse_inputs():
-    """ Parse and check command line and environment variables. """
-    import optparse
+    def _upload_file(self, filename, content_type):
+        """ Upload the file as it is. None as content_type means the type is
+        guessed from the file name.
+        Returns upload ID.
+        """
+        if content_type is None:
+            (content_type, _encoding) = mimetypes.guess_type(filename)
+        with open(filename, 'rb') as f:
+            return self.upload_stream(f, content_type)
+
+
+def _add_time(timings, phase, seconds):
+    """ Add seconds spent in the phase to the timings (dictionary). """
+    timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+def _unparsed(body):
+    """ Return the response body as it is. """
+    return body
+
+
+class CommandError(ValueError):
+    """ Invalid command run by --batch or --daemon. """
+    pass
+
+
+class InputError(ValueError):
+    """ Input file of an action cannot be read or is invalid. """
+    pass
+
+
+class _CommandParser(optparse.OptionParser):
+    """ Parser of the commands run by --batch or --daemon, which raises
+    CommandError instead of exiting.
+    """
+
+    def __init__(self, usage = None, version = None, add_help_option = True):
+        optparse.OptionParser.__init__(self, usage = usage, version = version, add_help_option = add_help_option)
 
+    def error(self, msg):
+        raise CommandError(msg)
+
+    # --help and --version would print to the output of the results and
+    # exit the process
+
+    def print_help(self, file = None):
+        raise CommandError("--help is not supported in commands")
+
+    def print_version(self, file = None):
+        raise CommandError("--version is not supported in commands")
+
+
+def build_parser(parser_class = optparse.OptionParser):
+    """ Return parser (instance of parser_class) of the command line. """
     usage = dedent("""
     Create a new item (prints progress):
       %prog [options] --create-item-in GROUP_ID -t TITLE [image [image2] ...]
 
+    Create or update items listed in a manifest (prints progress):
+      %prog [options] --bulk MANIFEST [--group GROUP_ID] [--workers N]
+
+    Same in any number of processes (on computers sharing the directory
+    QUEUE), each processing shards of the manifest (prints progress):
+      %prog [options] --bulk MANIFEST --shard-queue QUEUE [--shards N] [--group GROUP_ID] [--workers N]
+
+    Synchronize group with items listed in a manifest (prints changes):
+      %prog [options] --sync MANIFEST --group GROUP_ID [--state-file FILE] [--delete-missing]
+
     Create a new resource (prints nothing):
       %prog [options] --create-resource-for ITEM_ID -t TITLE -s SECTION [file]
 
@@ -392,33 +1112,80 @@ def parse_inputs():
     Deactivate image (prints updated image status):
       %prog [options] --deactivate-image IMAGE_ID
 
+    Delete, activate or deactivate many items or images (prints result for each ID):
+      %prog [options] --delete-items FILE [--workers N] [--dry-run]
+      %prog [options] --delete-images FILE [--workers N] [--dry-run]
+      %prog [options] --activate-images FILE [--workers N] [--dry-run]
+      %prog [options] --deactivate-images FILE [--workers N] [--dry-run]
+      (FILE lists one ID per line, - reads the IDs from standard input and
+      group:GROUP_ID selects the items of the group matching the --filter
+      switches, or the images of these items)
+
     Get image (prints image description):
       %prog [options] --get-image IMAGE_ID
 
     Get image status (prints image status):
       %prog [options] --get-image-status IMAGE_ID
 
+    Wait until images are active (prints status changes):
+      %prog [options] --wait-until-active FILE [--timeout SECONDS] [--max-rate N]
+
+    Resume a job interrupted when run with --journal JOURNAL (prints what the job prints):
+      %prog --resume JOURNAL
+
+    Run commands (one per line, the command line switches of the actions
+    above without the options configuring the client) read from a file or
+    standard input (prints JSON result for every command):
+      %prog [options] --batch FILE [--batch-workers N]
+
+    Run commands received over a Unix socket (prints JSON result for every
+    command to the connection, relative file names in the commands refer
+    to the working directory of the daemon, not of the sender):
+      %prog [options] --daemon SOCKET [--batch-workers N]
+
     The user credentials (access and secret keys) should be passed via
     environment variables KWS_ACCESS_KEY and KWS_SECRET_KEY.
     """)
 
     version = "%%prog %s" % VERSION
 
-    parser = optparse.OptionParser(usage = usage, version = version, add_help_option = True)
+    parser = parser_class(usage = usage, version = version, add_help_option = True)
     parser.add_option('--activate-image', type='int', default=None, metavar='IMAGE_ID',
             help="activate given image {activate image}")
+    parser.add_option('--activate-images', type='string', default=None, metavar='FILE',
+            help="activate images listed in the file (one ID per line, - for standard input, group:GROUP_ID for images of the group) {activate images}")
+    parser.add_option('--batch', type='string', default=None, metavar='FILE',
+            help="run commands listed in the file (one per line, - for standard input) {batch}")
+    parser.add_option('--batch-workers', type='int', default=4, metavar='N',
+            help="number of commands run concurrently [%default] {batch, daemon}")
+    parser.add_option('--bulk', type='string', default=None, metavar='MANIFEST',
+            help="create or update items listed in the manifest (CSV or JSON lines file) {bulk}")
     parser.add_option('--create-item-in', type='int', default=None, metavar='GROUP_ID',
             help="create item in given group {create item}")
     parser.add_option('--create-resource-for', type='int', default=None, metavar='ITEM_ID',
             help="create resource for given item {create resource}")
+    parser.add_option('--daemon', type='string', default=None, metavar='SOCKET',
+            help="run commands received over the Unix socket until terminated {daemon}")
     parser.add_option('--deactivate-image', type='int', default=None, metavar='IMAGE_ID',
             help="deactivate given image {deactivate image}")
+    parser.add_option('--deactivate-images', type='string', default=None, metavar='FILE',
+            help="deactivate images listed in the file (one ID per line, - for standard input, group:GROUP_ID for images of the group) {deactivate images}")
     parser.add_option('--debug', action='store_true', default=False,
             help="enable debugging printouts of communication with the server")
+    parser.add_option('--delete-missing', action='store_true', default=False,
+            help="delete items of the group which are not in the manifest {sync}")
     parser.add_option('--delete-image', type='int', default=None, metavar='IMAGE_ID',
             help="delete given image {delete image}")
+    parser.add_option('--delete-images', type='string', default=None, metavar='FILE',
+            help="delete images listed in the file (one ID per line, - for standard input, group:GROUP_ID for images of the group) {delete images}")
     parser.add_option('--delete-item', type='int', default=None, metavar='ITEM_ID',
             help="delete given item {delete item}")
+    parser.add_option('--delete-items', type='string', default=None, metavar='FILE',
+            help="delete items listed in the file (one ID per line, - for standard input, group:GROUP_ID for items of the group) {delete items}")
+    parser.add_option('--dry-run', action='store_true', default=False,
+            help="only print the IDs which would be changed {delete/activate/deactivate items or images}")
+    parser.add_option('--filter', type='string', action='append', default=list(), metavar='NAME=VALUE',
+            help="select only items of the group:GROUP_ID with given title or reference_id (can be repeated) {delete/activate/deactivate items or images}")
     parser.add_option('--external-id', type='int', default=None,
             help="external ID of the item (integer) {create/update item}")
     parser.add_option('-E', '--endpoint', type='string', default=QUERY_ENDPOINT,
@@ -435,33 +1202,173 @@ def parse_inputs():
             help="retrieve description of given item {get item}")
     parser.add_option('--get-item-resources', type='int', default=None, metavar='ITEM_ID',
             help="retrieve resources of given item {get item resources}")
+    parser.add_option('--group', type='int', default=None, metavar='GROUP_ID',
+            help="group for manifest items without group_id or item_id {bulk}, group to synchronize {sync}")
+    parser.add_option('--image-workers', type='int', default=1, metavar='N',
+            help="number of images of an item uploaded at once, more than 1 adds them in any order {create/update item, bulk} [%default]")
+    parser.add_option('--jpeg-quality', type='int', default=85, metavar='QUALITY',
+            help="JPEG quality of images shrunk by --max-dimension [%default]")
+    parser.add_option('--journal', type='string', default=None, metavar='FILE',
+            help="record the changes in the journal file, skip the changes it records as completed")
     parser.add_option('--locale', type='string', default=None,
             help="item locale (string) {create/update item}")
+    parser.add_option('--max-rate', type='float', default=10.0,
+            help="maximum number of status requests per second [%default] {wait until active}")
+    parser.add_option('--max-dimension', type='int', default=None, metavar='PIXELS',
+            help="shrink images larger than PIXELS x PIXELS before upload (requires PIL)")
     parser.add_option('--medium-type', type='string', default=None,
             help="medium type of the item (use empty string to delete medium type) {create/update item}")
     parser.add_option('-M', '--metadata', type='string', action='append', default=list(),
             help="medium specific metadata as 'name:value' pair (can be repeated multiple times) {create/update item}")
+    parser.add_option('--metadata-cache', type='string', default=None, metavar='FILE',
+            help="cache groups, items and images read from the API in FILE")
+    parser.add_option('--metadata-cache-ttl', type='float', default=60.0, metavar='SECONDS',
+            help="use cached data without revalidation for SECONDS [%default]")
+    parser.add_option('--metrics', type='string', default=None, metavar='FILE',
+            help="write request counts and latency histograms per endpoint to FILE in the Prometheus text format")
+    parser.add_option('--preprocess-cache', type='string', default=None, metavar='DIR',
+            help="keep images shrunk by --max-dimension in DIR for later runs")
+    parser.add_option('--rate-limit', type='string', action='append', default=list(), metavar='SPEC',
+            help="limit request rate as '[METHOD] [PATH]=RATE[/BURST]', e.g. '10' or 'POST /uploads.xml=2/5' (can be repeated multiple times)")
+    parser.add_option('--rate-limit-dir', type='string', default=None, metavar='DIR',
+            help="share the rate limits with other processes using the same directory")
     parser.add_option('--reference-id', type='string', default=None,
             help="reference ID of the item (string) {create/update item}")
+    parser.add_option('--shard-lease', type='float', default=120.0, metavar='SECONDS',
+            help="lifetime of a shard lease not renewed by its worker [%default] {bulk}")
+    parser.add_option('--shard-queue', type='string', default=None, metavar='DIR',
+            help="split the manifest into shards in DIR (created if missing) processed by all the processes using it {bulk}")
+    parser.add_option('--shards', type='int', default=64, metavar='N',
+            help="number of shards of the manifest [%default] {bulk}")
     parser.add_option('--skip-image-activation', action='store_true', default=False,
             help="do not activate image(s) after upload {create/update item}")
+    parser.add_option('--request-log', type='string', default=None, metavar='FILE',
+            help="append timings of every request to the file as JSON lines (- for standard error)")
+    parser.add_option('--resume', type='string', default=None, metavar='JOURNAL',
+            help="run again the job recorded in the journal, skipping its completed changes")
+    parser.add_option('--retries', type='int', default=3,
+            help="number of retries of failed requests (0 disables retrying) [%default]")
     parser.add_option('--section', type='string', default=None,
             help="item resource section (string) {create resource}")
+    parser.add_option('--socket-timeout', type='float', default=DEFAULT_TIMEOUT, metavar='SECONDS',
+            help="time after which a request waiting for the server fails (and is retried) [%default]")
+    parser.add_option('--state-file', type='string', default=None, metavar='FILE',
+            help="file recording the synchronized items [MANIFEST.sync-state] {sync}")
+    parser.add_option('--sync', type='string', default=None, metavar='MANIFEST',
+            help="synchronize group with the manifest (CSV or JSON lines file) {sync}")
+    parser.add_option('--timeout', type='float', default=None, metavar='SECONDS',
+            help="stop waiting after given time {wait until active}")
     parser.add_option('-t', '--title', type='string', default=None,
             help="item or resource title {create/update item, create resource}")
+    parser.add_option('--upload-cache', type='string', default=None, metavar='FILE',
+            help="reuse uploads of identical files recorded in the cache file (created if missing)")
+    parser.add_option('--upload-cache-ttl', type='int', default=DEFAULT_TTL, metavar='SECONDS',
+            help="lifetime of the upload cache entries [%default]")
     parser.add_option('--update-item', type='int', default=None, metavar='ITEM_ID',
             help="update given item {update item}")
     parser.add_option('--uri', type='string', default=None,
             help="item resource URI {create resource}")
+    parser.add_option('--wait-until-active', type='string', default=None, metavar='FILE',
+            help="wait until images listed in the file (one ID per line, - for standard input) are active {wait until active}")
+    parser.add_option('--workers', type='int', default=4,
+            help="number of items processed (or images polled) concurrently [%default] {bulk, sync, wait until active, delete/activate/deactivate items or images}")
     #parser.add_option('-v', '--verbose', action='store_true', default=False,
     #        help="verbose logging - DEBUG logging level [%default]")
+    return parser
+
 
+def parse_inputs():
+    """ Parse and check command line and environment variables. """
+    parser = build_parser()
     (options, arguments) = parser.parse_args()
+    if options.resume is not None:
+        from journal import read_journal_header
+        journal_filename = os.path.abspath(options.resume)
+        try:
+            (job_argv, job_cwd) = read_journal_header(journal_filename)
+        except (IOError, ValueError), e:
+            parser.error(str(e))
+        # relative paths in the arguments refer to the original directory
+        os.chdir(job_cwd)
+        (options, arguments) = parser.parse_args(job_argv)
+        # options given along with --resume override those of the job
+        (options, extra_arguments) = parser.parse_args(sys.argv[1:], options)
+        if len(extra_arguments) > 0:
+            parser.error("The files are taken from the journal when resuming a job.")
+        options.journal = journal_filename
+
+    if (options.batch is not None) or (options.daemon is not None):
+        if (options.batch is not None) and (options.daemon is not None):
+            parser.error("Please specify either --batch or --daemon, but not both.")
+        given = _given_options(parser, options, False)
+        if (len(given) > 0) or (len(arguments) > 0):
+            parser.error("Actions and their options are given in the commands in the batch and daemon modes.")
+        if options.batch_workers < 1:
+            parser.error("Number of batch workers must be positive.")
+        if options.batch is not None:
+            selected_action = 'batch'
+        else:
+            selected_action = 'daemon'
+            if os.path.exists(options.daemon):
+                if not stat.S_ISSOCK(os.stat(options.daemon).st_mode):
+                    parser.error("File %s exists and is not a socket." % options.daemon)
+                if _socket_in_use(options.daemon):
+                    parser.error("Another daemon listens on %s." % options.daemon)
+    else:
+        selected_action = select_action(parser, options, arguments)
+
+    if options.socket_timeout <= 0:
+        parser.error("Socket timeout must be positive.")
+
+    if options.max_dimension is not None:
+        if options.max_dimension < 1:
+            parser.error("Maximal image dimension must be positive.")
+        if not (1 <= options.jpeg_quality <= 100):
+            parser.error("JPEG quality must be between 1 and 100.")
+        from preprocess import Image
+        if Image is None:
+            parser.error("Shrinking images requires PIL (Pillow), which is not installed.")
+
+    # validate rate limits
+    if options.rate_limit_dir is not None:
+        # fails at the first request otherwise, retried as a network error
+        if not os.path.isdir(options.rate_limit_dir):
+            parser.error("Rate limit directory %s does not exist." % options.rate_limit_dir)
+        if not os.access(options.rate_limit_dir, os.W_OK | os.X_OK):
+            parser.error("Rate limit directory %s is not writable." % options.rate_limit_dir)
+    if len(options.rate_limit) > 0:
+        from ratelimit import RequestRateLimiter, parse_rate_limit
+        options.rate_limiter = RequestRateLimiter()
+        for spec in options.rate_limit:
+            try:
+                (bucket, method, path) = parse_rate_limit(spec, options.rate_limit_dir)
+            except (ValueError, RuntimeError), e:
+                parser.error(str(e))
+            options.rate_limiter.add_budget(bucket, method, path)
+    else:
+        options.rate_limiter = None
+
+    # inputs from environment variables
+    if 'KWS_ACCESS_KEY' not in os.environ:
+        parser.error("Environment variable KWS_ACCESS_KEY not set.")
+    options.access_key = os.environ['KWS_ACCESS_KEY']
+    if 'KWS_SECRET_KEY' not in os.environ:
+        parser.error("Environment variable KWS_SECRET_KEY not set.")
+    options.secret_key = os.environ['KWS_SECRET_KEY']
+
+    return (options, arguments, selected_action)
 
-    action_names = ['activate-image', 'create-item-in', 'create-resource-for',
-            'deactivate-image', 'delete-image', 'delete-item', 'get-group',
-            'get-group-items', 'get-image', 'get-image-status', 'get-item',
-            'get-item-resources', 'update-item']
+
+def select_action(parser, options, arguments):
+    """ Check the options of the action selected by options.
+    Returns name of the action.
+    """
+    action_names = ['activate-image', 'activate-images', 'bulk', 'create-item-in',
+            'create-resource-for', 'deactivate-image', 'deactivate-images',
+            'delete-image', 'delete-images', 'delete-item', 'delete-items',
+            'get-group', 'get-group-items', 'get-image', 'get-image-status',
+            'get-item', 'get-item-resources', 'sync', 'update-item',
+            'wait-until-active']
     action_count = 0
     for action_name in action_names:
         action = getattr(options, action_name.replace('-', '_'))
@@ -489,33 +1396,120 @@ def parse_inputs():
         if (options.uri is not None) and (len(arguments) > 0):
             parser.error("Resource requires either an URI or a file, but not both.")
 
+    if (selected_action in ['bulk', 'sync']) and (len(arguments) > 0):
+        parser.error("Images are specified in the manifest in the %s mode." % selected_action)
+    if options.shard_queue is not None:
+        if selected_action != 'bulk':
+            parser.error("Only the manifest of --bulk can be processed in shards.")
+        if options.journal is not None:
+            parser.error("The shards are journaled in the shard queue, --journal cannot be used.")
+        if options.shards < 1:
+            parser.error("Number of shards must be positive.")
+        if options.shard_lease <= 0:
+            parser.error("Shard lease must be positive.")
+    if selected_action == 'sync':
+        if options.group is None:
+            parser.error("Please specify the group to synchronize.")
+        if options.state_file is None:
+            options.state_file = options.sync + '.sync-state'
+    if options.workers < 1:
+        parser.error("Number of workers must be positive.")
+    if options.image_workers < 1:
+        parser.error("Number of image workers must be positive.")
+    if options.max_rate <= 0:
+        parser.error("Maximum rate of status requests must be positive.")
+
+    # validate group item filters
+    options.filters = dict()
+    for spec in options.filter:
+        (name, _sep, value) = spec.partition('=')
+        if name not in ('title', 'reference_id'):
+            parser.error("Filter '%s' is invalid (it must be specified as 'title=VALUE' or 'reference_id=VALUE')." % spec)
+        options.filters[name] = value
+    if options.filters and not (selected_action in BULK_CHANGES and getattr(options, selected_action.replace('-', '_')).startswith('group:')):
+        parser.error("Filters select items of group:GROUP_ID given to --delete-items, --delete-images, --activate-images or --deactivate-images.")
+
     # validate metadata array
     for md in options.metadata:
         if not ':' in md:
             parser.error("Metadata pair '%s' is invalid (it must be specified as 'name:value')." % md)
 
-    # inputs from environment variables
-    if 'KWS_ACCESS_KEY' not in os.environ:
-        parser.error("Environment variable KWS_ACCESS_KEY not set.")
-    options.access_key = os.environ['KWS_ACCESS_KEY']
-    if 'KWS_SECRET_KEY' not in os.environ:
-        parser.error("Environment variable KWS_SECRET_KEY not set.")
-    options.secret_key = os.environ['KWS_SECRET_KEY']
-
-    return (options, arguments, selected_action)
+    return selected_action
+
+
+def parse_command(parser, command):
+    """ Parse command run by --batch or --daemon (the command line of an
+    action without the global options) by parser (see build_parser()).
+    Returns tuple (options, arguments, selected_action).
+    Raises exception:
+        - CommandError: Invalid command.
+    """
+    try:
+        args = shlex.split(command)
+    except ValueError, e:
+        raise CommandError(str(e))
+    # the defaults must not collect the values of repeated options
+    values = parser.get_default_values()
+    for (name, value) in vars(values).items():
+        if isinstance(value, list):
+            setattr(values, name, list(value))
+    (options, arguments) = parser.parse_args(args, values)
+    given = _given_options(parser, options, True)
+    if len(given) > 0:
+        parser.error("Option %s applies to all the commands, give it along with --batch or --daemon." % ", ".join(given))
+    for name in STDIN_OPTIONS:
+        if getattr(options, name) == '-':
+            parser.error("Standard input cannot be read by the commands.")
+    if options.shard_queue is not None:
+        parser.error("Shards of a manifest cannot be processed by a command.")
+    return (options, arguments, select_action(parser, options, arguments))
+
+
+def _given_options(parser, options, global_options):
+    """ Return names of the global options (see GLOBAL_OPTIONS) if
+    global_options is True, of the other options otherwise, whose values
+    differ from their defaults.
+    """
+    names = list()
+    for option in parser.option_list:
+        if (option.dest is None) or ((option.dest in GLOBAL_OPTIONS) != global_options):
+            continue
+        if getattr(options, option.dest) != parser.defaults.get(option.dest):
+            names.append(option.get_opt_string())
+    return names
+
+
+def _decoded(text):
+    """ Return text (str encoded in UTF-8) as unicode. """
+    if isinstance(text, unicode):
+        return text
+    return text.decode('UTF-8', 'replace')
+
+
+def _socket_in_use(path):
+    """ Return True if a server accepts connections on the Unix socket. """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            s.connect(path)
+        except socket.error:
+            return False
+        return True
+    finally:
+        s.close()
 
 
-def create_new_item(client, options, arguments):
+def create_new_item(client, options, arguments, out):
     """ Create new item. Prints progress. """
     extras = {'external_id': options.external_id,
             'reference_id': options.reference_id,
             'locale': options.locale}
     item_id = client.create_item(options.create_item_in, options.title, extras)
-    print "Created item", item_id
-    return _update_item_common(client, item_id, options, arguments)
+    print >>out, "Created item", item_id
+    return _update_item_common(client, item_id, options, arguments, out)
 
 
-def update_item(client, options, arguments):
+def update_item(client, options, arguments, out):
     """ Update existing item. Prints progress. """
     item_id = options.update_item
     extras = dict()
@@ -525,13 +1519,13 @@ def update_item(client, options, arguments):
             extras[entry] = value
     if len(extras.keys()) > 0:
         client.update_item(item_id, extras)
-        print "Updated basic item metadata"
+        print >>out, "Updated basic item metadata"
     else:
-        print "No update to basic item metadata"
-    return _update_item_common(client, item_id, options, arguments)
+        print >>out, "No update to basic item metadata"
+    return _update_item_common(client, item_id, options, arguments, out)
 
 
-def _update_item_common(client, item_id, options, arguments):
+def _update_item_common(client, item_id, options, arguments, out):
     """ Update media metadata of the existing item and add any requested images. Prints progress. """
     if options.medium_type is not None:
         metadata = dict()
@@ -539,22 +1533,253 @@ def _update_item_common(client, item_id, options, arguments):
             split = md.split(':', 1)
             metadata[split[0].strip()] = split[1]
         client.change_item_medium_type(item_id, options.medium_type, options.title, metadata)
-        print "  changed medium type to", options.medium_type, "and uploaded metadata"
-    upload_ids = list()
-    for filename in arguments:
-        upload_ids.append(client.upload_from_file(filename))
-    image_ids = list()
-    for upload_id in upload_ids:
-        image_id = client.create_image_from_upload(item_id, upload_id)
-        image_ids.append(image_id)
-        print "  added image", image_id
-        if not options.skip_image_activation:
-            client.activate_image(image_id)
-            print "  activated image", image_id
+        print >>out, "  changed medium type to", options.medium_type, "and uploaded metadata"
+    activate = not options.skip_image_activation
+    if options.image_workers == 1:
+        # the images are added in the order of the files, the first error stops the script
+        upload_ids = list()
+        for (_filename, upload_id) in client.upload_files(arguments):
+            upload_ids.append(upload_id)
+        for upload_id in upload_ids:
+            image_id = client.create_image_from_upload(item_id, upload_id)
+            print >>out, "  added image", image_id
+            if activate:
+                client.activate_image(image_id)
+                print >>out, "  activated image", image_id
+        return 0
+    failures = 0
+    for (filename, image_id, error) in client.add_images(item_id, arguments, activate, options.image_workers):
+        if image_id is not None:
+            print >>out, "  added image", image_id, "from", filename
+        if error is not None:
+            failures += 1
+            print >>out, "  FAILED to add image from %s: %s" % (filename, error)
+        elif activate:
+            print >>out, "  activated image", image_id
+    if failures > 0:
+        return 1
+    return 0
+
+
+def bulk_ingest(client, options, out):
+    """ Create or update items listed in the manifest. Prints progress. """
+    from bulk import BulkIngestor, read_manifest
+    ingestor = BulkIngestor(client, options.workers, not options.skip_image_activation, options.group, options.image_workers)
+    failures = 0
+    processed = 0
+    # an invalid record fails alone, the other records are processed
+    for result in ingestor.run(read_manifest(options.bulk, True)):
+        processed += 1
+        line = result.record['line']
+        if result.succeeded():
+            print >>out, "line %s: item %s, images %s" % (line, result.item_id, " ".join(result.image_ids))
+        else:
+            failures += 1
+            print >>out, "line %s: FAILED (item %s, images %s): %s" % (line, result.item_id, " ".join(result.image_ids), result.error)
+    print >>out, "Processed %d records, %d failed" % (processed, failures)
+    if failures > 0:
+        return 1
+    return 0
+
+
+def sharded_ingest(client, options, out):
+    """ Create or update items listed in the manifest, taking turns with
+    the other processes using the shard queue. Prints progress.
+    """
+    from bulk import BulkIngestor
+    from journal import Journal
+    from shards import open_queue, worker_name
+    try:
+        queue = open_queue(options.shard_queue, options.bulk, options.shards)
+    except ValueError, e:
+        raise InputError(str(e))
+    worker = worker_name()
+    ingestor = BulkIngestor(client, options.workers, not options.skip_image_activation, options.group, options.image_workers)
+    # shards with failed records are not completed, so that a rerun retries
+    # them, but this process tries each of them only once: shard -> failures
+    unfinished = dict()
+    while True:
+        lease = queue.claim(worker, options.shard_lease, unfinished)
+        if lease is None:
+            if queue.finished(unfinished):
+                break
+            # wait for the shards leased by the others, or their expiration
+            time.sleep(min(options.shard_lease / 4.0, 10.0))
+            continue
+        print >>out, "shard %d: claimed by %s" % (lease.shard, worker)
+        journal = Journal(queue.journal_path(lease.shard))
+        journal.start(sys.argv[1:], os.getcwd())
+        client.set_journal(journal)
+        lease.keep_alive()
+        processed = 0
+        failures = 0
+        try:
+            results = ingestor.run(queue.read_records(lease.shard))
+            for result in results:
+                processed += 1
+                line = result.record['line']
+                if result.succeeded():
+                    print >>out, "line %s: item %s, images %s" % (line, result.item_id, " ".join(result.image_ids))
+                else:
+                    failures += 1
+                    print >>out, "line %s: FAILED (item %s, images %s): %s" % (line, result.item_id, " ".join(result.image_ids), result.error)
+                if lease.lost:
+                    results.close()
+                    break
+        except:
+            lease.release()
+            raise
+        finally:
+            client.set_journal(None)
+            journal.close()
+        if lease.lost:
+            print >>out, "shard %d: lease expired, left to another worker" % lease.shard
+            continue
+        if failures > 0:
+            # the journal of the shard lets a rerun skip the records which succeeded
+            lease.release()
+            unfinished[lease.shard] = failures
+            print >>out, "shard %d: processed %d records, %d failed, left unfinished" % (lease.shard, processed, failures)
+            continue
+        lease.complete(processed, failures)
+        print >>out, "shard %d: processed %d records, %d failed" % (lease.shard, processed, failures)
+    (completed, failed) = queue.status()
+    failed += sum(unfinished.values())
+    print >>out, "Completed %d of %d shards (%d records in total), %d records failed" % (completed, queue.shards, queue.records, failed)
+    if len(unfinished) > 0:
+        print >>out, "Shards left unfinished because of failed records: %s (run the command again to retry them)" % " ".join([str(shard) for shard in sorted(unfinished)])
+    if failed > 0:
+        return 1
     return 0
 
 
-def add_resource(client, options, arguments):
+def sync_group(client, options, out):
+    """ Synchronize group with items listed in the manifest. Prints changes. """
+    from bulk import read_manifest
+    from sync import CatalogSync, FAILED, UNCHANGED
+    # a record left out would look like an item removed from the catalog
+    try:
+        for _record in read_manifest(options.sync):
+            pass
+    except ValueError, e:
+        raise InputError("Invalid manifest %s: %s" % (options.sync, e))
+    synchronization = CatalogSync(client, options.group, options.state_file, options.workers,
+            not options.skip_image_activation, options.delete_missing)
+    counts = dict()
+    for result in synchronization.run(read_manifest(options.sync)):
+        counts[result.action] = counts.get(result.action, 0) + 1
+        if result.record is not None:
+            source = "line %s" % result.record['line']
+        else:
+            source = result.key
+        if result.action == FAILED:
+            print >>out, "%s: FAILED (item %s): %s" % (source, result.item_id, result.error)
+        elif result.action != UNCHANGED:
+            print >>out, "%s: %s item %s (%d requests)" % (source, result.action, result.item_id, result.requests)
+    summary = ", ".join(["%d %s" % (count, action) for (action, count) in sorted(counts.items())])
+    print >>out, "Synchronized group %s: %s" % (options.group, summary or "no items")
+    if counts.get(FAILED, 0) > 0:
+        return 1
+    return 0
+
+
+def wait_until_active(client, options, out):
+    """ Wait until the images are active. Prints status changes. """
+    from status_watch import ImageStatusWatcher
+    image_ids = read_id_list(options.wait_until_active)
+    watcher = ImageStatusWatcher(client, options.workers, options.max_rate)
+    for transition in watcher.watch(image_ids, options.timeout):
+        if transition.error is not None:
+            print >>out, "%s: %s (after %.0fs)" % (transition.image_id, transition.error, transition.elapsed)
+        else:
+            print >>out, "%s: %s -> %s (after %.0fs)" % (transition.image_id, transition.old_status, transition.new_status, transition.elapsed)
+    for (image_id, status) in sorted(watcher.pending.items()):
+        print >>out, "%s: %s (not active)" % (image_id, status)
+    if len(watcher.pending) > 0:
+        return 1
+    return 0
+
+
+def change_many(client, options, selected_action, out):
+    """ Delete, activate or deactivate items or images listed in a file or
+    selected from a group. Prints result for every ID.
+    """
+    (method_name, kind, done) = BULK_CHANGES[selected_action]
+    source = getattr(options, selected_action.replace('-', '_'))
+    if source.startswith('group:'):
+        ids = list_group_ids(client, source[len('group:'):], options.filters, kind == 'images')
+    else:
+        ids = read_id_list(source)
+    # a repeated ID would fail the second time
+    unique_ids = list()
+    seen = set()
+    for object_id in ids:
+        if object_id not in seen:
+            seen.add(object_id)
+            unique_ids.append(object_id)
+    if options.dry_run:
+        for object_id in unique_ids:
+            print >>out, "%s: would be %s" % (object_id, done)
+        print >>out, "%d %s would be %s" % (len(unique_ids), kind, done)
+        return 0
+    failures = 0
+    for (object_id, status, error) in getattr(client, method_name)(unique_ids, options.workers):
+        if error is not None:
+            failures += 1
+            print >>out, "%s: FAILED: %s" % (object_id, error)
+        elif status is not None:
+            print >>out, "%s: %s" % (object_id, status)
+        else:
+            print >>out, "%s: %s" % (object_id, done)
+    print >>out, "%d %s %s, %d failed" % (len(unique_ids) - failures, kind, done, failures)
+    if failures > 0:
+        return 1
+    return 0
+
+
+def list_group_ids(client, group_id, filters, images):
+    """ List IDs of the items of the group matching the filters (see
+    BasicDataUploadClient.iter_group_items()), or IDs of their images.
+    Returns list of IDs (as strings).
+    """
+    ids = list()
+    for item in client.iter_group_items(group_id, filters=filters):
+        if images:
+            ids.extend([str(image.id) for image in item.images])
+        else:
+            ids.append(str(item.id))
+    return ids
+
+
+def read_id_list(filename):
+    """ Read IDs listed one per line in the file (- means standard input).
+    Empty lines and lines starting with # are ignored.
+    Returns list of IDs (as strings).
+    Raises exception:
+        - InputError: The file cannot be read or a line is not a numeric ID.
+    """
+    if filename == '-':
+        lines = sys.stdin.readlines()
+        filename = 'standard input'
+    else:
+        try:
+            with open(filename, 'r') as f:
+                lines = f.readlines()
+        except IOError, e:
+            raise InputError("Cannot read IDs from %s: %s" % (filename, e.strerror or e))
+    ids = list()
+    for (number, line) in enumerate(lines):
+        line = line.strip()
+        if (line == '') or line.startswith('#'):
+            continue
+        # the IDs become part of the request paths
+        if not line.isdigit():
+            raise InputError("Invalid ID '%s' on line %d of %s (IDs must be numbers)." % (line, number + 1, filename))
+        ids.append(line)
+    return ids
+
+
+def add_resource(client, options, arguments, out):
     """ Create new item. Prints nothing. """
     if len(arguments) > 0:
         client.add_resource_file(options.create_resource_for, options.title, options.section, arguments[0])
@@ -563,97 +1788,286 @@ def add_resource(client, options, arguments):
     return 0
 
 
-def delete_image(client, options):
+def delete_image(client, options, out):
     """ Delete image. Prints nothing. """
     client.delete_image(options.delete_image)
     return 0
 
 
-def delete_item(client, options):
+def delete_item(client, options, out):
     """ Delete item. Prints nothing. """
     client.delete_item(options.delete_item)
     return 0
 
 
-def activate_image(client, options):
+def activate_image(client, options, out):
     """ Activate image. Prints new status of the image. """
-    print client.activate_image(options.activate_image)
+    print >>out, client.activate_image(options.activate_image)
     return 0
 
 
-def deactivate_image(client, options):
+def deactivate_image(client, options, out):
     """ Deactivate image. Prints new status of the image. """
-    print client.deactivate_image(options.deactivate_image)
+    print >>out, client.deactivate_image(options.deactivate_image)
     return 0
 
 
-def get_group(client, options):
+def get_group(client, options, out):
     """ Retrieve description of the group. Prints the description. """
-    print client.get_group(options.get_group)
+    print >>out, client.get_group(options.get_group)
     return 0
 
 
-def get_group_items(client, options):
+def get_group_items(client, options, out):
     """ Retrieve items of given group. Prints the items. """
-    print client.get_group_items(options.get_group_items)
+    print >>out, client.get_group_items(options.get_group_items)
     return 0
 
 
-def get_image(client, options):
+def get_image(client, options, out):
     """ Retrieve description of the image. Prints the description. """
-    print client.get_image(options.get_image)
+    print >>out, client.get_image(options.get_image)
     return 0
 
 
-def get_image_status(client, options):
+def get_image_status(client, options, out):
     """ Retrieve status of the image. Prints the status. """
-    print client.get_image_status(options.get_image_status)
+    print >>out, client.get_image_status(options.get_image_status)
     return 0
 
 
-def get_item(client, options):
+def get_item(client, options, out):
     """ Retrieve description of the item. Prints the description. """
-    print client.get_item(options.get_item)
+    print >>out, client.get_item(options.get_item)
     return 0
 
 
-def get_item_resources(client, options):
+def get_item_resources(client, options, out):
     """ Retrieve resources of the item. Prints the resources. """
-    print client.get_item_resources(options.get_item_resources)
+    print >>out, client.get_item_resources(options.get_item_resources)
+    return 0
+
+
+def run_batch(client, options, out):
+    """ Run commands listed in the batch file. Prints JSON result for every
+    command (see run_commands()).
+    """
+    if options.batch == '-':
+        failures = run_commands(client, iter(sys.stdin.readline, ''), out, options.batch_workers)
+    else:
+        with open(options.batch, 'r') as f:
+            failures = run_commands(client, iter(f.readline, ''), out, options.batch_workers)
+    if failures > 0:
+        return 1
+    return 0
+
+
+def run_commands(client, lines, out, workers):
+    """ Run commands given as lines (see parse_command(), empty lines and
+    lines starting with # are skipped), up to workers commands at once.
+    Writes a JSON object to out for every command as soon as it finishes,
+    one per line, with the entries:
+       * line: Number of the line with the command.
+       * command: The command.
+       * status: Exit status of the command (2 if the command is invalid).
+       * output: What the command printed.
+       * error: Message of the exception which failed the command, null
+          if there was none.
+       * seconds: Duration of the command.
+    Returns number of the failed commands.
+    """
+    try:
+        import json
+    except ImportError:
+        # Python 2.5
+        import simplejson as json
+    # the commands are parsed by one thread, optparse parsers are not thread-safe
+    parser = build_parser(_CommandParser)
+
+    def parse_lines():
+        number = 0
+        for line in lines:
+            number += 1
+            command = line.strip()
+            if (command == '') or command.startswith('#'):
+                continue
+            try:
+                yield (number, command, parse_command(parser, command))
+            except CommandError, e:
+                yield (number, command, e)
+
+    def run(task):
+        (number, command, parsed) = task
+        result = {'line': number, 'command': _decoded(command), 'output': u'', 'error': None, 'seconds': 0.0}
+        if isinstance(parsed, CommandError):
+            result['status'] = 2
+            result['error'] = _decoded(str(parsed))
+            return result
+        (options, arguments, selected_action) = parsed
+        output = StringIO()
+        started = time.time()
+        try:
+            result['status'] = run_action(client, options, arguments, selected_action, output)
+        except Exception, e:
+            result['status'] = 1
+            result['error'] = _decoded("%s" % e)
+        result['seconds'] = round(time.time() - started, 3)
+        result['output'] = _decoded(output.getvalue())
+        return result
+
+    failures = 0
+    for (_task, result, _error) in imap_unordered(run, parse_lines(), workers):
+        if result['status'] != 0:
+            failures += 1
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+        out.flush()
+    return failures
+
+
+def serve_commands(client, options, out):
+    """ Run commands received over the Unix socket until terminated (by
+    SIGTERM or SIGINT). Every connection sends commands one per line and
+    receives JSON result for each of them (see run_commands()). Prints
+    the socket once listening.
+    """
+    import SocketServer
+    import signal
+
+    class CommandHandler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            run_commands(client, iter(self.rfile.readline, ''), self.wfile, options.batch_workers)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+
+    if os.path.exists(options.daemon):
+        # left by a daemon which was killed (parse_inputs checked nobody listens)
+        os.unlink(options.daemon)
+    # only the user running the daemon may connect
+    umask = os.umask(0077)
+    try:
+        server = SocketServer.ThreadingUnixStreamServer(options.daemon, CommandHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, terminate)
+    print >>out, "Listening on", options.daemon
+    out.flush()
+    try:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        server.server_close()
+        os.unlink(options.daemon)
     return 0
 
 
 def main():
     """ CLI client. """
     (options, arguments, selected_action) = parse_inputs()
-    client = BasicDataUploadClient(options.access_key, options.secret_key, options.endpoint)
-    client.set_debug(options.debug)
-    if selected_action == 'create-item-in':
-        return create_new_item(client, options, arguments)
+    client = BasicDataUploadClient(options.access_key, options.secret_key, options.endpoint,
+            HTTPConnectionPool(timeout=options.socket_timeout))
+    if selected_action in ('batch', 'daemon'):
+        # standard output carries the results of the commands
+        client.set_debug(options.debug, sys.stderr)
+    else:
+        client.set_debug(options.debug)
+    client.set_rate_limiter(options.rate_limiter)
+    if options.retries > 0:
+        client.set_retry_policy(RetryPolicy(options.retries))
+    else:
+        client.set_retry_policy(None)
+    if options.upload_cache is not None:
+        from upload_cache import UploadCache
+        client.set_upload_cache(UploadCache(options.upload_cache, options.upload_cache_ttl))
+    journal = None
+    if options.journal is not None:
+        from journal import Journal
+        journal = Journal(options.journal)
+        journal.start(sys.argv[1:], os.getcwd())
+        client.set_journal(journal)
+    if options.metadata_cache is not None:
+        from metadata_cache import MetadataCache
+        client.set_metadata_cache(MetadataCache(ttl=options.metadata_cache_ttl, filename=options.metadata_cache))
+    metrics = None
+    if options.metrics is not None:
+        from instrument import MetricsCollector
+        metrics = MetricsCollector()
+        client.add_request_hooks(metrics)
+    request_log = None
+    if options.request_log == '-':
+        from instrument import JSONLinesExporter
+        client.add_request_hooks(JSONLinesExporter(sys.stderr))
+    elif options.request_log is not None:
+        from instrument import JSONLinesExporter
+        request_log = open(options.request_log, 'a')
+        client.add_request_hooks(JSONLinesExporter(request_log))
+    preprocessor = None
+    if options.max_dimension is not None:
+        from preprocess import ImagePreprocessor
+        preprocessor = ImagePreprocessor(options.max_dimension, options.jpeg_quality, options.preprocess_cache)
+        client.set_preprocessor(preprocessor)
+    try:
+        try:
+            return run_action(client, options, arguments, selected_action, sys.stdout)
+        except InputError, e:
+            print >>sys.stderr, "%s: error: %s" % (os.path.basename(sys.argv[0]), e)
+            return 2
+    finally:
+        if preprocessor is not None:
+            preprocessor.close()
+        if journal is not None:
+            journal.close()
+        if metrics is not None:
+            metrics.write_prometheus(options.metrics)
+        if request_log is not None:
+            request_log.close()
+
+
+def run_action(client, options, arguments, selected_action, out):
+    """ Perform the action selected on the command line, printing to out. """
+    if selected_action == 'batch':
+        return run_batch(client, options, out)
+    elif selected_action == 'bulk':
+        if options.shard_queue is not None:
+            return sharded_ingest(client, options, out)
+        return bulk_ingest(client, options, out)
+    elif selected_action == 'create-item-in':
+        return create_new_item(client, options, arguments, out)
     elif selected_action == 'create-resource-for':
-        return add_resource(client, options, arguments)
+        return add_resource(client, options, arguments, out)
     elif selected_action == 'update-item':
-        return update_item(client, options, arguments)
+        return update_item(client, options, arguments, out)
     elif selected_action == 'delete-image':
-        return delete_image(client, options)
+        return delete_image(client, options, out)
     elif selected_action == 'delete-item':
-        return delete_item(client, options)
+        return delete_item(client, options, out)
     elif selected_action == 'activate-image':
-        return activate_image(client, options)
+        return activate_image(client, options, out)
+    elif selected_action == 'daemon':
+        return serve_commands(client, options, out)
     elif selected_action == 'deactivate-image':
-        return deactivate_image(client, options)
+        return deactivate_image(client, options, out)
+    elif selected_action in BULK_CHANGES:
+        return change_many(client, options, selected_action, out)
     elif selected_action == 'get-group':
-        return get_group(client, options)
+        return get_group(client, options, out)
     elif selected_action == 'get-group-items':
-        return get_group_items(client, options)
+        return get_group_items(client, options, out)
     elif selected_action == 'get-image':
-        return get_image(client, options)
+        return get_image(client, options, out)
     elif selected_action == 'get-image-status':
-        return get_image_status(client, options)
+        return get_image_status(client, options, out)
     elif selected_action == 'get-item':
-        return get_item(client, options)
+        return get_item(client, options, out)
     elif selected_action == 'get-item-resources':
-        return get_item_resources(client, options)
+        return get_item_resources(client, options, out)
+    elif selected_action == 'sync':
+        return sync_group(client, options, out)
+    elif selected_action == 'wait-until-active':
+        return wait_until_active(client, options, out)
     else:
         raise NotImplementedError("Unimplemented action: --"+selected_action)
 
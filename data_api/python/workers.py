@@ -0,0 +1,260 @@
+"""
+Thread pool helpers for the kooaba API clients.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import collections
+import sys
+import threading
+
+# Python 2 vs 3
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+__all__ = ['WorkerPool', 'imap_prefetch', 'imap_unordered']
+
+
+# Markers passed through the result queue
+_WORKER_DONE = object()
+_FEED_FAILED = object()
+
+
+class _PrefetchSlot:
+    """ Argument of imap_prefetch and its result once computed. """
+
+    def __init__(self, argument):
+        self.argument = argument
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def imap_prefetch(function, arguments, workers, depth):
+    """ Apply function to the arguments ahead of their consumption.
+
+    The function is applied on a pool of worker threads to at most depth
+    arguments following the one being consumed, so that the consumer does
+    not wait for the results computed meanwhile. Generates tuples
+    (argument, result, error) in the order of the arguments, see
+    imap_unordered for their meaning.
+
+    Closing the generator early stops the workers after their current
+    call, the arguments not started yet are skipped.
+    """
+    tasks = queue.Queue()
+    stop = threading.Event()
+
+    def work():
+        while True:
+            slot = tasks.get()
+            if slot is None:
+                return
+            if not stop.isSet():
+                try:
+                    slot.result = function(slot.argument)
+                except Exception:
+                    slot.error = sys.exc_info()[1]
+            slot.done.set()
+
+    threads = [threading.Thread(target=work) for _i in range(max(workers, 1))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    arguments = iter(arguments)
+    pending = collections.deque()
+    exhausted = False
+    try:
+        while True:
+            while (not exhausted) and (len(pending) < max(depth, 1)):
+                try:
+                    argument = next(arguments)
+                except StopIteration:
+                    exhausted = True
+                    break
+                slot = _PrefetchSlot(argument)
+                pending.append(slot)
+                tasks.put(slot)
+            if not pending:
+                return
+            slot = pending.popleft()
+            slot.done.wait()
+            yield (slot.argument, slot.result, slot.error)
+    finally:
+        stop.set()
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+
+def imap_unordered(function, arguments, workers):
+    """ Apply function to every argument on a pool of worker threads.
+
+    The arguments are consumed lazily (at most a few of them per worker are
+    held in memory), so arguments can be an arbitrarily long iterable.
+    Generates tuples (argument, result, error) in the order of completion.
+    The error is the exception raised by the function (result is None
+    then), or None if the call succeeded.
+
+    Closing the generator early stops the workers after their current
+    call. Any exception raised while iterating over the arguments is
+    re-raised to the consumer.
+    """
+    if workers <= 1:
+        for argument in arguments:
+            try:
+                yield (argument, function(argument), None)
+            except Exception:
+                yield (argument, None, sys.exc_info()[1])
+        return
+    tasks = queue.Queue(workers * 2)
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def feed():
+        try:
+            try:
+                for argument in arguments:
+                    if stop.isSet():
+                        break
+                    tasks.put((argument,))
+            except Exception:
+                results.put((_FEED_FAILED, sys.exc_info()[1]))
+        finally:
+            for _i in range(workers):
+                tasks.put(None)
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                results.put((_WORKER_DONE, None))
+                return
+            if stop.isSet():
+                # drain the remaining tasks so that the feeder cannot block
+                continue
+            argument = task[0]
+            try:
+                results.put((argument, function(argument), None))
+            except Exception:
+                results.put((argument, None, sys.exc_info()[1]))
+
+    threads = [threading.Thread(target=feed)]
+    threads += [threading.Thread(target=work) for _i in range(workers)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    running = workers
+    try:
+        while running > 0:
+            result = results.get()
+            if result[0] is _WORKER_DONE:
+                running -= 1
+            elif result[0] is _FEED_FAILED:
+                raise result[1]
+            else:
+                yield result
+    finally:
+        stop.set()
+
+
+class WorkerPool:
+    """ Pool of worker threads shared by many consumers.
+
+    Unlike imap_unordered(), which starts its own threads for every call,
+    the threads of the pool are started once and serve the calls of
+    imap_unordered() of any number of threads until close().
+    """
+
+    def __init__(self, workers):
+        """ Start the worker threads. """
+        self._tasks = queue.Queue()
+        self._threads = [threading.Thread(target=self._work) for _i in range(max(workers, 1))]
+        for thread in self._threads:
+            thread.setDaemon(True)
+            thread.start()
+
+    def close(self):
+        """ Stop the worker threads once the submitted calls finish. """
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def imap_unordered(self, function, arguments, limit = None):
+        """ Apply function to every argument on the threads of the pool,
+        running at most limit of the calls at once (as many as there are
+        workers if None). Generates tuples (argument, result, error) in the
+        order of completion, see the imap_unordered() function.
+
+        Closing the generator early skips the calls not started yet.
+        """
+        if limit is None:
+            limit = len(self._threads)
+        results = queue.Queue()
+        stop = threading.Event()
+        arguments = iter(arguments)
+        running = 0
+        exhausted = False
+        try:
+            while True:
+                while (not exhausted) and (running < limit):
+                    try:
+                        argument = next(arguments)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    self._tasks.put((function, argument, results, stop))
+                    running += 1
+                if running == 0:
+                    return
+                result = results.get()
+                running -= 1
+                yield result
+        finally:
+            stop.set()
+
+    def _work(self):
+        """ Run the submitted calls until close(). """
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            (function, argument, results, stop) = task
+            if stop.isSet():
+                continue
+            try:
+                results.put((argument, function(argument), None))
+            except Exception:
+                results.put((argument, None, sys.exc_info()[1]))
+
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
@@ -0,0 +1,160 @@
+"""
+Cache of the Query API recognition results.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+try:
+    from lru import LRUCache
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data_api', 'python'))
+    from lru import LRUCache
+
+
+__all__ = ['QueryCache', 'result_key']
+
+
+# Results of the queries change only when the images in the groups change,
+# keep them for a few minutes unless invalidated explicitly
+DEFAULT_TTL = 300.0
+
+
+def result_key(scope, body_md5, groups, parameters = None):
+    """ Return cache key of the query of an image (given by the MD5 hex
+    digest of the query body containing it) in the groups with the query
+    parameters, sent by a client with the scope (a string naming its
+    endpoint and access key, the same group IDs may name different groups
+    for other accounts or servers). The order of the groups does not
+    matter.
+    """
+    groups_text = ',%s,' % ','.join(sorted(set(str(group_id) for group_id in groups)))
+    parameters_text = '&'.join('%s=%s' % item for item in sorted((parameters or dict()).items()))
+    return (scope, body_md5, groups_text, parameters_text)
+
+
+class QueryCache:
+    """ Cache of the responses to the queries.
+
+    The responses are kept in memory (at most max_entries of them taking
+    at most max_size bytes) and optionally in a SQLite database file
+    shared by processes. A response is used for ttl seconds after the
+    query, or until the results in any of its groups are invalidated by
+    invalidate_group() (e.g. after activating new reference images).
+    The invalidation reaches the memory of other processes sharing the
+    database file only once their entries expire.
+    """
+
+    def __init__(self, max_entries = 1000, max_size = 16 * 1024 * 1024, ttl = DEFAULT_TTL, filename = None):
+        """ Create cache, the responses are stored also in the database
+        file filename unless it is None.
+        """
+        self.ttl = ttl
+        self._memory = LRUCache(max_entries, max_size)
+        self._lock = threading.Lock()
+        self._db = None
+        if filename is not None:
+            self._db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+            with self._lock:
+                columns = [row[1] for row in self._db.execute("PRAGMA table_info(results)").fetchall()]
+                if columns and ('scope' not in columns):
+                    # results cached without scope by older versions
+                    self._db.execute("DROP TABLE results")
+                self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "scope TEXT NOT NULL, body_md5 TEXT NOT NULL, groups TEXT NOT NULL, parameters TEXT NOT NULL, "
+                        "body BLOB NOT NULL, stored_at REAL NOT NULL, PRIMARY KEY (scope, body_md5, groups, parameters))")
+                self._db.commit()
+
+    def clear(self):
+        """ Drop all the responses. """
+        self._memory.clear()
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("DELETE FROM results")
+                self._db.commit()
+
+    def close(self):
+        """ Close the cache database. """
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+
+    def invalidate_group(self, group_id):
+        """ Drop responses to the queries searching in the group (in all
+        the scopes).
+        """
+        pattern = ',%s,' % group_id
+        self._memory.remove_if(lambda key: pattern in key[2])
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("DELETE FROM results WHERE groups LIKE ?", ('%' + pattern + '%',))
+                self._db.commit()
+
+    def lookup(self, key):
+        """ Return cached body of the response to the query with the key
+        (see result_key()), None if there is no such unexpired response.
+        """
+        found = self._memory.get_with_age(key)
+        if found is not None:
+            (body, age) = found
+            if age <= self.ttl:
+                return body
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT body, stored_at FROM results "
+                    "WHERE scope = ? AND body_md5 = ? AND groups = ? AND parameters = ? AND stored_at > ?",
+                    key + (time.time() - self.ttl,)).fetchone()
+        if row is None:
+            return None
+        body = bytes(row[0])
+        self._memory.put(key, body, len(body), row[1])
+        return body
+
+    def purge(self):
+        """ Remove expired responses from the database. """
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("DELETE FROM results WHERE stored_at <= ?", (time.time() - self.ttl,))
+                self._db.commit()
+
+    def store(self, key, body):
+        """ Cache body of the response to the query with the key. """
+        now = time.time()
+        self._memory.put(key, body, len(body), now)
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("INSERT OR REPLACE INTO results (scope, body_md5, groups, parameters, body, stored_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", key + (sqlite3.Binary(body), now))
+                self._db.commit()
+
+# vim: ai:si:sw=4:ts=4:et:sts=4:
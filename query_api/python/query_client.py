@@ -0,0 +1,488 @@
+"""
+Client of the kooaba Query API.
+
+Copyright (c) 2011, kooaba AG
+
+All rights reserved. Redistribution and use in source and binary forms,
+with or without modification, are permitted provided that the following
+conditions are met:
+
+  * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+  * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+  * Neither the name of the kooaba AG nor the names of its contributors may be
+    used to endorse or promote products derived from this software without
+    specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import email.utils
+import mimetypes
+import os
+import socket
+import sys
+import uuid
+
+# The signing, connection pooling and XML helpers are shared with the
+# Data API client, use its modules from this repository unless installed.
+try:
+    from KWS import KWSSigner, new_md5
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data_api', 'python'))
+    from KWS import KWSSigner, new_md5
+from connection_pool import HTTPConnectionPool, STALE_CONNECTION_ERRORS
+from models import Group, Record, decode_element, parse_records, parse_xml
+from retry import RetryPolicy
+from workers import imap_unordered
+from query_cache import DEFAULT_TTL, result_key
+
+# Python 2 vs 3
+try:
+    import httplib
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlparse
+
+
+__all__ = ['MatchedItem', 'QueryClient', 'QueryError', 'QueryResult']
+
+
+VERSION = '1.0.0'
+
+# Configuration defaults
+QUERY_ENDPOINT = 'http://search.kooaba.com'
+
+# Content type covered by the signatures of the queries (the boundary is
+# sent only in the Content-Type header)
+MULTIPART_CONTENT_TYPE = 'multipart/form-data'
+
+# Boundary of the query bodies not containing it, the same in every client
+# so that the body digests key the cached results of all the processes
+MULTIPART_BOUNDARY = 'b7e1c5f9a2d84e6c93f0a1d2c3b4e5f6'
+
+CRLF = b'\r\n'
+
+
+class QueryError(RuntimeError):
+    """ Query API call returned an error status.
+
+    Attributes:
+       * status: HTTP status code of the response.
+       * reason: HTTP reason phrase of the response.
+       * body: Body of the response (usually XML with error messages).
+       * retry_after: Seconds to wait before retrying as requested by the
+          server (None if not specified).
+    """
+
+    def __init__(self, status, reason, body, retry_after = None):
+        RuntimeError.__init__(self, "Query API call returned status %s %s. Message: %s" % (status, reason, body))
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.retry_after = None
+        if retry_after is not None:
+            try:
+                self.retry_after = int(retry_after)
+            except ValueError:
+                pass
+
+
+class ItemResource(Record):
+    """ Resource of a recognized item (e.g. an EAN of a product). """
+
+    __slots__ = ('title', 'address', 'locale', 'scheme')
+    fields = __slots__
+
+    def __repr__(self):
+        return '<%s %s:%s>' % (self.__class__.__name__, self.scheme, self.address)
+
+
+class MatchedItem(Record):
+    """ Item recognized in a query image, the resources are ItemResource
+    records. The matches score is given only if multiple items were
+    requested (higher is better).
+    """
+
+    __slots__ = ('title', 'reference_id', 'medium_type', 'matches', 'resources')
+    fields = __slots__
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, _native(self.title))
+
+    def _decode_field(self, name):
+        if name == 'medium_type':
+            return self.element.get('medium-type')
+        if name == 'matches':
+            matches = self.element.get('matches')
+            if matches is None:
+                return None
+            return int(matches)
+        if name == 'resources':
+            return [ItemResource(element) for element in self.element.findall('item-resources/item-resource')]
+        return Record._decode_field(self, name)
+
+
+class QueryResult(Record):
+    """ Result of a query, the items are MatchedItem records (an empty list
+    if nothing was recognized).
+    """
+
+    __slots__ = ('uuid', 'result_url', 'items')
+    fields = __slots__
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.uuid)
+
+    def _decode_field(self, name):
+        if name == 'items':
+            elements = self.element.findall('items/item')
+            item = self.element.find('item')
+            if (item is not None) and (decode_element(item) is not None):
+                elements.append(item)
+            return [MatchedItem(element) for element in elements]
+        return Record._decode_field(self, name)
+
+
+class QueryClient:
+    """ Client of the Query API.
+
+    The client keeps the connections to the server open for the following
+    queries and can be shared by multiple threads. The constant parts of
+    the multipart request bodies (the parts naming the groups and the
+    other query parameters) are built once and the MD5 hash of the body
+    continues from a hash state computed for them, so only the image is
+    hashed for each query.
+    """
+
+    def __init__(self, access_key, secret_key, endpoint = None, connection_pool = None, retry_policy = None):
+        """ Initialize client for given endpoint (e.g. http://search.kooaba.com),
+        None means the default endpoint. Queries are retried according to
+        retry_policy (a retry.RetryPolicy with default settings if None).
+        """
+        self.access_key = access_key
+        self.kws = KWSSigner(secret_key, memoize=True)
+        if endpoint is None:
+            endpoint = QUERY_ENDPOINT
+        if '://' not in endpoint:
+            # endpoint as a host or host:port
+            endpoint = 'http://' + endpoint
+        self.endpoint = endpoint
+        self._parsed_endpoint = urlparse(endpoint)
+        if self._parsed_endpoint.scheme not in ('http', 'https'):
+            raise RuntimeError("URL scheme '%s' not supported" % self._parsed_endpoint.scheme)
+        if connection_pool is None:
+            connection_pool = HTTPConnectionPool()
+        self.connection_pool = connection_pool
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        self.result_cache = None
+        # results of other accounts or servers must not be used
+        self._cache_scope = '%s %s' % (access_key, endpoint)
+        self.boundary = MULTIPART_BOUNDARY
+        # (groups, parameters) -> (leading parts of the body, MD5 state after them)
+        self._prefixes = dict()
+
+    def close(self):
+        """ Close idle connections to the server. """
+        self.connection_pool.close()
+
+    def get_groups(self):
+        """ Return list of groups (models.Group with id and title) the user
+        can query.
+        """
+        body = self._send_request('GET', '/groups.xml')
+        return parse_records(body, Group)
+
+    def recognize(self, data, groups, content_type = 'image/jpeg', filename = 'query.jpg', parameters = None):
+        """ Recognize the query image given as data (str under Python 2,
+        bytes under Python 3) in the groups (list of group IDs).
+        The parameters (dictionary) are the optional query parameters,
+        e.g. {'multiple_items': 'true', 'country': 'US'}. Results cached
+        by the result cache (if set) are returned without any request.
+        Returns QueryResult.
+        Raises exception:
+            - IOError: Failure performing the HTTP call.
+            - QueryError: The server returned an error.
+            - ValueError: No group given.
+        """
+        if len(groups) == 0:
+            raise ValueError("Query requires at least one group")
+        (body, content_md5, boundary) = self._build_body(data, groups, content_type, filename, parameters)
+        key = None
+        # the signed digest of the body keys the result, so the image is
+        # hashed once (bodies with a random boundary are not cached)
+        if (self.result_cache is not None) and (boundary == self.boundary):
+            key = result_key(self._cache_scope, content_md5, groups, parameters)
+            cached = self.result_cache.lookup(key)
+            if cached is not None:
+                return QueryResult(parse_xml(cached))
+        body = self._send_request('POST', '/queries.xml', body, content_md5, boundary)
+        result = QueryResult(parse_xml(body))
+        if key is not None:
+            self.result_cache.store(key, body)
+        return result
+
+    def recognize_file(self, filename, groups, content_type = None, parameters = None):
+        """ Recognize the query image stored in the file, see recognize().
+        None as content_type means the type is guessed from the file name.
+        """
+        if content_type is None:
+            (content_type, _encoding) = mimetypes.guess_type(filename)
+            if content_type is None:
+                content_type = 'image/jpeg'
+        with open(filename, 'rb') as f:
+            data = f.read()
+        return self.recognize(data, groups, content_type, os.path.basename(filename), parameters)
+
+    def recognize_many(self, images, groups, workers = 8, parameters = None):
+        """ Recognize many query images in the groups, up to workers queries
+        at once over the pooled connections. The images are file names or
+        tuples (data, content type), see recognize_file() and recognize().
+        Generates tuples (image, QueryResult, error) in the order of
+        completion. The error is the exception which failed the query (the
+        result is None then) or None.
+        """
+        def recognize(image):
+            if isinstance(image, tuple):
+                (data, content_type) = image
+                return self.recognize(data, groups, content_type, parameters=parameters)
+            return self.recognize_file(image, groups, parameters=parameters)
+        return imap_unordered(recognize, images, workers)
+
+    def set_result_cache(self, result_cache):
+        """ Answer repeated queries of the same image content in the same
+        groups from the result_cache (query_cache.QueryCache), None
+        disables the cache.
+        """
+        self.result_cache = result_cache
+
+    def _build_body(self, data, groups, content_type, filename, parameters):
+        """ Build multipart body of a query.
+        Returns tuple (body, MD5 hex digest of the body, boundary).
+        """
+        boundary = self.boundary
+        if _to_bytes(boundary) in data:
+            # the boundary must not occur in the content
+            boundary = uuid.uuid4().hex
+            (prefix, prefix_md5) = self._build_prefix(boundary, groups, parameters)
+        else:
+            key = (tuple(groups), tuple(sorted((parameters or dict()).items())))
+            cached = self._prefixes.get(key)
+            if cached is None:
+                cached = self._build_prefix(boundary, groups, parameters)
+                self._prefixes[key] = cached
+            (prefix, prefix_md5) = cached
+        file_header = _to_bytes('--%s\r\nContent-Disposition: form-data; name="query[file]"; filename="%s"\r\n'
+                'Content-Transfer-Encoding: binary\r\nContent-Type: %s\r\n\r\n' % (boundary, filename, content_type))
+        closing = _to_bytes('\r\n--%s--\r\n' % boundary)
+        h = prefix_md5.copy()
+        h.update(file_header)
+        h.update(data)
+        h.update(closing)
+        return (b''.join([prefix, file_header, data, closing]), h.hexdigest(), boundary)
+
+    def _build_prefix(self, boundary, groups, parameters):
+        """ Build the parts of a query body preceding the image.
+        Returns tuple (parts, MD5 hash object updated with them).
+        """
+        parts = list()
+        for group_id in groups:
+            parts.append(_form_field(boundary, 'group_ids][', group_id))
+        for (name, value) in sorted((parameters or dict()).items()):
+            parts.append(_form_field(boundary, name, value))
+        prefix = b''.join(parts)
+        h = new_md5()
+        h.update(prefix)
+        return (prefix, h)
+
+    def _send_attempt(self, method, path, body, content_md5, boundary):
+        """ Sign and send the request once. See _send_request(). """
+        parsed = self._parsed_endpoint
+        (http, reused) = self.connection_pool.acquire(parsed.scheme, parsed.hostname, parsed.port)
+        request_path = parsed.path.rstrip('/') + path
+        try:
+            date = email.utils.formatdate(None, localtime=False, usegmt=True)
+            headers = {'Date': date}
+            if body is None:
+                signature = self.kws.sign_with_no_content(method, None, date, request_path)
+            else:
+                signature = self.kws.sign_with_content_md5(method, content_md5, MULTIPART_CONTENT_TYPE, date, request_path)
+                headers['Content-Type'] = '%s; boundary=%s' % (MULTIPART_CONTENT_TYPE, boundary)
+                headers['Content-Length'] = str(len(body))
+            headers['Authorization'] = 'KWS %s:%s' % (self.access_key, _to_text(signature))
+            try:
+                try:
+                    http.request(method, request_path, body, headers)
+                    response = http.getresponse()
+                except STALE_CONNECTION_ERRORS:
+                    if not reused:
+                        raise
+                    # the server closed the kept-alive connection in the meantime
+                    http = self.connection_pool.reconnect(http)
+                    http.request(method, request_path, body, headers)
+                    response = http.getresponse()
+                # the response has to be read completely before the connection is reused
+                response_body = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                raise IOError("Error during request: %s: %s" % (type(e), e))
+        except:
+            self.connection_pool.discard(http)
+            raise
+        if response.will_close:
+            self.connection_pool.discard(http)
+        else:
+            self.connection_pool.release(http)
+        if (response.status < 200) or (response.status > 299):
+            raise QueryError(response.status, response.reason, response_body, response.getheader('Retry-After'))
+        return response_body
+
+    def _send_request(self, method, path, body = None, content_md5 = None, boundary = None):
+        """ Send the request (with multipart body with the boundary unless
+        it is None) to the path of the endpoint, retrying failed attempts
+        according to the retry policy (queries do not change any data, so
+        they can be repeated).
+        Returns body of the response.
+        Raises exception on error:
+            - IOError: Failure performing HTTP call.
+            - QueryError: The server returned an error.
+        """
+        self.retry_policy.record_request()
+        retry = 0
+        while True:
+            try:
+                return self._send_attempt(method, path, body, content_md5, boundary)
+            except Exception as e:
+                retry += 1
+                if not self.retry_policy.should_retry(e, retry):
+                    raise
+                self.retry_policy.wait(retry, e)
+
+
+def _form_field(boundary, name, value):
+    """ Return multipart part of the query parameter. """
+    return _to_bytes('--%s\r\nContent-Disposition: form-data; name="query[%s]"\r\n\r\n%s\r\n' % (boundary, name, value))
+
+
+def _native(text):
+    """ Return text as native str (UTF-8 encoded under Python 2). """
+    if (text is not None) and (not isinstance(text, str)):
+        return text.encode('utf-8')
+    return text
+
+
+def _print_line(text):
+    """ Print line of text. """
+    sys.stdout.write(_native(text) + '\n')
+
+
+def _to_bytes(text):
+    """ Encode text (str under Python 3) as UTF-8 bytes. """
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+def _to_text(data):
+    """ Decode ASCII data (bytes under Python 3) to native str. """
+    if isinstance(data, str):
+        return data
+    return data.decode('ascii')
+
+
+def parse_inputs():
+    """ Parse and check command line and environment variables. """
+    import optparse
+
+    usage = """%prog [options] -g GROUP_ID [-g GROUP_ID ...] image [image2 ...]
+
+Recognizes the images (prints title and reference ID of the recognized
+items for every image as soon as it is recognized).
+
+The user credentials (access and secret keys) should be passed via
+environment variables KWS_ACCESS_KEY and KWS_SECRET_KEY."""
+
+    version = "%%prog %s" % VERSION
+
+    parser = optparse.OptionParser(usage = usage, version = version, add_help_option = True)
+    parser.add_option('-E', '--endpoint', type='string', default=QUERY_ENDPOINT,
+            help="endpoint for the request [%default]")
+    parser.add_option('-g', '--group', type='int', action='append', default=list(), metavar='GROUP_ID',
+            help="group to search the images in (can be repeated multiple times)")
+    parser.add_option('--multiple-items', action='store_true', default=False,
+            help="return all the matching items, not just the best one")
+    parser.add_option('--result-cache', type='string', default=None, metavar='FILE',
+            help="reuse results of the queries of identical images stored in the cache file FILE")
+    parser.add_option('--result-cache-ttl', type='float', default=None, metavar='SECONDS',
+            help="expiration of the cached results [%g]" % DEFAULT_TTL)
+    parser.add_option('--workers', type='int', default=8,
+            help="number of queries sent concurrently [%default]")
+
+    (options, arguments) = parser.parse_args()
+    if len(options.group) == 0:
+        parser.error("Please specify at least one group.")
+    if len(arguments) == 0:
+        parser.error("Please specify the query images.")
+    if options.workers < 1:
+        parser.error("Number of workers must be positive.")
+    if (options.result_cache_ttl is not None) and (options.result_cache is None):
+        parser.error("--result-cache-ttl requires --result-cache.")
+    if 'KWS_ACCESS_KEY' not in os.environ:
+        parser.error("Environment variable KWS_ACCESS_KEY not set.")
+    options.access_key = os.environ['KWS_ACCESS_KEY']
+    if 'KWS_SECRET_KEY' not in os.environ:
+        parser.error("Environment variable KWS_SECRET_KEY not set.")
+    options.secret_key = os.environ['KWS_SECRET_KEY']
+    return (options, arguments)
+
+
+def main():
+    """ CLI client. """
+    (options, arguments) = parse_inputs()
+    client = QueryClient(options.access_key, options.secret_key, options.endpoint)
+    result_cache = None
+    if options.result_cache is not None:
+        from query_cache import QueryCache
+        ttl = options.result_cache_ttl
+        if ttl is None:
+            ttl = DEFAULT_TTL
+        result_cache = QueryCache(ttl=ttl, filename=options.result_cache)
+        client.set_result_cache(result_cache)
+    parameters = dict()
+    if options.multiple_items:
+        parameters['multiple_items'] = 'true'
+    failures = 0
+    for (filename, result, error) in client.recognize_many(arguments, options.group, options.workers, parameters):
+        if error is not None:
+            failures += 1
+            _print_line("%s: FAILED: %s" % (filename, error))
+        elif len(result.items) == 0:
+            _print_line("%s: not recognized" % filename)
+        else:
+            for item in result.items:
+                _print_line("%s: %s (reference ID %s)" % (filename, item.title, item.reference_id))
+    client.close()
+    if result_cache is not None:
+        result_cache.close()
+    if failures > 0:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: ai:si:sw=4:ts=4:et:sts=4: